@@ -1,5 +1,26 @@
+# The package reads its paths from src.config.Config. These names keep
+# notebooks and scripts that do `from paths import *` working, and give the
+# default locations; they don't follow configure() or PARKING_* variables.
+from src.config import Config as _Config
+
+_defaults = _Config()
+
 # Relative paths to the databases
-parking_prices_path = "Databases\\parking_prices.db"
-parking_slots_path = "Databases\\parking_slots.db"
-parking_tickets_path = "Databases\\parking_tickets.db"
-users_db_path = "Databases\\users_data.db"
+(parking_slots_path, _), (parking_tickets_path, _), (parking_prices_path, _), \
+    (users_db_path, _), (user_data_personal_path, _) = _defaults.legacy_databases
+
+# Unified store that replaces the per-table databases above
+parking_db_path = _defaults.db_path
+
+# Directory holding one store per site when running several lots
+lots_dir = _defaults.lots_dir
+
+# Append-only journal of gate events and its latest snapshot
+journal_path = _defaults.journal_path
+journal_snapshot_path = _defaults.journal_snapshot_path
+
+# Directory holding cached column chunks of the tickets table for reports
+report_cache_dir = _defaults.report_cache_dir
+
+# Directory the user QR code images are written to
+qr_codes_dir = _defaults.qr_codes_dir
@@ -1,11 +1,15 @@
 import sqlite3
 from datetime import datetime
-from paths import *
-from src.slots import Slots
+from src.slots import Slots, SIZE_CLASSES
+from src.storage import get_storage
+from src.history import TicketHistory
+from src.qr import QRCodeRenderer, render_qr
+from src.tariff import get_tariff_cache
+from src.reservations import get_reservations
+from src.rollups import Rollups
+from src.metrics import timed
+from src.ledger import record_openings
 import logging
-import qrcode
-# Configure the logger
-logging.basicConfig(level=logging.INFO, filename='src\\logs\\admin.log', filemode='a', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
@@ -15,44 +19,46 @@ class Admin:
     A class to manage administrative tasks related to parking.
 
     Attributes:
-        users_db (sqlite3.Connection): Connection to the users database.
-        cursor_users (sqlite3.Cursor): Cursor for executing SQL queries on the users database.
-        parking_tickets_db (sqlite3.Connection): Connection to the parking tickets database.
-        cursor_parking_ticket (sqlite3.Cursor): Cursor for executing SQL queries on the parking tickets database.
-        parking_prices_db (sqlite3.Connection): Connection to the parking prices database.
-        cursor_parking_prices (sqlite3.Cursor): Cursor for executing SQL queries on the parking prices database.
-        slots_manager (Slots): An instance of the Slots class.
+        storage (Storage): The shared storage holding users, tickets and prices.
+        slots_manager (Slots): An instance of the Slots class. Free slots are only loaded on first use.
+        tariffs (TariffCache): In-memory copy of the parking prices, shared with the gates.
+        history (TicketHistory): Paginated access to users' tickets.
+        qr_renderer (QRCodeRenderer): Renders user QR codes in the background.
+        reports (Reports): Revenue and occupancy reports. NumPy is only imported on first use.
+        rollups (Rollups): Daily and hourly ticket and revenue totals.
     """
-    def __init__(self, users_db_name=users_db_path, parking_tickets=parking_tickets_path, parking_prices=parking_prices_path):
+    def __init__(self, storage=None, qr_renderer=None):
         """
         Initializes the Admin class.
 
         Args:
-            users_db_name (str): The name of the users database file.
+            storage (Storage): The storage to use. Defaults to the shared store.
+            qr_renderer (QRCodeRenderer): The QR code renderer. Defaults to one writing to the QR codes directory.
         """
         try:
-            self.users_db = sqlite3.connect(users_db_name)
-            self.cursor_users = self.users_db.cursor()
-            self.parking_tickets_db = sqlite3.connect(parking_tickets)
-            self.cursor_parking_ticket = self.parking_tickets_db.cursor()
-            self.parking_prices_db = sqlite3.connect(parking_prices)
-            self.cursor_parking_prices = self.parking_prices_db.cursor()
-            self.slots_manager = Slots()
-            logger.info("Admin connected to all databases")
+            self.storage = storage or get_storage()
+            self._slots_manager = None
+            self.tariffs = get_tariff_cache(self.storage)
+            self.history = TicketHistory(self.storage)
+            self.qr_renderer = qr_renderer or QRCodeRenderer()
+            self._reports = None
+            self.rollups = Rollups(self.storage)
+            logger.info("Admin using the shared storage")
         except sqlite3.Error as e:
             logger.error(f"Error connecting to database: {e}")
 
-    def __del__(self):
-        """
-        Closes all database connections when the object is deleted.
-        """
-        try:
-            self.users_db.close()
-            self.parking_prices_db.close()
-            self.parking_tickets_db.close()
-            logger.info("All database connections closed")
-        except sqlite3.Error as e:
-            logger.error(f"Error closing database connection: {e}")
+    @property
+    def slots_manager(self):
+        if self._slots_manager is None:
+            self._slots_manager = Slots(self.storage)
+        return self._slots_manager
+
+    @property
+    def reports(self):
+        if self._reports is None:
+            from src.reports import Reports
+            self._reports = Reports(self.storage)
+        return self._reports
 
     def get_prices(self):
         """
@@ -61,16 +67,11 @@ class Admin:
         Returns:
             list: A list of tuples containing vehicle types and their respective prices.
         """
-        try:
-            get_query = "SELECT * FROM parking_prices"
-            self.cursor_parking_prices.execute(get_query)
-            prices = self.cursor_parking_prices.fetchall()
-            logger.info("Retrieved parking prices")
-            return prices
-        except sqlite3.Error as e:
-            logger.error(f"Error retrieving prices: {e}")
-            return []
+        prices = list(self.tariffs.get_rates().items())
+        logger.info("Retrieved parking prices")
+        return prices
 
+    @timed("Admin.update_prices")
     def update_prices(self, type_of_vehicle, new_price):
         """
         Updates parking prices in the database.
@@ -82,13 +83,58 @@ class Admin:
         try:
             vehicle_types = [i[0] for i in self.get_prices()]
             if type_of_vehicle not in vehicle_types:
-                insert_query = 'INSERT INTO parking_prices VALUES (?,?);'
-                self.cursor_parking_prices.execute(insert_query, (type_of_vehicle, new_price))
-                self.parking_prices_db.commit()
+                insert_query = 'INSERT INTO parking_prices (vehicle_type, amount) VALUES (?,?);'
+                with self.storage.connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(insert_query, (type_of_vehicle, new_price))
+                    conn.commit()
+                self.tariffs.invalidate()
                 logger.info(f"Updated prices for vehicle type {type_of_vehicle} to {new_price}")
         except sqlite3.Error as e:
             logger.error(f"Error updating prices: {e}")
 
+    def set_tariff_rules(self, type_of_vehicle, grace_minutes=0, rounding_minutes=0, daily_max=None):
+        """
+        Sets the grace period, rounding and daily cap of a vehicle type's tariff.
+
+        Args:
+            type_of_vehicle (str): The type of vehicle.
+            grace_minutes (int): Stays up to this many minutes are free.
+            rounding_minutes (int): Billable time is rounded up to a multiple of this, 0 for none.
+            daily_max (float): Cap on the charge for each 24 hours, or None for no cap.
+        """
+        try:
+            update_query = "UPDATE parking_prices SET grace_minutes = ?, rounding_minutes = ?, daily_max = ? WHERE vehicle_type = ?;"
+            with self.storage.connection() as conn:
+                conn.execute(update_query, (grace_minutes, rounding_minutes, daily_max, type_of_vehicle))
+                conn.commit()
+            self.tariffs.invalidate()
+            logger.info(f"Updated tariff rules for vehicle type {type_of_vehicle}")
+        except sqlite3.Error as e:
+            logger.error(f"Error updating tariff rules: {e}")
+
+    def set_tariff_bands(self, type_of_vehicle, bands):
+        """
+        Replaces the time-of-day bands of a vehicle type's tariff.
+
+        Args:
+            type_of_vehicle (str): The type of vehicle.
+            bands (list): (start_minute, end_minute, amount, is_flat) tuples in minutes from
+                midnight. Hourly bands replace the base rate; flat bands charge amount once
+                per occurrence, e.g. an overnight flat rate from 1320 to 360.
+        """
+        try:
+            with self.storage.transaction() as conn:
+                conn.execute("DELETE FROM tariff_bands WHERE vehicle_type = ?;", (type_of_vehicle,))
+                conn.executemany(
+                    "INSERT INTO tariff_bands (vehicle_type, start_minute, end_minute, amount, is_flat) VALUES (?, ?, ?, ?, ?);",
+                    [(type_of_vehicle, start, end, amount, int(bool(is_flat))) for start, end, amount, is_flat in bands])
+            self.tariffs.invalidate()
+            logger.info(f"Set {len(bands)} tariff bands for vehicle type {type_of_vehicle}")
+        except sqlite3.Error as e:
+            logger.error(f"Error setting tariff bands: {e}")
+
+    @timed("Admin.get_users_info")
     def get_users_info(self, user_id):
         """
         Retrieves parking ticket information for a specific user.
@@ -100,15 +146,50 @@ class Admin:
             list: A list of tuples containing parking ticket information for the specified user.
         """
         try:
-            get_query = f"SELECT * FROM parking_tickets WHERE user_id = {user_id}"
-            self.cursor_parking_ticket.execute(get_query)
-            user_info = self.cursor_parking_ticket.fetchall()
+            get_query = "SELECT * FROM parking_tickets WHERE user_id = ? ORDER BY in_time;"
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(get_query, (user_id,))
+                user_info = cursor.fetchall()
             logger.info(f"Retrieved user info for user_id {user_id}")
             return user_info
         except sqlite3.Error as e:
             logger.error(f"Error retrieving user info: {e}")
             return []
 
+    def get_users_info_page(self, user_id, after=None, limit=100, start=None, end=None, vehicle_type=None):
+        """
+        Retrieves one page of parking ticket information for a specific user.
+
+        Args:
+            user_id (int): The ID of the user.
+            after (tuple): Cursor returned with the previous page, or None for the first page.
+            limit (int): Maximum number of tickets in the page.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+            vehicle_type (str): Only tickets for this vehicle type.
+
+        Returns:
+            tuple: (rows, cursor). cursor is None when there are no more pages.
+        """
+        return self.history.page(user_id, after, limit, start, end, vehicle_type)
+
+    def iter_users_info(self, user_id, chunk_size=500, start=None, end=None, vehicle_type=None):
+        """
+        Streams parking ticket information for a specific user in constant memory.
+
+        Args:
+            user_id (int): The ID of the user.
+            chunk_size (int): Number of rows fetched per query.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+            vehicle_type (str): Only tickets for this vehicle type.
+
+        Returns:
+            generator: Yields parking ticket rows in entry order.
+        """
+        return self.history.stream(user_id, chunk_size, start, end, vehicle_type)
+
     def get_available_slots(self):
         """
         Retrieves all available parking slots.
@@ -136,55 +217,246 @@ class Admin:
             return []
         
 
+    @timed("Admin.add_slots")
+    def add_slots(self, slot_numbers, size_class, level=0, zone=None):
+        """
+        Adds parking slots, or changes the class, level and zone of existing ones.
+
+        Existing slots keep their status. Gates running in other processes pick
+        the change up the next time they reload their free slots.
+
+        Args:
+            slot_numbers (iterable): The slot numbers.
+            size_class (str): One of SIZE_CLASSES, e.g. "van".
+            level (int): The level the slots are on.
+            zone (str): The zone the slots are in, or None.
+
+        Raises:
+            ValueError: If the size class isn't known.
+        """
+        if size_class not in SIZE_CLASSES:
+            raise ValueError(f"Unknown size class {size_class}")
+        upsert_query = '''
+            INSERT INTO parking_slots (slot_number, status, size_class, level, zone) VALUES (?, "free", ?, ?, ?)
+            ON CONFLICT (slot_number) DO UPDATE SET size_class = excluded.size_class, level = excluded.level, zone = excluded.zone;
+        '''
+        try:
+            rows = [(int(slot_number), size_class, level, zone) for slot_number in slot_numbers]
+            with self.storage.transaction() as conn:
+                conn.executemany(upsert_query, rows)
+            self.slots_manager.load_free_slots()
+            get_reservations(self.storage).invalidate()
+            logger.info(f"Configured {len(rows)} {size_class} slots on level {level}, zone {zone}")
+        except sqlite3.Error as e:
+            logger.error(f"Error adding slots: {e}")
+
+    @timed("Admin.get_daily_revenue")
+    def get_daily_revenue(self, start_day, end_day=None):
+        """
+        Returns tickets and revenue per day and vehicle type from the rollups.
+
+        Args:
+            start_day (datetime or str): First day, 'YYYY-MM-DD'.
+            end_day (datetime or str): Last day, inclusive. Defaults to start_day.
+
+        Returns:
+            list: (day, vehicle_type, tickets, revenue, minutes) tuples ordered by day.
+        """
+        return self.rollups.daily(start_day, end_day or start_day)
+
+    def get_occupancy(self, attribute=None, value=None):
+        """
+        Returns live free and occupied counts without querying the database.
+
+        Args:
+            attribute (str): Slot attribute to count, e.g. "level". None for the whole lot.
+            value: The attribute's value.
+
+        Returns:
+            tuple: (free, occupied).
+        """
+        return self.slots_manager.occupancy.counts(attribute, value)
+
     def add_user_to_database(self, user_id, name, email_id, phone_number):
-        conn = sqlite3.connect('Databases\\user_data_personal.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users WHERE user_id=?", (user_id,))
-        count = cursor.fetchone()[0]
-        if count > 0:
-            print(f"User ID {user_id} already exists in the database.")
-        else:
-            # Generate QR code
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(user_id)
-            qr.make(fit=True)
-            
-            img = qr.make_image(fill='black', back_color='white')
-            qr_code_path = f'src\\qr_codes\\user_id_{user_id}.png'
-            img.save(qr_code_path)
+        """
+        Stores a user's personal details and queues their QR code.
+
+        The row is committed straight away with the path the QR code will be
+        written to. The image itself is rendered in the background.
+
+        Args:
+            user_id (int): The ID of the user.
+            name (str): The user's name.
+            email_id (str): The user's email address.
+            phone_number (str): The user's phone number.
+
+        Returns:
+            str: The path of the user's QR code, or None if the user already exists.
+        """
+        with self.storage.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM users WHERE user_id=?", (user_id,))
+            count = cursor.fetchone()[0]
+            if count > 0:
+                print(f"User ID {user_id} already exists in the database.")
+                return None
+            qr_code_path = self.qr_renderer.path_for(str(user_id))
             cursor.execute(
             "INSERT INTO users (user_id, name, email_id, phone_number, qr_code_path) VALUES (?, ?, ?, ?, ?)",
             (user_id, name, email_id, phone_number, qr_code_path))
             conn.commit()
-            print(f"QR Code saved at: {qr_code_path}")
-            conn.close()
-            
+        self.qr_renderer.submit(str(user_id))
+        print(f"QR Code will be saved at: {qr_code_path}")
+        return qr_code_path
+
+    def get_qr_code(self, user_id, image_format="png"):
+        """
+        Renders a user's QR code on demand instead of reading it from disk.
+
+        Args:
+            user_id (int): The ID of the user.
+            image_format (str): "png" or "svg".
+
+        Returns:
+            bytes: The rendered image.
+        """
+        return render_qr(str(user_id), image_format)
+
+    def close(self):
+        """
+        Waits for queued QR code renders and stops the render processes.
+        """
+        self.qr_renderer.close()
+
     def add_new_user(self, name, email, phone_number, initial_balance):
         """
         Adds a new user to the system with an initial balance.
 
         Args:
+            name (str): The user's name.
+            email (str): The user's email address.
+            phone_number (str): The user's phone number.
             initial_balance (float): The initial balance for the new user.
 
         Returns:
-            int: The ID of the new user.
+            tuple: The ID of the new user and the path of their QR code, or None on error.
         """
-        try:
-            self.cursor_users.execute("SELECT MAX(user_id) FROM user_data")
-            max_user_id = self.cursor_users.fetchone()[0]
-            new_user_id = max_user_id + 1 if max_user_id else 1
-            qr_path = self.add_user_to_database(new_user_id,name, email, phone_number)
-            insert_query = "INSERT INTO user_data (user_id, amount) VALUES (?, ?);"
-            self.cursor_users.execute(insert_query, (new_user_id, initial_balance))
-            self.users_db.commit()
-            logger.info(f"Added new user with user_id {new_user_id} and initial balance {initial_balance}")
-            
-            return new_user_id, qr_path 
-        except sqlite3.Error as e:
-            logger.error(f"Error adding new user: {e}")
+        created, failed = self.add_users_bulk([(name, email, phone_number, initial_balance)])
+        if failed:
+            logger.error(f"Error adding new user: {failed[0][1]}")
             return None
+        _, new_user_id, qr_path = created[0]
+        logger.info(f"QR Code will be saved at: {qr_path}")
+        return new_user_id, qr_path
+
+    def reserve_user_ids(self, conn, count):
+        """
+        Reserves a contiguous block of user IDs.
+
+        Must be called inside a write transaction. The block is claimed with a
+        single UPDATE on the id_sequences table, so two admins adding users at
+        the same time never get overlapping IDs.
+
+        Args:
+            conn (sqlite3.Connection): A connection inside an open write transaction.
+            count (int): Number of IDs to reserve.
+
+        Returns:
+            int: The first ID of the block.
+        """
+        row = conn.execute(
+            "UPDATE id_sequences SET next_value = next_value + ? WHERE name = 'user_id' RETURNING next_value - ?;",
+            (count, count)).fetchone()
+        return row[0]
+
+    @timed("Admin.add_users_bulk")
+    def add_users_bulk(self, records, chunk_size=5000):
+        """
+        Adds many users in one transaction.
+
+        Records are validated first and the valid ones get a contiguous block of
+        IDs. Personal details and balances are then inserted with executemany,
+        a chunk at a time. If a chunk hits a constraint error it is rolled back
+        to its savepoint and retried row by row, so one bad row is reported
+        without aborting the rest. QR codes are rendered in the background.
+
+        Args:
+            records (list): (name, email, phone_number, initial_balance) tuples, or dicts
+                with those keys.
+            chunk_size (int): Number of rows per executemany call.
+
+        Returns:
+            tuple: (created, failed). created lists (index, user_id, qr_code_path) for each
+                added user, failed lists (index, reason) for each record that was not added.
+                Indexes refer to positions in records.
+        """
+        rows = []
+        failed = []
+        for index, record in enumerate(records):
+            try:
+                rows.append((index,) + self._user_record(record))
+            except (KeyError, TypeError, ValueError) as e:
+                failed.append((index, f"Invalid record: {e}"))
+        invalid = list(failed)
+        created = []
+        if rows:
+            try:
+                with self.storage.transaction() as conn:
+                    first_id = self.reserve_user_ids(conn, len(rows))
+                    rows = [(row[0], first_id + offset) + row[1:] for offset, row in enumerate(rows)]
+                    for i in range(0, len(rows), chunk_size):
+                        self._insert_users(conn, rows[i:i + chunk_size], created, failed)
+            except sqlite3.Error as e:
+                logger.error(f"Error adding users in bulk: {e}")
+                # Nothing was committed, so per-row failures from the inserts are superseded.
+                failed = invalid + [(row[0], f"Database error: {e}") for row in rows]
+                created = []
+        if created:
+            self.qr_renderer.submit_many([str(user_id) for _, user_id, _ in created])
+        failed.sort()
+        logger.info(f"Added {len(created)} users in bulk, {len(failed)} failed")
+        return created, failed
+
+    @staticmethod
+    def _user_record(record):
+        if isinstance(record, dict):
+            name, email, phone_number = record["name"], record.get("email"), record.get("phone_number")
+            initial_balance = record.get("initial_balance", 0)
+        else:
+            name, email, phone_number, initial_balance = record
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError("name is required")
+        initial_balance = float(initial_balance)
+        if initial_balance < 0:
+            raise ValueError("initial balance can't be negative")
+        return name, email, None if phone_number is None else str(phone_number), initial_balance
+
+    def _insert_users(self, conn, rows, created, failed):
+        personal_query = "INSERT INTO users (user_id, name, email_id, phone_number, qr_code_path) VALUES (?, ?, ?, ?, ?);"
+        balance_query = "INSERT INTO user_data (user_id, amount) VALUES (?, ?);"
+        personal = [(user_id, name, email, phone, self.qr_renderer.path_for(str(user_id)))
+                    for _, user_id, name, email, phone, _ in rows]
+        balances = [(user_id, amount) for _, user_id, _, _, _, amount in rows]
+        conn.execute("SAVEPOINT bulk_users;")
+        try:
+            conn.executemany(personal_query, personal)
+            conn.executemany(balance_query, balances)
+            record_openings(conn, balances)
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK TO bulk_users;")
+            conn.execute("RELEASE bulk_users;")
+            for row, personal_row, balance_row in zip(rows, personal, balances):
+                conn.execute("SAVEPOINT bulk_user;")
+                try:
+                    conn.execute(personal_query, personal_row)
+                    conn.execute(balance_query, balance_row)
+                    record_openings(conn, [balance_row])
+                except sqlite3.IntegrityError as e:
+                    conn.execute("ROLLBACK TO bulk_user;")
+                    failed.append((row[0], f"Could not insert user {row[1]}: {e}"))
+                else:
+                    created.append((row[0], row[1], personal_row[4]))
+                conn.execute("RELEASE bulk_user;")
+            return
+        conn.execute("RELEASE bulk_users;")
+        created.extend((row[0], row[1], p[4]) for row, p in zip(rows, personal))
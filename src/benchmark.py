@@ -0,0 +1,404 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from multiprocessing import get_context
+from src.storage import Storage
+from src.parking_gate_system import ParkingGateSystem
+from src.config import setup_logging
+from src.ledger import record_openings
+logger = logging.getLogger(__name__)
+
+# Share of bays per size class, and of arriving vehicles per vehicle type.
+SLOT_MIX = (("motorcycle", 0.05), ("car", 0.80), ("van", 0.10), ("truck", 0.05))
+VEHICLE_MIX = (("Motorcycle", 0.05), ("Car", 0.80), ("Van", 0.10), ("Truck", 0.05))
+PRICES = (("Motorcycle", 20), ("Car", 60), ("Van", 120), ("Truck", 200))
+SLOTS_PER_LEVEL = 500
+# Rush hours as (hour of day, width in hours), each adding rush_factor times the base rate at its peak.
+RUSH_HOURS = ((8.5, 1.0), (17.5, 1.25))
+# Import time budgets in milliseconds for a fresh interpreter, entry points first.
+STARTUP_BUDGETS_MS = {"src.server": 150, "src.admin": 100, "src.parking_gate_system": 75, "src.storage": 60}
+# Optional dependencies that must only be imported when a feature needs them.
+HEAVY_MODULES = ("qrcode", "PIL", "numpy", "pandas", "http.server", "concurrent.futures.process")
+
+
+def seed_lot(db_path, slots, users, initial_balance=1000):
+    """
+    Creates a store with a lot of the given size, users and prices.
+
+    Bays are split across size classes by SLOT_MIX and laid out
+    SLOTS_PER_LEVEL to a level.
+
+    Args:
+        db_path (str): Path of the database file to create.
+        slots (int): Number of bays.
+        users (int): Number of users, with IDs 1 to users.
+        initial_balance (float): Balance given to every user.
+
+    Returns:
+        Storage: The seeded storage.
+    """
+    storage = Storage(db_path, legacy_databases=())
+    rows = []
+    slot_number = 1
+    for size_class, share in SLOT_MIX:
+        for _ in range(max(1, round(slots * share))):
+            rows.append((slot_number, size_class, (slot_number - 1) // SLOTS_PER_LEVEL))
+            slot_number += 1
+    with storage.transaction() as conn:
+        conn.executemany("INSERT INTO parking_slots (slot_number, status, size_class, level) VALUES (?, 'free', ?, ?);", rows)
+        conn.executemany("INSERT INTO parking_prices (vehicle_type, amount) VALUES (?, ?);", PRICES)
+        balances = [(user_id, initial_balance) for user_id in range(1, users + 1)]
+        conn.executemany("INSERT INTO user_data (user_id, amount) VALUES (?, ?);", balances)
+        record_openings(conn, balances)
+    logger.info(f"Seeded {db_path} with {len(rows)} slots and {users} users")
+    return storage
+
+
+def arrival_rate(t, base_rate, rush_factor):
+    """
+    Returns the arrival rate at a simulated time.
+
+    Args:
+        t (float): Simulated seconds since midnight of the first day.
+        base_rate (float): Arrivals per simulated second outside rush hours.
+        rush_factor (float): Extra multiple of base_rate at the peak of each rush hour.
+
+    Returns:
+        float: Arrivals per simulated second.
+    """
+    hour = (t / 3600) % 24
+    rush = sum(math.exp(-0.5 * ((hour - peak) / width) ** 2) for peak, width in RUSH_HOURS)
+    return base_rate * (1 + rush_factor * rush)
+
+
+def make_trace(operations, users, gates, seed=0, base_rate=0.5, rush_factor=0.0, mean_stay=7200, start_hour=6):
+    """
+    Generates a reproducible arrival and departure trace.
+
+    Arrivals follow a Poisson process whose rate rises around the rush hours,
+    drawn by thinning a process at the peak rate. Stays are log-normal around
+    mean_stay. Every vehicle is assigned to one gate, which handles both its
+    entry and its exit, so a gate never waits on another gate's ticket.
+
+    Args:
+        operations (int): Number of entries plus exits to generate.
+        users (int): Number of users vehicles are drawn from.
+        gates (int): Number of gates.
+        seed (int): Random seed. The same seed gives the same trace.
+        base_rate (float): Arrivals per simulated second outside rush hours.
+        rush_factor (float): Extra multiple of the rate at rush hour peaks, 0 for a flat Poisson process.
+        mean_stay (float): Mean stay in simulated seconds.
+        start_hour (float): Simulated hour of day the trace starts at.
+
+    Returns:
+        list: One list per gate of (time, op, vehicle, user_id, vehicle_type) tuples in time order,
+            where op is "entry" or "exit" and vehicle indexes the arrival.
+    """
+    rng = random.Random(seed)
+    peak_rate = base_rate * (1 + rush_factor * len(RUSH_HOURS))
+    sigma = 0.75
+    mu = math.log(mean_stay) - sigma ** 2 / 2
+    vehicle_types = [vehicle_type for vehicle_type, _ in VEHICLE_MIX]
+    weights = [share for _, share in VEHICLE_MIX]
+    events = []
+    t = start_hour * 3600.0
+    vehicle = 0
+    while len(events) < operations:
+        t += rng.expovariate(peak_rate)
+        if rng.random() * peak_rate > arrival_rate(t, base_rate, rush_factor):
+            continue
+        user_id = rng.randint(1, users)
+        vehicle_type = rng.choices(vehicle_types, weights)[0]
+        events.append((t, "entry", vehicle, user_id, vehicle_type))
+        events.append((t + rng.lognormvariate(mu, sigma), "exit", vehicle, user_id, vehicle_type))
+        vehicle += 1
+    events.sort()
+    events = events[:operations]
+    per_gate = [[] for _ in range(gates)]
+    for event in events:
+        per_gate[event[2] % gates].append(event)
+    return per_gate
+
+
+def run_gate(gate_system, events, speedup=0.0, started=None):
+    """
+    Replays one gate's events and times every operation.
+
+    Args:
+        gate_system (ParkingGateSystem): The gate system to drive.
+        events (list): The gate's events from make_trace.
+        speedup (float): Simulated seconds per real second. 0 replays as fast as possible.
+        started (float): time.perf_counter() value the replay is paced from.
+
+    Returns:
+        dict: Latencies in seconds per op, plus "rejected" and "errors" counts.
+    """
+    latencies = {"entry": [], "exit": []}
+    tickets = {}
+    rejected = errors = 0
+    first_time = events[0][0] if events else 0
+    started = started if started is not None else time.perf_counter()
+    for t, op, vehicle, user_id, vehicle_type in events:
+        if speedup:
+            delay = started + (t - first_time) / speedup - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if op == "exit" and vehicle not in tickets:
+            continue
+        begin = time.perf_counter()
+        try:
+            if op == "entry":
+                result = gate_system.create_new_ticket(user_id, vehicle_type)
+            else:
+                result = gate_system.add_out_time(tickets.pop(vehicle))
+        except (sqlite3.Error, ValueError) as e:
+            logger.error(f"Benchmark {op} failed: {e}")
+            errors += 1
+            continue
+        latencies[op].append(time.perf_counter() - begin)
+        if op == "entry":
+            if isinstance(result, int):
+                tickets[vehicle] = result
+            else:
+                rejected += 1
+    return {"latencies": latencies, "rejected": rejected, "errors": errors}
+
+
+def _run_gate_process(db_path, events, speedup, group_commit_window, start_at):
+    log_listener = setup_logging()
+    storage = Storage(db_path, legacy_databases=())
+    gate_system = ParkingGateSystem(storage, group_commit_window=group_commit_window)
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    try:
+        return run_gate(gate_system, events, speedup)
+    finally:
+        gate_system.close()
+        storage.close()
+        if log_listener is not None:
+            log_listener.stop()
+
+
+def summarize(latencies, elapsed):
+    """
+    Summarizes one operation's latencies.
+
+    Args:
+        latencies (list): Latencies in seconds.
+        elapsed (float): Wall-clock seconds of the whole run.
+
+    Returns:
+        dict: count, throughput per second, and mean, p50, p95, p99 and max latency in milliseconds.
+    """
+    if not latencies:
+        return {"count": 0, "throughput": 0.0}
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)] * 1000
+    return {
+        "count": len(ordered),
+        "throughput": len(ordered) / elapsed if elapsed else 0.0,
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def run_benchmark(slots=1000, users=5000, operations=20000, gates=4, mode="threads", seed=0,
+                  base_rate=0.5, rush_factor=0.0, mean_stay=7200, speedup=0.0, group_commit_window=None,
+                  db_dir=None):
+    """
+    Seeds a temporary lot, replays a synthetic trace through it and reports the results.
+
+    Args:
+        slots (int): Number of bays.
+        users (int): Number of users.
+        operations (int): Number of entries plus exits.
+        gates (int): Number of concurrent gates.
+        mode (str): "threads" to share one ParkingGateSystem, or "processes" to give
+            every gate its own process and gate system on the same database.
+        seed (int): Random seed of the trace.
+        base_rate (float): Arrivals per simulated second outside rush hours.
+        rush_factor (float): Extra multiple of the rate at rush hour peaks.
+        mean_stay (float): Mean stay in simulated seconds.
+        speedup (float): Simulated seconds per real second. 0 replays as fast as possible.
+        group_commit_window (float): Group commit window in seconds, or None.
+        db_dir (str): Directory for the database. Defaults to a temporary directory removed afterwards.
+
+    Returns:
+        dict: The configuration, environment and per-operation results, ready to dump as JSON.
+    """
+    if mode not in ("threads", "processes"):
+        raise ValueError(f"Unknown mode {mode}")
+    config = {"slots": slots, "users": users, "operations": operations, "gates": gates, "mode": mode, "seed": seed,
+              "base_rate": base_rate, "rush_factor": rush_factor, "mean_stay": mean_stay, "speedup": speedup,
+              "group_commit_window": group_commit_window}
+    trace = make_trace(operations, users, gates, seed, base_rate, rush_factor, mean_stay)
+    temp_dir = None
+    if db_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        db_dir = temp_dir.name
+    db_path = os.path.join(db_dir, f"benchmark_{seed}.db")
+    try:
+        seed_lot(db_path, slots, users).close()
+        if mode == "threads":
+            storage = Storage(db_path, legacy_databases=())
+            gate_system = ParkingGateSystem(storage, group_commit_window=group_commit_window)
+            results = [None] * gates
+            started = time.perf_counter()
+
+            def worker(i):
+                results[i] = run_gate(gate_system, trace[i], speedup, started)
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(gates)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            gate_system.close()
+            storage.close()
+        else:
+            start_at = time.time() + 0.5
+            with get_context("spawn").Pool(gates) as pool:
+                pending = [pool.apply_async(_run_gate_process, (db_path, trace[i], speedup, group_commit_window, start_at))
+                           for i in range(gates)]
+                results = [p.get() for p in pending]
+            elapsed = time.time() - start_at
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+    report = {
+        "config": config,
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "elapsed_s": elapsed,
+        "rejected_entries": sum(r["rejected"] for r in results),
+        "errors": sum(r["errors"] for r in results),
+        "operations": {},
+    }
+    all_latencies = []
+    for op in ("entry", "exit"):
+        latencies = [latency for r in results for latency in r["latencies"][op]]
+        all_latencies.extend(latencies)
+        report["operations"][op] = summarize(latencies, elapsed)
+    report["operations"]["all"] = summarize(all_latencies, elapsed)
+    logger.info(f"Benchmark finished: {report['operations']['all']}")
+    return report
+
+
+def compare(report, baseline):
+    """
+    Compares a benchmark report with a baseline report.
+
+    Args:
+        report (dict): The new report.
+        baseline (dict): The report to compare against.
+
+    Returns:
+        dict: Per operation, the ratio new / baseline of throughput and of each latency percentile.
+    """
+    comparison = {}
+    for op, stats in report["operations"].items():
+        base = baseline.get("operations", {}).get(op, {})
+        comparison[op] = {key: stats[key] / base[key] for key in ("throughput", "p50_ms", "p95_ms", "p99_ms")
+                          if base.get(key) and key in stats}
+    return comparison
+
+
+def measure_startup(budgets=STARTUP_BUDGETS_MS, repeats=5):
+    """
+    Measures how long importing each module takes in a fresh interpreter.
+
+    Every import runs in its own interpreter with python -X importtime, in an
+    empty temporary directory, so the report also shows whether importing
+    loaded a heavy optional dependency or created files.
+
+    Args:
+        budgets (dict): Maps module names to their import time budget in milliseconds.
+        repeats (int): Imports per module. The fastest counts.
+
+    Returns:
+        dict: Per module, import_ms, budget_ms, heavy_modules and created_files, plus
+            "within_budget", True if every module is under budget, loads nothing heavy and creates nothing.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, (root, os.environ.get("PYTHONPATH"))))}
+    report = {"modules": {}, "within_budget": True}
+    for module, budget in budgets.items():
+        samples = []
+        heavy = set()
+        created = set()
+        for _ in range(repeats):
+            with tempfile.TemporaryDirectory() as cwd:
+                result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                        cwd=cwd, env=env, capture_output=True, text=True)
+                created.update(os.listdir(cwd))
+            if result.returncode != 0:
+                raise RuntimeError(f"Importing {module} failed: {result.stderr.strip().splitlines()[-1]}")
+            lines = [line.split("|") for line in result.stderr.splitlines() if line.startswith("import time:")]
+            imported = {fields[2].strip() for fields in lines}
+            heavy.update(name for name in HEAVY_MODULES if name in imported)
+            samples.append(int(lines[-1][1]) / 1000)
+        entry = {"import_ms": min(samples), "budget_ms": budget, "heavy_modules": sorted(heavy),
+                 "created_files": sorted(created)}
+        report["modules"][module] = entry
+        if entry["import_ms"] > budget or heavy or created:
+            report["within_budget"] = False
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure entry and exit throughput and latency on a synthetic lot.")
+    parser.add_argument("--slots", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--operations", type=int, default=20000)
+    parser.add_argument("--gates", type=int, default=4)
+    parser.add_argument("--mode", choices=("threads", "processes"), default="threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=0.5, help="Arrivals per simulated second outside rush hours.")
+    parser.add_argument("--rush-factor", type=float, default=0.0, help="Extra multiple of the rate at rush hour peaks.")
+    parser.add_argument("--mean-stay", type=float, default=7200, help="Mean stay in simulated seconds.")
+    parser.add_argument("--speedup", type=float, default=0.0, help="Simulated seconds per real second, 0 for as fast as possible.")
+    parser.add_argument("--group-commit-ms", type=float, default=None)
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout.")
+    parser.add_argument("--baseline", default=None, help="A previous JSON report to compare against.")
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure import times against STARTUP_BUDGETS_MS instead, exiting with 1 if over budget.")
+    args = parser.parse_args(argv)
+    if args.startup:
+        report = measure_startup()
+        print(json.dumps(report, indent=2))
+        sys.exit(0 if report["within_budget"] else 1)
+    log_listener = setup_logging()
+    report = run_benchmark(args.slots, args.users, args.operations, args.gates, args.mode, args.seed, args.rate,
+                           args.rush_factor, args.mean_stay, args.speedup,
+                           args.group_commit_ms / 1000 if args.group_commit_ms is not None else None)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report, json.load(f))
+    if log_listener is not None:
+        log_listener.stop()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
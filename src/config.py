@@ -0,0 +1,170 @@
+import os
+import logging
+import threading
+logger = logging.getLogger(__name__)
+# Until an application or setup_logging() configures logging, the package's
+# records are dropped instead of falling through to stderr.
+logging.getLogger(__name__.rpartition(".")[0]).addHandler(logging.NullHandler())
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Legacy per-table database files and the table each one holds. They are
+# copied into the unified store the first time it is created.
+LEGACY_FILES = (
+    ("parking_slots.db", "parking_slots"),
+    ("parking_tickets.db", "parking_tickets"),
+    ("parking_prices.db", "parking_prices"),
+    ("users_data.db", "user_data"),
+    ("user_data_personal.db", "users"),
+)
+# Environment variables read by Config.from_env, and the setting and type each one sets.
+ENV_SETTINGS = (
+    ("PARKING_DATA_DIR", "data_dir", str),
+    ("PARKING_DB_PATH", "db_path", str),
+    ("PARKING_QR_CODES_DIR", "qr_codes_dir", str),
+    ("PARKING_LOG_DIR", "log_dir", str),
+    ("PARKING_LOG_LEVEL", "log_level", str),
+    ("PARKING_POOL_SIZE", "pool_size", int),
+    ("PARKING_TIMEOUT", "timeout", float),
+    ("PARKING_SYNCHRONOUS", "synchronous", str),
+)
+
+
+class Config:
+    """
+    Where the package keeps its data and logs, and how it sizes its connection pools.
+
+    Every path defaults to a location under data_dir, so pointing data_dir
+    somewhere else moves everything together. Nothing is created or opened
+    when a Config is made.
+
+    Attributes:
+        data_dir (str): Directory holding the databases.
+        db_path (str): The unified store.
+        legacy_databases (tuple): (path, table) pairs imported when the store is first created.
+        lots_dir (str): Directory holding one store per site.
+        journal_path (str): Append-only journal of gate events.
+        journal_snapshot_path (str): Latest snapshot of the journal.
+        report_cache_dir (str): Directory holding cached report chunks.
+        qr_codes_dir (str): Directory the user QR code images are written to.
+        log_dir (str): Directory of the log file.
+        log_file (str): Name of the log file.
+        log_level (str): Lowest level logged, e.g. "INFO".
+        log_queue (bool): Whether log records are written by a background thread.
+        pool_size (int): Maximum number of pooled connections per store.
+        timeout (float): Seconds to wait for a pooled connection or the write lock.
+        synchronous (str): SQLite synchronous level, NORMAL or FULL.
+    """
+    def __init__(self, data_dir="Databases", db_path=None, legacy_databases=None, lots_dir=None, journal_path=None,
+                 journal_snapshot_path=None, report_cache_dir=None, qr_codes_dir=os.path.join("src", "qr_codes"),
+                 log_dir="logs", log_file="parking.log", log_level="INFO", log_queue=True,
+                 pool_size=8, timeout=5.0, synchronous="NORMAL"):
+        self.data_dir = data_dir
+        self.db_path = db_path or os.path.join(data_dir, "parking.db")
+        if legacy_databases is None:
+            legacy_databases = tuple((os.path.join(data_dir, name), table) for name, table in LEGACY_FILES)
+        self.legacy_databases = legacy_databases
+        self.lots_dir = lots_dir or os.path.join(data_dir, "lots")
+        self.journal_path = journal_path or os.path.join(data_dir, "gate_events.journal")
+        self.journal_snapshot_path = journal_snapshot_path or os.path.join(data_dir, "gate_events.snapshot")
+        self.report_cache_dir = report_cache_dir or os.path.join(data_dir, "report_cache")
+        self.qr_codes_dir = qr_codes_dir
+        self.log_dir = log_dir
+        self.log_file = log_file
+        self.log_level = log_level
+        self.log_queue = log_queue
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.synchronous = synchronous
+
+    @classmethod
+    def from_env(cls, environ=None, **settings):
+        """
+        Creates a Config from PARKING_* environment variables.
+
+        Args:
+            environ (dict): The environment to read. Defaults to os.environ.
+            **settings: Settings that take precedence over the environment.
+
+        Returns:
+            Config: The configuration.
+        """
+        environ = os.environ if environ is None else environ
+        from_environ = {name: convert(environ[variable]) for variable, name, convert in ENV_SETTINGS if variable in environ}
+        return cls(**{**from_environ, **settings})
+
+    def __repr__(self):
+        return f"Config({', '.join(f'{name}={value!r}' for name, value in vars(self).items())})"
+
+
+_config = None
+_config_lock = threading.Lock()
+_log_listener = None
+_logging_ready = False
+
+
+def get_config():
+    """
+    Returns the process-wide configuration, reading the environment on first use.
+
+    Returns:
+        Config: The configuration.
+    """
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = Config.from_env()
+    return _config
+
+
+def configure(config=None, **settings):
+    """
+    Replaces the process-wide configuration.
+
+    Call it before the first store is opened, e.g. at the top of a CLI
+    entry point. Stores that are already open keep their settings.
+
+    Args:
+        config (Config): The configuration to use. Defaults to Config.from_env(**settings).
+        **settings: Settings for a new configuration, when config isn't given.
+
+    Returns:
+        Config: The configuration now in effect.
+    """
+    global _config
+    with _config_lock:
+        _config = config or Config.from_env(**settings)
+        return _config
+
+
+def setup_logging(config=None):
+    """
+    Sends log records of the whole package to the configured log file.
+
+    Importing the package doesn't configure logging, so applications keep their
+    own setup. Entry points call this once; later calls do nothing. With
+    log_queue on, records are written by a background thread.
+
+    Args:
+        config (Config): The configuration. Defaults to get_config().
+
+    Returns:
+        logging.handlers.QueueListener: The listener writing queued records, to be stopped
+            at shutdown, or None when records are written directly.
+    """
+    global _log_listener, _logging_ready
+    with _config_lock:
+        if _logging_ready:
+            return _log_listener
+        _logging_ready = True
+    config = config or get_config()
+    os.makedirs(config.log_dir, exist_ok=True)
+    handler = logging.FileHandler(os.path.join(config.log_dir, config.log_file), mode='a')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(config.log_level)
+    root.addHandler(handler)
+    if config.log_queue:
+        from src.metrics import start_queue_logging
+        _log_listener = start_queue_logging()
+    return _log_listener
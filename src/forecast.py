@@ -0,0 +1,348 @@
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from src.storage import get_storage
+from src.config import setup_logging
+from src.slots import SIZE_CLASSES, DEFAULT_SIZE_CLASS, size_class_for
+logger = logging.getLogger(__name__)
+
+HOURS_PER_WEEK = 168
+# 1970-01-01 was a Thursday, so epoch hour 0 is hour 72 of a Monday-first week.
+EPOCH_HOUR_OF_WEEK = 72
+# Stays longer than this share the last dwell bin, and are assumed to stay on.
+MAX_DWELL_HOURS = 48
+
+TICKETS_SINCE = '''
+    SELECT t.in_time, t.out_time, COALESCE(s.size_class, ?) FROM parking_tickets t
+    LEFT JOIN parking_slots s ON s.slot_number = t.slot WHERE t.in_time >= ? AND t.in_time < ?;
+'''
+OPEN_TICKETS = '''
+    SELECT t.in_time, COALESCE(s.size_class, ?) FROM parking_tickets t
+    LEFT JOIN parking_slots s ON s.slot_number = t.slot WHERE t.out_time IS NULL;
+'''
+
+
+def _seconds(timestamps):
+    # Parsed like Reports does, so naive local times are treated as UTC on both sides.
+    return np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+
+
+def _hour_of_week(hours):
+    return (hours + EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+
+
+class Forecaster:
+    """
+    Predicts free slots per size class from the ticket history, with NumPy.
+
+    Two models are kept per size class, where a ticket's class is that of
+    the slot it parked in:
+
+    - arrivals: the mean number of entries in each hour of the week, i.e. a
+      weekday-by-hour seasonal profile.
+    - dwell: a histogram of stay lengths in step_minutes bins, read as the
+      probability that a stay lasts longer than a given time.
+
+    Occupancy at a future time is the parked vehicles expected to still be
+    there plus the arrivals expected before then and still there, both
+    computed as array operations over the horizon. fit() builds the models
+    from the last history_days of tickets; the gates then add each entry
+    and exit with observe_entry() and observe_exit(), so the profiles follow
+    the lot without refitting.
+
+    Observing only updates the counts. The rates, survival curves and price
+    factors derived from them are rebuilt by refresh(), which runs in a
+    background thread at most every refresh_seconds once the counts have
+    changed, so gates pricing an exit never wait for a rebuild.
+
+    The models also give the expected share of each class occupied in every
+    hour of the week. price_factor() turns that into a rate multiplier, which
+    ParkingGateSystem.get_price applies when a forecaster is attached.
+
+    Attributes:
+        storage (Storage): The storage holding the tickets and slots.
+        history_days (int): How many days of tickets fit() reads.
+        step_minutes (int): Resolution of the dwell model and of predictions.
+        surge_threshold (float): Expected occupancy above which rates go up, e.g. 0.8.
+        max_surge (float): Largest rate increase, e.g. 0.5 for at most 50% more at a full lot.
+        refresh_seconds (float): Minimum time between rebuilds of the derived model.
+    """
+    def __init__(self, storage=None, history_days=28, step_minutes=15, surge_threshold=0.8, max_surge=0.5,
+                 refresh_seconds=60.0):
+        """
+        Initializes the Forecaster class with empty models. Call fit() to load the history.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+            history_days (int): How many days of tickets fit() reads.
+            step_minutes (int): Resolution of the dwell model and of predictions.
+            surge_threshold (float): Expected occupancy share above which rates go up.
+            max_surge (float): Largest rate increase, reached when a class is expected to be full.
+            refresh_seconds (float): Minimum time between rebuilds of the derived model.
+
+        Raises:
+            ValueError: If surge_threshold isn't below 1 or step_minutes doesn't divide an hour.
+        """
+        if not 0 <= surge_threshold < 1:
+            raise ValueError("surge_threshold must be in [0, 1)")
+        if step_minutes <= 0 or 60 % step_minutes:
+            raise ValueError("step_minutes must divide an hour")
+        self.storage = storage or get_storage()
+        self.history_days = history_days
+        self.step_minutes = step_minutes
+        self.surge_threshold = surge_threshold
+        self.max_surge = max_surge
+        self.refresh_seconds = refresh_seconds
+        self._class_index = {size_class: i for i, size_class in enumerate(SIZE_CLASSES)}
+        self._dwell_bins = MAX_DWELL_HOURS * 60 // step_minutes
+        self._lock = threading.Lock()
+        self._arrivals = np.zeros((len(SIZE_CLASSES), HOURS_PER_WEEK))
+        self._dwell = np.zeros((len(SIZE_CLASSES), self._dwell_bins + 1))
+        self._hours_seen = np.zeros(HOURS_PER_WEEK)
+        self._observed_until = None
+        self._capacity = np.zeros(len(SIZE_CLASSES))
+        self._model = None
+        # The counts change version on every observation; the model records the one it was built from.
+        self._version = 0
+        self._model_version = None
+        self._built_at = 0.0
+        self._refreshing = False
+
+    def _class_codes(self, size_classes):
+        default = self._class_index[DEFAULT_SIZE_CLASS]
+        return np.fromiter((self._class_index.get(c, default) for c in size_classes), np.int64, len(size_classes))
+
+    def _advance(self, hour):
+        # Must be called with self._lock held. Counts the hours of the week observed up to hour.
+        if self._observed_until is None:
+            self._observed_until = hour
+        if hour > self._observed_until:
+            hours = np.arange(self._observed_until, hour)
+            self._hours_seen += np.bincount(_hour_of_week(hours), minlength=HOURS_PER_WEEK)
+            self._observed_until = hour
+
+    def fit(self, now=None):
+        """
+        Rebuilds the models and slot counts from the last history_days of tickets.
+
+        Args:
+            now (datetime): End of the history, rounded down to the hour. Defaults to now.
+
+        Returns:
+            int: The number of tickets read.
+        """
+        # Only whole hours are read; the current one is added by observe_entry as it goes.
+        now = (now or datetime.now()).replace(minute=0, second=0, microsecond=0)
+        since = (now - timedelta(days=self.history_days)).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            with self.storage.connection() as conn:
+                rows = conn.execute(TICKETS_SINCE, (DEFAULT_SIZE_CLASS, since, now.strftime('%Y-%m-%d %H:%M:%S'))).fetchall()
+                slot_rows = conn.execute(
+                    "SELECT COALESCE(size_class, ?), COUNT(*) FROM parking_slots GROUP BY 1;", (DEFAULT_SIZE_CLASS,)).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading tickets for the forecast: {e}")
+            return 0
+        classes = len(SIZE_CLASSES)
+        capacity = np.zeros(classes)
+        for size_class, count in slot_rows:
+            capacity[self._class_index.get(size_class, self._class_index[DEFAULT_SIZE_CLASS])] += count
+        arrivals = np.zeros(classes * HOURS_PER_WEEK)
+        dwell = np.zeros(classes * (self._dwell_bins + 1))
+        if rows:
+            in_time, out_time, size_classes = zip(*rows)
+            codes = self._class_codes(size_classes)
+            in_seconds = _seconds(in_time)
+            arrivals = np.bincount(codes * HOURS_PER_WEEK + _hour_of_week(in_seconds // 3600),
+                                   minlength=classes * HOURS_PER_WEEK).astype(float)
+            out_seconds = _seconds(out_time)
+            closed = out_seconds != np.iinfo(np.int64).min
+            bins = np.minimum((out_seconds[closed] - in_seconds[closed]) // (self.step_minutes * 60), self._dwell_bins)
+            dwell = np.bincount(codes[closed] * (self._dwell_bins + 1) + np.maximum(bins, 0),
+                                minlength=classes * (self._dwell_bins + 1)).astype(float)
+        now_hour = int(_seconds([now])[0] // 3600)
+        with self._lock:
+            self._arrivals = arrivals.reshape(classes, HOURS_PER_WEEK)
+            self._dwell = dwell.reshape(classes, self._dwell_bins + 1)
+            self._hours_seen = np.zeros(HOURS_PER_WEEK)
+            self._observed_until = now_hour - self.history_days * 24
+            self._advance(now_hour)
+            self._capacity = capacity
+            self._version += 1
+        self.refresh()
+        logger.info(f"Fitted the forecast on {len(rows)} tickets")
+        return len(rows)
+
+    def observe_entry(self, in_time, size_class):
+        """
+        Adds an entry to the arrival profile.
+
+        Args:
+            in_time (datetime or str): Entry time, 'YYYY-MM-DD HH:MM:SS'.
+            size_class (str): Size class of the slot taken.
+        """
+        hour = int(_seconds([in_time])[0] // 3600)
+        with self._lock:
+            # Count the hour as observed before adding to it, so its own entry is averaged in.
+            self._advance(hour + 1)
+            self._arrivals[self._class_index.get(size_class, self._class_index[DEFAULT_SIZE_CLASS]), _hour_of_week(hour)] += 1
+            self._version += 1
+
+    def observe_exit(self, in_time, out_time, size_class):
+        """
+        Adds a finished stay to the dwell model.
+
+        Args:
+            in_time (datetime or str): Entry time, 'YYYY-MM-DD HH:MM:SS'.
+            out_time (datetime or str): Exit time.
+            size_class (str): Size class of the slot left.
+        """
+        in_seconds, out_seconds = _seconds([in_time, out_time])
+        dwell_bin = min(max(int(out_seconds - in_seconds) // (self.step_minutes * 60), 0), self._dwell_bins)
+        with self._lock:
+            self._dwell[self._class_index.get(size_class, self._class_index[DEFAULT_SIZE_CLASS]), dwell_bin] += 1
+            self._version += 1
+
+    def refresh(self):
+        """
+        Rebuilds the rates, survival curves and price factors from the current counts.
+
+        The counts are copied under the lock and the model is built outside
+        it, so observations aren't held up while it runs.
+        """
+        with self._lock:
+            version = self._version
+            arrivals = self._arrivals.copy()
+            dwell = self._dwell.copy()
+            hours_seen = self._hours_seen.copy()
+            capacity = self._capacity[:, None]
+        rates = arrivals / np.maximum(hours_seen, 1)
+        totals = dwell.sum(axis=1, keepdims=True)
+        # survival[c, k] is the probability that a stay lasts longer than k steps.
+        survival = np.ones((len(SIZE_CLASSES), self._dwell_bins + 1))
+        survival[:, 1:] = 1 - np.cumsum(dwell[:, :-1], axis=1) / np.maximum(totals, 1)
+        survival[totals[:, 0] == 0] = 1.0
+        steps_per_hour = 60 // self.step_minutes
+        # Expected vehicles present in each hour of the week, arriving in that hour or before,
+        # as a circular convolution of the arrival rates with the hourly survival.
+        hourly_survival = survival[:, ::steps_per_hour]
+        hours_ago = (np.arange(HOURS_PER_WEEK)[:, None] - np.arange(hourly_survival.shape[1])[None, :]) % HOURS_PER_WEEK
+        profile = (rates[:, hours_ago] * hourly_survival[:, None, :]).sum(axis=2)
+        share = np.divide(profile, capacity, out=np.zeros_like(profile), where=capacity > 0)
+        surge = np.clip((share - self.surge_threshold) / (1 - self.surge_threshold), 0, 1)
+        factors = 1 + self.max_surge * surge
+        with self._lock:
+            if self._model_version is None or version >= self._model_version:
+                self._model = (rates, survival, factors)
+                self._model_version = version
+                self._built_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _current_model(self):
+        # Returns (rates, survival, factors). Only builds inline if there's no model yet;
+        # a stale one is served while a background refresh replaces it.
+        with self._lock:
+            model = self._model
+            due = (model is not None and not self._refreshing and self._model_version != self._version
+                   and time.monotonic() - self._built_at >= self.refresh_seconds)
+            if due:
+                self._refreshing = True
+        if model is None:
+            self.refresh()
+            with self._lock:
+                return self._model
+        if due:
+            threading.Thread(target=self._refresh_in_background, name="forecast-refresh", daemon=True).start()
+        return model
+
+    def _survival_at(self, survival, steps):
+        # Survival of one class at fractional step offsets. Stays past the last bin are assumed to go on.
+        return np.interp(steps, np.arange(len(survival)), survival)
+
+    def predict(self, horizon_hours=3, now=None, open_tickets=None):
+        """
+        Predicts the free slots of each size class over the coming hours.
+
+        Args:
+            horizon_hours (float): How far ahead to predict.
+            now (datetime): Start of the forecast. Defaults to now.
+            open_tickets (list): (in_time, size_class) of the vehicles parked now.
+                Defaults to the open tickets in the store.
+
+        Returns:
+            tuple: (times, free). times is a datetime64 array of the predicted instants,
+                one per step_minutes from now, and free maps each size class to an array
+                of the expected free slots at those instants.
+        """
+        now = now or datetime.now()
+        if open_tickets is None:
+            try:
+                with self.storage.connection() as conn:
+                    open_tickets = conn.execute(OPEN_TICKETS, (DEFAULT_SIZE_CLASS,)).fetchall()
+            except sqlite3.Error as e:
+                logger.error(f"Error reading open tickets for the forecast: {e}")
+                open_tickets = []
+        rates, survival, _ = self._current_model()
+        step_seconds = self.step_minutes * 60
+        now_seconds = int(_seconds([now])[0])
+        steps = np.arange(int(horizon_hours * 60 // self.step_minutes) + 1)
+        times = np.datetime64(now_seconds, 's') + steps * np.timedelta64(step_seconds, 's')
+        # Arrivals expected in each step, and the chance an arrival in step i is still there at step j.
+        step_hours = _hour_of_week((now_seconds + steps * step_seconds) // 3600)
+        arriving = rates[:, step_hours] * (self.step_minutes / 60)
+        lag = steps[:, None] - steps[None, :] - 0.5
+        codes, ages = np.array([], dtype=np.int64), np.array([])
+        if open_tickets:
+            in_time, size_classes = zip(*open_tickets)
+            codes = self._class_codes(size_classes)
+            ages = np.maximum(now_seconds - _seconds(in_time), 0) / step_seconds
+        free = {}
+        for i, size_class in enumerate(SIZE_CLASSES):
+            class_ages = ages[codes == i]
+            staying = self._survival_at(survival[i], class_ages[:, None] + steps[None, :])
+            staying /= np.maximum(self._survival_at(survival[i], class_ages), 1e-12)[:, None]
+            still_there = np.where(lag > 0, self._survival_at(survival[i], np.maximum(lag, 0)), 0.0)
+            occupied = staying.sum(axis=0) + still_there @ arriving[i]
+            free[size_class] = np.maximum(self._capacity[i] - occupied, 0.0)
+        return times, free
+
+    def price_factor(self, vehicle_type, at):
+        """
+        Returns the rate multiplier for a vehicle type at a given time.
+
+        It grows from 1 once the vehicle's size class is expected to be more
+        than surge_threshold occupied in that hour of the week, up to
+        1 + max_surge for a class expected to be full.
+
+        Args:
+            vehicle_type (str): The type of vehicle.
+            at (datetime): The time, usually the entry time of the stay.
+
+        Returns:
+            float: The multiplier.
+        """
+        _, _, factors = self._current_model()
+        hour = at.weekday() * 24 + at.hour
+        return float(factors[self._class_index[size_class_for(vehicle_type)], hour])
+
+
+if __name__ == '__main__':
+    # Prints the expected free slots of each size class for the next hours.
+    import sys
+    setup_logging()
+    db_path = sys.argv[1] if len(sys.argv) > 1 else None
+    storage = get_storage(db_path)
+    forecaster = Forecaster(storage)
+    forecaster.fit()
+    times, free = forecaster.predict()
+    for size_class, counts in free.items():
+        print(size_class, " ".join(f"{str(t)[11:16]}={count:.0f}" for t, count in zip(times, counts)))
+    storage.close()
@@ -0,0 +1,141 @@
+import time
+import queue
+import sqlite3
+import logging
+import threading
+logger = logging.getLogger(__name__)
+
+
+class _PendingOperation:
+    def __init__(self, operation):
+        self.operation = operation
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """
+    Runs write operations from many threads in shared transactions.
+
+    A background thread collects the operations submitted within window
+    seconds of the first one, or until max_batch have arrived, and runs
+    them all in one BEGIN IMMEDIATE transaction. The store then syncs once
+    per batch instead of once per operation. Each operation runs inside its
+    own savepoint, so one that fails is rolled back alone and only its caller
+    sees the error. Callers are released only after the batch has committed.
+
+    Attributes:
+        storage (Storage): The storage the operations write to.
+        window (float): Seconds to wait for more operations after the first one.
+        max_batch (int): Maximum number of operations per transaction.
+    """
+    def __init__(self, storage, window=0.003, max_batch=64):
+        """
+        Initializes the GroupCommitter class and starts its commit thread.
+
+        Args:
+            storage (Storage): The storage the operations write to.
+            window (float): Seconds to wait for more operations after the first one.
+            max_batch (int): Maximum number of operations per transaction.
+        """
+        self.storage = storage
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, operation):
+        """
+        Runs an operation in the next group transaction and waits for the commit.
+
+        Args:
+            operation (callable): Takes a sqlite3.Connection inside an open
+                transaction and returns the caller's result. It must not commit
+                or roll back.
+
+        Returns:
+            object: Whatever the operation returned.
+
+        Raises:
+            Exception: Whatever the operation raised, or the sqlite3.Error that
+                stopped the batch from committing.
+            RuntimeError: If the committer has been closed.
+        """
+        pending = _PendingOperation(operation)
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError("The group committer is closed")
+            self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def close(self):
+        """
+        Commits whatever is queued and stops the commit thread.
+
+        Later submits raise RuntimeError.
+        """
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        # Nothing should follow the sentinel, but never leave a caller waiting.
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if pending is not None:
+                pending.error = RuntimeError("The group committer is closed")
+                pending.done.set()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with self.storage.transaction() as conn:
+                for pending in batch:
+                    conn.execute("SAVEPOINT gate_operation;")
+                    try:
+                        pending.result = pending.operation(conn)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO gate_operation;")
+                        pending.error = e
+                    conn.execute("RELEASE gate_operation;")
+            logger.info(f"Committed a group of {len(batch)} operations")
+        except sqlite3.Error as e:
+            logger.error(f"Error committing a group of {len(batch)} operations: {e}")
+            for pending in batch:
+                pending.result = None
+                pending.error = pending.error or e
+        finally:
+            for pending in batch:
+                pending.done.set()
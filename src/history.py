@@ -0,0 +1,97 @@
+import sqlite3
+import logging
+from datetime import datetime
+from src.storage import get_storage
+logger = logging.getLogger(__name__)
+
+
+def _as_timestamp(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+class TicketHistory:
+    """
+    Keyset-paginated access to a user's parking tickets.
+
+    Pages are ordered by (in_time, ticket_id) and the cursor is the key of the
+    last row returned, so every page is a range scan of the
+    (user_id, in_time) index however deep into the history it is.
+
+    Attributes:
+        storage (Storage): The shared storage holding the tickets.
+    """
+    def __init__(self, storage=None):
+        """
+        Initializes the TicketHistory class.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+        """
+        self.storage = storage or get_storage()
+
+    def page(self, user_id, after=None, limit=100, start=None, end=None, vehicle_type=None):
+        """
+        Returns one page of a user's tickets.
+
+        Args:
+            user_id (int): The ID of the user.
+            after (tuple): Cursor returned with the previous page, or None for the first page.
+            limit (int): Maximum number of tickets in the page.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+            vehicle_type (str): Only tickets for this vehicle type.
+
+        Returns:
+            tuple: (rows, cursor). cursor is None when there are no more pages.
+        """
+        conditions = ["user_id = ?"]
+        params = [user_id]
+        if after is not None:
+            conditions.append("(in_time, ticket_id) > (?, ?)")
+            params.extend(after)
+        if start is not None:
+            conditions.append("in_time >= ?")
+            params.append(_as_timestamp(start))
+        if end is not None:
+            conditions.append("in_time < ?")
+            params.append(_as_timestamp(end))
+        if vehicle_type is not None:
+            conditions.append("vehicle_type = ?")
+            params.append(vehicle_type)
+        query = ("SELECT ticket_id, user_id, in_time, out_time, vehicle_type, slot FROM parking_tickets "
+                 f"WHERE {' AND '.join(conditions)} ORDER BY in_time, ticket_id LIMIT ?;")
+        params.append(limit)
+        try:
+            with self.storage.connection() as conn:
+                rows = conn.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving ticket history: {e}")
+            return [], None
+        cursor = (rows[-1][2], rows[-1][0]) if len(rows) == limit else None
+        return rows, cursor
+
+    def stream(self, user_id, chunk_size=500, start=None, end=None, vehicle_type=None):
+        """
+        Yields a user's tickets in order, fetching chunk_size rows at a time.
+
+        Each chunk borrows a pooled connection only while it is fetched, so a
+        slow consumer doesn't hold a connection and memory stays constant.
+
+        Args:
+            user_id (int): The ID of the user.
+            chunk_size (int): Number of rows fetched per query.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+            vehicle_type (str): Only tickets for this vehicle type.
+
+        Yields:
+            tuple: One parking ticket row.
+        """
+        cursor = None
+        while True:
+            rows, cursor = self.page(user_id, cursor, chunk_size, start, end, vehicle_type)
+            yield from rows
+            if cursor is None:
+                return
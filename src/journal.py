@@ -0,0 +1,328 @@
+import os
+import json
+import zlib
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from src.config import get_config, setup_logging
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl, writers rely on O_APPEND alone to keep their batches apart.
+    fcntl = None
+logger = logging.getLogger(__name__)
+
+# Every record is its payload length and CRC32, then the payload: one compact JSON object.
+HEADER = struct.Struct("<II")
+
+# Event types written by the gates.
+ENTRY = "entry"
+EXIT = "exit"
+SLOT_BOOKED = "slot_booked"
+SLOT_RELEASED = "slot_released"
+PRICE = "price"
+
+
+def encode_record(record):
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+@contextmanager
+def _file_lock(f):
+    # Serializes writers of one journal file, across processes too.
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_records(path, offset=0):
+    """
+    Reads records from a journal file.
+
+    Reading stops at the end of the file or at the first record that is cut
+    short or fails its checksum, which is where a crash interrupted a write.
+
+    Args:
+        path (str): Path of the journal file.
+        offset (int): Byte offset to start reading at.
+
+    Yields:
+        tuple: (record, end_offset), where end_offset is the byte offset just after the record.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logger.warning(f"Journal {path} ends with a torn record at offset {offset}")
+                return
+            offset += HEADER.size + length
+            yield json.loads(payload), offset
+
+
+class JournalState:
+    """
+    Slot and ticket state rebuilt from the journal.
+
+    Attributes:
+        seq (int): Sequence number of the last record applied. Every writer numbers
+            its own records, so replay goes by offset, not by seq.
+        offset (int): Byte offset in the journal just after the last record applied.
+        slots (dict): Maps slot numbers to True when occupied, False when free.
+        tickets (dict): Maps ticket IDs to dicts with user_id, slot, vehicle_type,
+            in_time, out_time and price.
+    """
+    def __init__(self, seq=0, offset=0, slots=None, tickets=None):
+        self.seq = seq
+        self.offset = offset
+        self.slots = slots or {}
+        self.tickets = tickets or {}
+
+    def apply(self, record):
+        """
+        Applies one journal record.
+
+        Args:
+            record (dict): The decoded record.
+        """
+        event_type = record["type"]
+        if event_type == SLOT_BOOKED:
+            self.slots[record["slot"]] = True
+        elif event_type == SLOT_RELEASED:
+            self.slots[record["slot"]] = False
+        elif event_type == ENTRY:
+            self.tickets[record["ticket_id"]] = {
+                "user_id": record["user_id"], "slot": record["slot"], "vehicle_type": record["vehicle_type"],
+                "in_time": record["in_time"], "out_time": None, "price": None}
+        elif event_type == EXIT:
+            ticket = self.tickets.setdefault(record["ticket_id"], {
+                "user_id": None, "slot": record["slot"], "vehicle_type": None,
+                "in_time": None, "out_time": None, "price": None})
+            ticket["out_time"] = record["out_time"]
+        elif event_type == PRICE:
+            if record["ticket_id"] in self.tickets:
+                self.tickets[record["ticket_id"]]["price"] = record["price"]
+        self.seq = record["seq"]
+
+    def save(self, path):
+        """
+        Writes the state to a snapshot file, replacing the previous one atomically.
+
+        Args:
+            path (str): Path of the snapshot file.
+        """
+        snapshot = {"seq": self.seq, "offset": self.offset,
+                    "slots": [[slot, occupied] for slot, occupied in self.slots.items()],
+                    "tickets": [[ticket_id, ticket] for ticket_id, ticket in self.tickets.items()]}
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        logger.info(f"Saved journal snapshot at seq {self.seq} to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a snapshot file.
+
+        Args:
+            path (str): Path of the snapshot file.
+
+        Returns:
+            JournalState: The saved state, or an empty state if there is no snapshot.
+        """
+        if path is None or not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            snapshot = json.load(f)
+        return cls(snapshot["seq"], snapshot["offset"],
+                   {slot: occupied for slot, occupied in snapshot["slots"]},
+                   {ticket_id: ticket for ticket_id, ticket in snapshot["tickets"]})
+
+    def apply_to(self, storage):
+        """
+        Writes the rebuilt slot statuses and tickets into a store in one transaction.
+
+        Args:
+            storage (Storage): The store to restore.
+        """
+        with storage.transaction() as conn:
+            conn.executemany("UPDATE parking_slots SET status = ? WHERE slot_number = ?;",
+                             [("occupied" if occupied else "free", slot) for slot, occupied in self.slots.items()])
+            conn.executemany(
+                "INSERT OR REPLACE INTO parking_tickets (ticket_id, user_id, in_time, out_time, vehicle_type, slot, price) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                [(ticket_id, t["user_id"], t["in_time"], t["out_time"], t["vehicle_type"], t["slot"], t.get("price"))
+                 for ticket_id, t in self.tickets.items() if t["in_time"] is not None])
+        logger.info(f"Restored {len(self.slots)} slots and {len(self.tickets)} tickets from the journal")
+
+
+def replay(path, snapshot_path=None):
+    """
+    Rebuilds slot and ticket state from a snapshot plus the journal written after it.
+
+    Args:
+        path (str): Path of the journal file.
+        snapshot_path (str): Path of the snapshot file, or None to replay the whole journal.
+
+    Returns:
+        JournalState: The rebuilt state.
+    """
+    state = JournalState.load(snapshot_path)
+    for record, offset in read_records(path, state.offset):
+        state.apply(record)
+        state.offset = offset
+    return state
+
+
+def ticket_events(path, ticket_id):
+    """
+    Returns every journal record about one ticket, e.g. to audit a disputed charge.
+
+    Args:
+        path (str): Path of the journal file.
+        ticket_id (int): The ID of the ticket.
+
+    Returns:
+        list: The records, oldest first.
+    """
+    return [record for record, _ in read_records(path) if record.get("ticket_id") == ticket_id]
+
+
+class EventJournal:
+    """
+    An append-only journal of gate events, written behind the gate operations.
+
+    append() only queues the record. A background thread writes everything
+    queued in one go and fsyncs once per batch, so gates don't wait for the
+    disk. flush() waits until everything appended so far is durable.
+
+    Several journals, in one process or many, can append to the same file.
+    Each batch is written under an exclusive lock on the file, so batches
+    never interleave. Sequence numbers are only unique per journal.
+
+    Attributes:
+        path (str): Path of the journal file.
+        flush_interval (float): Seconds the writer gathers records before writing a batch.
+        seq (int): Sequence number of the last record appended.
+    """
+    def __init__(self, path=None, flush_interval=0.05):
+        """
+        Initializes the EventJournal class and starts its writer thread.
+
+        A record torn by an earlier crash is cut off so new records follow
+        the last complete one.
+
+        Args:
+            path (str): Path of the journal file. Defaults to the configured journal.
+            flush_interval (float): Seconds the writer gathers records before writing a batch.
+        """
+        path = path or get_config().journal_path
+        self.path = path
+        self.flush_interval = flush_interval
+        self.seq = 0
+        end = 0
+        self._file = open(path, 'ab')
+        with _file_lock(self._file):
+            for record, end in read_records(path):
+                self.seq = record["seq"]
+            if os.fstat(self._file.fileno()).st_size != end:
+                self._file.truncate(end)
+        self._buffer = []
+        self._durable_seq = self.seq
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="event-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, event_type, **fields):
+        """
+        Queues an event.
+
+        Args:
+            event_type (str): One of ENTRY, EXIT, SLOT_BOOKED, SLOT_RELEASED or PRICE.
+            **fields: The event's data. Values must be JSON serializable.
+
+        Returns:
+            int: The event's sequence number.
+        """
+        with self._cond:
+            self.seq += 1
+            self._buffer.append(encode_record({"seq": self.seq, "type": event_type, **fields}))
+            if len(self._buffer) == 1:
+                self._cond.notify_all()
+            return self.seq
+
+    def flush(self, timeout=None):
+        """
+        Waits until every event appended so far has been written and fsynced.
+
+        Args:
+            timeout (float): Maximum seconds to wait, or None to wait as long as needed.
+
+        Returns:
+            bool: True if everything is durable.
+        """
+        with self._cond:
+            target = self.seq
+            return self._cond.wait_for(lambda: self._durable_seq >= target, timeout)
+
+    def close(self):
+        """
+        Writes whatever is queued and stops the writer thread.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._buffer or self._closing)
+                if not self._closing:
+                    self._cond.wait(self.flush_interval)
+                batch, self._buffer = self._buffer, []
+                seq = self.seq
+                closing = self._closing
+            if batch:
+                try:
+                    with _file_lock(self._file):
+                        self._file.write(b"".join(batch))
+                        self._file.flush()
+                    os.fsync(self._file.fileno())
+                except OSError as e:
+                    logger.error(f"Error writing {len(batch)} journal records: {e}")
+                else:
+                    with self._cond:
+                        self._durable_seq = seq
+                        self._cond.notify_all()
+            if closing:
+                return
+
+
+if __name__ == '__main__':
+    # Rebuilds state from the latest snapshot plus the journal tail and saves
+    # a new snapshot, so the next restart only reads what is written after it.
+    import sys
+    setup_logging()
+    path = sys.argv[1] if len(sys.argv) > 1 else get_config().journal_path
+    snapshot_path = sys.argv[2] if len(sys.argv) > 2 else get_config().journal_snapshot_path
+    state = replay(path, snapshot_path)
+    state.save(snapshot_path)
+    occupied = sum(1 for is_occupied in state.slots.values() if is_occupied)
+    print(f"Replayed {path} to seq {state.seq}: {len(state.tickets)} tickets, {occupied} occupied slots")
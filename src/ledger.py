@@ -0,0 +1,197 @@
+import sqlite3
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from src.storage import get_storage
+from src.config import setup_logging
+logger = logging.getLogger(__name__)
+
+# Kinds of ledger entries. Credits are positive amounts, debits negative.
+OPENING = "opening"
+TOP_UP = "top_up"
+PARKING = "parking"
+ADJUSTMENT = "adjustment"
+
+BALANCE_UPDATE = "UPDATE user_data SET amount = amount + ? WHERE user_id = ? RETURNING amount;"
+LEDGER_INSERT = "INSERT INTO balance_ledger (user_id, amount, kind, ticket_id, created_at) VALUES (?, ?, ?, ?, ?);"
+# Compares the cached balances of a range of users with the sum of their ledger entries.
+RECONCILE_QUERY = '''
+    SELECT u.user_id, u.amount, COALESCE(l.total, 0) FROM user_data u
+    LEFT JOIN (
+        SELECT user_id, SUM(amount) AS total FROM balance_ledger WHERE user_id BETWEEN ? AND ? GROUP BY user_id
+    ) l ON l.user_id = u.user_id
+    WHERE u.user_id BETWEEN ? AND ? AND ABS(COALESCE(u.amount, 0) - COALESCE(l.total, 0)) > ?;
+'''
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def post(conn, user_id, amount, kind, ticket_id=None, created_at=None):
+    """
+    Changes a user's balance and appends the change to the ledger.
+
+    user_data.amount is the running balance, so balance reads never sum
+    the ledger. Call it in the transaction that causes the change, e.g. the
+    one closing a ticket, so the cached balance and the ledger can't
+    disagree.
+
+    Args:
+        conn (sqlite3.Connection): A connection inside an open write transaction.
+        user_id (int): The ID of the user.
+        amount (float): The change, negative for a debit.
+        kind (str): OPENING, TOP_UP, PARKING or ADJUSTMENT.
+        ticket_id (int): The ticket a parking debit is for, or None.
+        created_at (str): Time of the change, 'YYYY-MM-DD HH:MM:SS'. Defaults to now.
+
+    Returns:
+        float: The new balance, or None if the user doesn't exist and nothing was written.
+    """
+    row = conn.execute(BALANCE_UPDATE, (amount, user_id)).fetchone()
+    if row is None:
+        return None
+    conn.execute(LEDGER_INSERT, (user_id, amount, kind, ticket_id, created_at or _now()))
+    return row[0]
+
+
+def post_many(conn, changes, kind, created_at=None):
+    """
+    Applies many balance changes with one executemany per table.
+
+    Args:
+        conn (sqlite3.Connection): A connection inside an open write transaction.
+        changes (list): (user_id, amount) pairs.
+        kind (str): The kind of every entry.
+        created_at (str): Time of the changes. Defaults to now.
+
+    Returns:
+        int: The number of balances changed. Unknown users are skipped and get no entry.
+    """
+    created_at = created_at or _now()
+    updated = conn.executemany("UPDATE user_data SET amount = amount + ? WHERE user_id = ?;",
+                               [(amount, user_id) for user_id, amount in changes]).rowcount
+    conn.executemany('''
+        INSERT INTO balance_ledger (user_id, amount, kind, created_at)
+        SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM user_data WHERE user_id = ?);
+    ''', [(user_id, amount, kind, created_at, user_id) for user_id, amount in changes])
+    return updated
+
+
+def record_openings(conn, balances, created_at=None):
+    """
+    Records the opening balances of users just inserted into user_data.
+
+    Args:
+        conn (sqlite3.Connection): A connection inside the transaction that inserted them.
+        balances (list): (user_id, amount) pairs. Zero balances get no entry.
+    """
+    created_at = created_at or _now()
+    conn.executemany(LEDGER_INSERT, [(user_id, amount, OPENING, None, created_at)
+                                     for user_id, amount in balances if amount])
+
+
+class Ledger:
+    """
+    Reads the balance ledger and checks it against the cached balances.
+
+    Attributes:
+        storage (Storage): The storage holding user_data and balance_ledger.
+        chunk_size (int): Number of user IDs checked per reconciliation query.
+        workers (int): Number of chunks checked at the same time.
+    """
+    def __init__(self, storage=None, chunk_size=10000, workers=4):
+        """
+        Initializes the Ledger class.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+            chunk_size (int): Number of user IDs checked per reconciliation query.
+            workers (int): Number of chunks checked at the same time.
+        """
+        self.storage = storage or get_storage()
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def entries(self, user_id, limit=100):
+        """
+        Returns a user's latest ledger entries.
+
+        Args:
+            user_id (int): The ID of the user.
+            limit (int): Maximum number of entries.
+
+        Returns:
+            list: (entry_id, amount, kind, ticket_id, created_at) tuples, newest first.
+        """
+        try:
+            with self.storage.connection() as conn:
+                return conn.execute('''
+                    SELECT entry_id, amount, kind, ticket_id, created_at FROM balance_ledger
+                    WHERE user_id = ? ORDER BY entry_id DESC LIMIT ?;
+                ''', (int(user_id), limit)).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading ledger of user {user_id}: {e}")
+            return []
+
+    def _check_chunk(self, first_id, last_id, tolerance):
+        with self.storage.connection() as conn:
+            return conn.execute(RECONCILE_QUERY, (first_id, last_id, first_id, last_id, tolerance)).fetchall()
+
+    def reconcile(self, repair=False, tolerance=1e-6):
+        """
+        Checks every cached balance against the sum of the user's ledger entries.
+
+        Users are split into ranges of chunk_size IDs. The ranges are checked
+        on up to workers pooled connections at once, each with one grouped
+        query over the ledger's (user_id) index.
+
+        Args:
+            repair (bool): Whether to reset mismatched cached balances to their ledger
+                balance. Balances cached in memory by a UserRepository are not dropped.
+            tolerance (float): Largest difference treated as equal.
+
+        Returns:
+            list: (user_id, cached_balance, ledger_balance) for every mismatch.
+        """
+        try:
+            with self.storage.connection() as conn:
+                low, high = conn.execute("SELECT MIN(user_id), MAX(user_id) FROM user_data;").fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading user ids for reconciliation: {e}")
+            return []
+        if low is None:
+            return []
+        ranges = [(first_id, min(first_id + self.chunk_size - 1, high))
+                  for first_id in range(low, high + 1, self.chunk_size)]
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                chunks = list(executor.map(lambda r: self._check_chunk(r[0], r[1], tolerance), ranges))
+        except sqlite3.Error as e:
+            logger.error(f"Error reconciling balances: {e}")
+            return []
+        mismatches = [row for chunk in chunks for row in chunk]
+        if mismatches and repair:
+            try:
+                with self.storage.transaction() as conn:
+                    conn.executemany("UPDATE user_data SET amount = ? WHERE user_id = ?;",
+                                     [(ledger, user_id) for user_id, _, ledger in mismatches])
+            except sqlite3.Error as e:
+                logger.error(f"Error repairing balances: {e}")
+        level = logging.WARNING if mismatches else logging.INFO
+        logger.log(level, f"Reconciled {len(ranges)} chunks of users, {len(mismatches)} mismatched balances")
+        return mismatches
+
+
+if __name__ == '__main__':
+    # Checks the cached balances of a store against its ledger.
+    import sys
+    setup_logging()
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    db_path = paths[0] if paths else None
+    storage = get_storage(db_path)
+    mismatches = Ledger(storage).reconcile(repair="--repair" in sys.argv)
+    for user_id, cached, ledger in mismatches:
+        print(f"User {user_id}: cached {cached}, ledger {ledger}")
+    print(f"{len(mismatches)} mismatched balances")
+    storage.close()
@@ -0,0 +1,455 @@
+import time
+import queue
+import bisect
+import sqlite3
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+logger = logging.getLogger(__name__)
+
+# Latency histogram bucket bounds in seconds, from 50 microseconds to 5 seconds.
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# A lock wait longer than this counts as contended.
+CONTENDED_WAIT = 0.001
+# SQL statements are labelled by their first characters with whitespace collapsed.
+STATEMENT_LABEL_LENGTH = 80
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def labels(self, **labels):
+        """
+        Binds label values once, for use on a hot path.
+
+        Args:
+            **labels: A value for every label name.
+
+        Returns:
+            functools.partial: Takes the value to record, like inc or observe without labels.
+        """
+        return functools.partial(self._record, self._key(labels))
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up, e.g. retries or cache hits.
+    """
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._record(self._key(labels), amount)
+
+    def _record(self, key, amount=1):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, self._labels(key), value) for key, value in values]
+
+    def snapshot(self):
+        return [{"labels": labels, "value": value} for _, labels, value in self.samples()]
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, set directly or read from a function at scrape time.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        """
+        Args:
+            name (str): Metric name.
+            help_text (str): One line describing the metric.
+            labelnames (tuple): Label names.
+            function (callable): Returns a dict mapping label value tuples to values. Read at
+                scrape time instead of the values set with set().
+        """
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._record(self._key(labels), value)
+
+    def _record(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function().items()
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [(self.name, self._labels(tuple(str(v) for v in key)), value) for key, value in values]
+
+    def snapshot(self):
+        return [{"labels": labels, "value": value} for _, labels, value in self.samples()]
+
+
+class Histogram(_Metric):
+    """
+    Counts observations, e.g. latencies in seconds, in fixed buckets.
+
+    Recording is a bisect and three additions under a lock, cheap enough for
+    the gate path. Percentiles are estimated as the upper bound of the bucket
+    they fall in.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self._record(self._key(labels), value)
+
+    def _record(self, key, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager that observes how long its block took.
+        """
+        key = self._key(labels)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(key, time.perf_counter() - start)
+
+    def _states(self):
+        with self._lock:
+            return [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+
+    def percentile(self, q, **labels):
+        """
+        Estimates a percentile.
+
+        Args:
+            q (float): The percentile, 0 to 100.
+            **labels: A value for every label name.
+
+        Returns:
+            float: The bucket bound the percentile falls under, inf past the last bucket,
+                or None if nothing was observed.
+        """
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None:
+                return None
+            counts, _, count = list(state[0]), state[1], state[2]
+        return self._percentile(counts, count, q)
+
+    def _percentile(self, counts, count, q):
+        target = q / 100 * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        samples = []
+        for key, counts, total, count in self._states():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", {**labels, "le": "+Inf" if bound == float("inf") else repr(bound)}, cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+    def snapshot(self):
+        return [{"labels": self._labels(key), "count": count, "sum": total,
+                 "p50": self._percentile(counts, count, 50), "p95": self._percentile(counts, count, 95),
+                 "p99": self._percentile(counts, count, 99)}
+                for key, counts, total, count in self._states()]
+
+
+class MetricsRegistry:
+    """
+    The metrics of one process, by name.
+
+    Metrics are created on first request and returned on later ones, so
+    every module can ask for the metric it records into at import time.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.type_name}")
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=(), function=None):
+        return self._get(Gauge, name, help_text, labelnames, function)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, labelnames, buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page.
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Returns every metric as plain data, e.g. for a benchmark report.
+
+        Returns:
+            dict: Maps each metric name to its samples. Histograms give count, sum and
+                estimated p50, p95 and p99 per label set.
+        """
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+
+REGISTRY = MetricsRegistry()
+
+OPERATION_SECONDS = REGISTRY.histogram(
+    "parking_operation_seconds", "Latency of slot, gate, user and admin operations.", ("operation",))
+QUERY_SECONDS = REGISTRY.histogram(
+    "parking_query_seconds", "Latency of SQL statements on profiled connections, up to the first row.", ("statement",))
+LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    "parking_lock_wait_seconds", "Time spent waiting for a pooled connection or the database write lock.", ("lock",))
+LOCK_WAITS = REGISTRY.counter(
+    "parking_lock_waits_total", "Waits for a pooled connection or the write lock longer than a millisecond.", ("lock",))
+RETRIES = REGISTRY.counter(
+    "parking_retries_total", "Operations retried, by reason.", ("operation", "reason"))
+CACHE_REQUESTS = REGISTRY.counter(
+    "parking_cache_requests_total", "Cache lookups by cache and result, hit or miss.", ("cache", "result"))
+
+
+def timed(operation):
+    """
+    Decorator that records a function's latency under an operation name.
+
+    Args:
+        operation (str): The operation label, e.g. "ParkingGateSystem.create_new_ticket".
+
+    Returns:
+        callable: The decorator.
+    """
+    record = OPERATION_SECONDS.labels(operation=operation)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def record_lock_wait(lock, seconds):
+    """
+    Records time spent waiting for a lock, counting it as contended past CONTENDED_WAIT.
+
+    Args:
+        lock (str): The lock, "pool" or "write".
+        seconds (float): How long the wait took.
+    """
+    LOCK_WAIT_SECONDS.observe(seconds, lock=lock)
+    if seconds > CONTENDED_WAIT:
+        LOCK_WAITS.inc(lock=lock)
+
+
+def cache_hit_ratio(cache):
+    """
+    Returns the share of lookups a cache answered.
+
+    Args:
+        cache (str): The cache label, e.g. "balances".
+
+    Returns:
+        float: Hits over lookups, or None before the first lookup.
+    """
+    hits = CACHE_REQUESTS.value(cache=cache, result="hit")
+    lookups = hits + CACHE_REQUESTS.value(cache=cache, result="miss")
+    return hits / lookups if lookups else None
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql):
+    return " ".join(sql.split())[:STATEMENT_LABEL_LENGTH]
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    A cursor that records the latency of every statement it runs in QUERY_SECONDS.
+    """
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, statement=statement_label(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, statement=statement_label(sql))
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    A connection whose statements all run on ProfiledCursors.
+
+    Pass it as the factory to sqlite3.connect. Storage does this when
+    created with profile_queries=True.
+    """
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def start_queue_logging():
+    """
+    Moves the root logger's handlers onto a background thread.
+
+    Log handlers, like the one setup_logging adds, write to files synchronously.
+    After this call, logging only puts the record on a queue and a listener
+    thread does the writing, so log lines don't hold up the gates. Call
+    stop() on the returned listener at shutdown to write what is queued.
+
+    Returns:
+        logging.handlers.QueueListener: The started listener, or None if logging already goes through a queue.
+    """
+    import logging.handlers
+    root = logging.getLogger()
+    handlers = [handler for handler in root.handlers if not isinstance(handler, logging.handlers.QueueHandler)]
+    if not handlers:
+        return None
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    logger.info(f"Logging through a queue to {len(handlers)} handlers")
+    return listener
+
+
+class MetricsServer:
+    """
+    Serves a registry in the Prometheus text format at /metrics on a background thread.
+
+    Attributes:
+        registry (MetricsRegistry): The metrics served.
+        host (str): Interface listened on.
+        port (int): Port listened on. Pass 0 to pick a free port.
+    """
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=9108):
+        """
+        Initializes the MetricsServer class and starts serving.
+
+        Args:
+            registry (MetricsRegistry): The metrics to serve.
+            host (str): Interface to listen on. Keep it local unless the port is firewalled.
+            port (int): Port to listen on, or 0 for any free port.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = registry.render().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def close(self):
+        """
+        Stops serving.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,188 @@
+import logging
+import threading
+logger = logging.getLogger(__name__)
+
+
+class Occupancy:
+    """
+    Live free/occupied counts for a lot, kept up to date as slots change.
+
+    Counts are held for the whole lot and for every value of each slot
+    attribute (for example level, zone or vehicle class), so reading them is
+    a dictionary lookup rather than a table scan. A bitmap with one bit per
+    slot number, set when the slot is occupied, gives a compact snapshot of
+    the whole lot.
+
+    Subscribers are called after every change with (slot_number, occupied,
+    version). Callbacks run on the thread that made the change, after the
+    lock is released, so they should be quick and must not block.
+
+    Attributes:
+        version (int): Incremented on every change. Equal versions mean equal state.
+    """
+    def __init__(self):
+        """
+        Initializes the Occupancy class with no slots.
+        """
+        self._lock = threading.Lock()
+        self._occupied = {}
+        self._groups = {}
+        self._counts = {None: [0, 0]}
+        self._bitmap = bytearray()
+        self._subscribers = []
+        self.version = 0
+
+    def load(self, slots):
+        """
+        Replaces the state with the given slots.
+
+        Args:
+            slots (iterable): (slot_number, occupied, attributes) tuples, where
+                attributes is a dict such as {"level": 1, "zone": "A"}.
+        """
+        occupied = {}
+        groups = {}
+        counts = {None: [0, 0]}
+        bitmap = bytearray()
+        for slot_number, is_occupied, attributes in slots:
+            slot_number = int(slot_number)
+            is_occupied = bool(is_occupied)
+            keys = tuple((name, value) for name, value in sorted((attributes or {}).items()))
+            occupied[slot_number] = is_occupied
+            groups[slot_number] = keys
+            for key in (None,) + keys:
+                counts.setdefault(key, [0, 0])[is_occupied] += 1
+            if is_occupied:
+                self._set_bit(bitmap, slot_number, True)
+        with self._lock:
+            self._occupied = occupied
+            self._groups = groups
+            self._counts = counts
+            self._bitmap = bitmap
+            self.version += 1
+            version = self.version
+        logger.info(f"Loaded occupancy for {len(occupied)} slots")
+        self._notify(None, None, version)
+
+    def set_occupied(self, slot_number, occupied):
+        """
+        Records that a slot became occupied or free.
+
+        Args:
+            slot_number (int): The slot that changed.
+            occupied (bool): Whether it is now occupied.
+
+        Returns:
+            bool: True if the state changed, False if it already was that way or
+                the slot isn't known. Slots added to the table show up on the next load.
+        """
+        slot_number = int(slot_number)
+        occupied = bool(occupied)
+        with self._lock:
+            previous = self._occupied.get(slot_number)
+            if previous is None or previous == occupied:
+                return False
+            for key in (None,) + self._groups[slot_number]:
+                counts = self._counts[key]
+                counts[previous] -= 1
+                counts[occupied] += 1
+            self._occupied[slot_number] = occupied
+            self._set_bit(self._bitmap, slot_number, occupied)
+            self.version += 1
+            version = self.version
+        self._notify(slot_number, occupied, version)
+        return True
+
+    def counts(self, attribute=None, value=None):
+        """
+        Returns the free and occupied counts of the lot or of one group of slots.
+
+        Args:
+            attribute (str): Slot attribute to filter on, e.g. "level". None for the whole lot.
+            value: The attribute's value, e.g. 2.
+
+        Returns:
+            tuple: (free, occupied).
+        """
+        key = None if attribute is None else (attribute, value)
+        with self._lock:
+            free, occupied = self._counts.get(key, (0, 0))
+        return free, occupied
+
+    def free_count(self, attribute=None, value=None):
+        """
+        Returns the number of free slots in the lot or in one group of slots.
+
+        Args:
+            attribute (str): Slot attribute to filter on. None for the whole lot.
+            value: The attribute's value.
+
+        Returns:
+            int: The number of free slots.
+        """
+        return self.counts(attribute, value)[0]
+
+    def breakdown(self, attribute):
+        """
+        Returns the counts for every value of one slot attribute.
+
+        Args:
+            attribute (str): The slot attribute, e.g. "zone".
+
+        Returns:
+            dict: Maps each value to its (free, occupied) counts.
+        """
+        with self._lock:
+            return {key[1]: tuple(counts) for key, counts in self._counts.items()
+                    if key is not None and key[0] == attribute}
+
+    def snapshot(self):
+        """
+        Returns a consistent copy of the lot's state.
+
+        Returns:
+            dict: "version", "free" and "occupied" counts, and "bitmap", bytes in
+                which bit n (byte n // 8, bit n % 8) is set when slot n is occupied.
+        """
+        with self._lock:
+            free, occupied = self._counts[None]
+            return {"version": self.version, "free": free, "occupied": occupied, "bitmap": bytes(self._bitmap)}
+
+    def subscribe(self, callback):
+        """
+        Registers a callback for occupancy changes.
+
+        Args:
+            callback (callable): Called with (slot_number, occupied, version). After a
+                full reload slot_number and occupied are None.
+
+        Returns:
+            callable: Call it to unsubscribe.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def _notify(self, slot_number, occupied, version):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(slot_number, occupied, version)
+            except Exception as e:
+                logger.error(f"Error in occupancy subscriber: {e}")
+
+    @staticmethod
+    def _set_bit(bitmap, slot_number, occupied):
+        index, bit = divmod(slot_number, 8)
+        if index >= len(bitmap):
+            bitmap.extend(bytes(index + 1 - len(bitmap)))
+        if occupied:
+            bitmap[index] |= 1 << bit
+        else:
+            bitmap[index] &= ~(1 << bit) & 0xFF
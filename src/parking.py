@@ -1,13 +1,25 @@
-from src.slots import Slots 
 from src.parking_gate_system import ParkingGateSystem
-from src.user import User
+from src.user import UserRepository
+from src.storage import get_storage
 class ParkingLot:
-    def __init__(self):
-        self.slot_manager = Slots()
-        self.gate_system = ParkingGateSystem()
+    def __init__(self, storage=None, group_commit_window=None, slot_fallback=None, users=None, journal_path=None,
+                 forecaster=None, min_balance=None):
+        self.storage = storage or get_storage()
+        self.users = users or UserRepository(self.storage)
+        self.gate_system = ParkingGateSystem(self.storage, group_commit_window=group_commit_window, slot_fallback=slot_fallback,
+                                             journal_path=journal_path, forecaster=forecaster, users=self.users)
+        self.slot_manager = self.gate_system.slots_manager
+        self.occupancy = self.slot_manager.occupancy
+        # Entry policy: users whose prepaid balance is below this are turned away. None lets everyone in.
+        self.min_balance = min_balance
+        self.reservations = self.gate_system.reservations
 
-    def park_vehicle(self, user_id, vehicle_type):
-        ticket_id = self.gate_system.create_new_ticket(user_id, vehicle_type)
+    def park_vehicle(self, user_id, vehicle_type, level=None, zone=None):
+        if self.min_balance is not None:
+            balance = self.users.get_balance(user_id)
+            if balance is None or balance < self.min_balance:
+                return "Insufficient balance"
+        ticket_id = self.gate_system.create_new_ticket(user_id, vehicle_type, level, zone)
         return ticket_id
 
     def leave_parking(self, ticket_id):
@@ -17,10 +29,27 @@ class ParkingLot:
     def get_available_slots(self):
         return self.slot_manager.return_all_available_slots()
 
+    def count_available_slots(self):
+        return self.occupancy.free_count()
+
+    def occupancy_snapshot(self):
+        return self.occupancy.snapshot()
+
+    def reserve(self, user_id, vehicle_type, start, end, level=None, zone=None):
+        return self.reservations.reserve(user_id, vehicle_type, start, end, level, zone)
+
+    def cancel_reservation(self, reservation_id):
+        return self.reservations.cancel(reservation_id)
+
+    def free_slots_between(self, start, end, vehicle_type=None, level=None, zone=None):
+        return self.reservations.free_slots(start, end, vehicle_type, level, zone)
+
+    def forecast_free_slots(self, horizon_hours=3):
+        if self.gate_system.forecaster is None:
+            raise ValueError("The lot has no forecaster")
+        return self.gate_system.forecaster.predict(horizon_hours)
+
     def add_user_balance(self, user_id, amount):
-        user = User(user_id)
-        user.add_balance(amount)
+        return self.users.add_balance(user_id, amount)
     def check_user_balance(self, user_id):
-        user = User(user_id)
-        return user.get_balance()
-
+        return self.users.get_balance(user_id)
\ No newline at end of file
@@ -1,97 +1,241 @@
 import sqlite3
 import logging
+import time
 from datetime import datetime
-from paths import *
-from src.slots import Slots
-logging.basicConfig(level=logging.INFO, filename='logs\\parking_system.log', filemode='a', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from src.slots import Slots, DEFAULT_SIZE_CLASS
+from src.storage import get_storage
+from src.tariff import get_tariff_cache
+from src.reservations import get_reservations
+from src.group_commit import GroupCommitter
+from src.journal import EventJournal, ENTRY, EXIT, SLOT_BOOKED, SLOT_RELEASED, PRICE
+from src.rollups import record_exit
+from src.ledger import post, PARKING
+from src.metrics import timed, RETRIES
 logger = logging.getLogger(__name__)
 class ParkingGateSystem:
     """
     A class representing the parking gate system.
 
     Attributes:
-        conn (sqlite3.Connection): Connection to the parking tickets database.
-        cursor (sqlite3.Cursor): Cursor for executing SQL queries on the parking tickets database.
+        storage (Storage): The shared storage holding tickets, slots and prices.
         slots_manager (Slots): An instance of the Slots class.
-        users_db (sqlite3.Connection): Connection to the users database.
-        cursor_users (sqlite3.Cursor): Cursor for executing SQL queries on the users database.
-        parking_prices_db (sqlite3.Connection): Connection to the parking prices database.
-        cursor_parking_prices (sqlite3.Cursor): Cursor for executing SQL queries on the parking prices database.
+        tariffs (TariffCache): In-memory copy of the parking prices.
+        reservations (Reservations): Bays reserved for future time windows.
+        max_claim_retries (int): How many times a gate retries claiming a slot before giving up.
+        retry_backoff (float): Base delay in seconds between claim retries, doubled on every attempt.
+        committer (GroupCommitter): Shares transactions between concurrent gate operations, or
+            None to commit every operation on its own.
+        journal (EventJournal): Append-only record of gate events, or None.
+        forecaster (Forecaster): Demand forecast that scales rates and learns from every entry
+            and exit, or None for plain tariffs.
+        users (UserRepository): Where exits are charged when balances live in another store,
+            and whose cached balances are dropped on every charge. None charges the gate's store.
     """
-    def __init__(self, parking_tickets=parking_tickets_path, users_db=users_db_path, parking_prices=parking_prices_path):
+    def __init__(self, storage=None, max_claim_retries=5, retry_backoff=0.01, group_commit_window=None, group_commit_max=64,
+                 slot_fallback=None, journal_path=None, forecaster=None, users=None):
         """
         Initializes the ParkingGateSystem class.
+
+        Group commit trades a few milliseconds of latency per operation for
+        one commit per batch instead of one per operation. Leave it off where
+        every gate operation should be committed on its own.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+            max_claim_retries (int): How many times to retry claiming a slot.
+            retry_backoff (float): Base delay in seconds between claim retries.
+            group_commit_window (float): Seconds to gather concurrent operations into
+                one transaction, e.g. 0.003. None disables group commit.
+            group_commit_max (int): Maximum number of operations per group transaction.
+            slot_fallback (dict): Maps a slot size class to the larger classes a vehicle may
+                use when its own is full. Defaults to every larger class; {} disables fallback.
+            journal_path (str): File to journal entries, exits, slot changes and prices to,
+                written behind the operations. None disables the journal.
+            forecaster (Forecaster): A fitted forecast whose price factor is applied to every
+                price. None for plain tariffs.
+            users (UserRepository): The user service of the lot. When its storage is the gate's,
+                exits are charged in the transaction closing the ticket; otherwise they are
+                charged in the user store right after it commits.
         """
+        self.max_claim_retries = max_claim_retries
+        self.retry_backoff = retry_backoff
+        self.committer = None
+        self.journal = None
+        self.forecaster = forecaster
+        self.users = users
         try:
-            self.conn = sqlite3.connect(parking_tickets)
-            self.cursor = self.conn.cursor()
-            self.slots_manager = Slots()
-            self.users_db = sqlite3.connect(users_db)
-            self.cursor_users = self.users_db.cursor()
-            self.parking_prices_db = sqlite3.connect(parking_prices)
-            self.cursor_parking_prices = self.parking_prices_db.cursor()
-            logger.info("ParkingGateSystem connected to all databases")
+            self.storage = storage or get_storage()
+            self.slots_manager = Slots(self.storage, slot_fallback)
+            self.tariffs = get_tariff_cache(self.storage)
+            self.reservations = get_reservations(self.storage)
+            if group_commit_window is not None:
+                self.committer = GroupCommitter(self.storage, group_commit_window, group_commit_max)
+            if journal_path is not None:
+                self.journal = EventJournal(journal_path)
+            logger.info("ParkingGateSystem using the shared storage")
         except sqlite3.Error as e:
             logger.error(f"Error connecting to database: {e}")
 
-    def __del__(self):
+    def close(self):
         """
-        Closes all database connections when the object is deleted.
+        Commits any queued group operations and journal events and stops their threads.
         """
-        try:
-            self.conn.close()
-            logger.info("ParkingGateSystem database connection closed")
-        except sqlite3.Error as e:
-            logger.error(f"Error closing database connection: {e}")
+        if self.committer is not None:
+            self.committer.close()
+            self.committer = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
 
-    def get_price(self, net_time, type_of_vehicle):
+    def run_write(self, operation):
+        """
+        Runs a write operation in a transaction, shared with other gate
+        operations when group commit is on.
+
+        Args:
+            operation (callable): Takes a connection inside an open transaction and
+                returns a result. It must not commit or roll back.
+
+        Returns:
+            object: Whatever the operation returned, once it has been committed.
+        """
+        if self.committer is not None:
+            return self.committer.submit(operation)
+        with self.storage.transaction() as conn:
+            return operation(conn)
+
+    @timed("ParkingGateSystem.get_price")
+    def get_price(self, net_time, type_of_vehicle, in_time=None):
         """
         Calculates the price for parking based on vehicle type and duration.
 
+        The vehicle type's compiled tariff applies its grace period, rounding,
+        time-of-day bands and daily cap. With a forecaster attached, the price
+        is then scaled by the forecast demand at the entry time.
+
         Args:
             net_time (datetime.timedelta): The duration of parking.
             type_of_vehicle (str): The type of vehicle.
+            in_time (datetime.datetime): Entry time, needed for time-of-day bands.
+                Defaults to now minus net_time.
 
         Returns:
             float: The calculated price for parking.
         """
+        schedule = self.tariffs.get_schedule(type_of_vehicle)
+        if schedule is None:
+            logger.error(f"Error calculating price: no tariff for vehicle type {type_of_vehicle}")
+            return 0.0
+        if in_time is None:
+            in_time = datetime.now() - net_time
+        price = schedule.price(net_time, in_time)
+        if self.forecaster is not None:
+            price *= self.forecaster.price_factor(type_of_vehicle, in_time)
+        logger.info(f"Calculated price {price} for vehicle type {type_of_vehicle} and net time {net_time}")
+        return price
+
+    def price_many(self, durations, vehicle_types, in_times=None):
+        """
+        Prices many stays at once, e.g. to re-price historic tickets.
+
+        Each vehicle type's schedule is looked up once and reused for every
+        stay of that type.
+
+        Args:
+            durations (list): datetime.timedelta durations.
+            vehicle_types (list): The vehicle type of each stay.
+            in_times (list): Entry time of each stay, or None. A stay without an entry time is
+                priced as if it entered at midnight, so time-of-day bands and daily caps still
+                apply, and no forecast price factor is applied to it.
+
+        Returns:
+            list: The price of each stay, 0.0 where the vehicle type has no tariff.
+        """
+        if in_times is None:
+            in_times = [None] * len(durations)
+        schedules = {vehicle_type: self.tariffs.get_schedule(vehicle_type) for vehicle_type in set(vehicle_types)}
+        prices = []
+        for net_time, vehicle_type, in_time in zip(durations, vehicle_types, in_times):
+            schedule = schedules[vehicle_type]
+            price = schedule.price(net_time, in_time) if schedule is not None else 0.0
+            if self.forecaster is not None and in_time is not None:
+                price *= self.forecaster.price_factor(vehicle_type, in_time)
+            prices.append(price)
+        logger.info(f"Priced {len(prices)} stays")
+        return prices
+
+    def _close_ticket(self, conn, ticket_id, out_time):
+        cursor = conn.cursor()
+        update_query = "UPDATE parking_tickets SET out_time = ? WHERE ticket_id = ? AND out_time IS NULL RETURNING in_time, slot, vehicle_type, user_id;"
+        cursor.execute(update_query, (out_time, ticket_id))
+        result = cursor.fetchone()
+        if result is None:
+            return None
+        in_time_text, slot, vehicle_type, user_id = result
+        cursor.execute('''
+            UPDATE parking_slots
+            SET status="free"
+            WHERE slot_number=? AND status="occupied"
+        ''', (slot,))
+        in_time = datetime.strptime(in_time_text, '%Y-%m-%d %H:%M:%S')
+        net_time = datetime.strptime(out_time, '%Y-%m-%d %H:%M:%S') - in_time
+        price = self.get_price(net_time, vehicle_type, in_time)
+        cursor.execute("UPDATE parking_tickets SET price = ? WHERE ticket_id = ?;", (price, ticket_id))
+        record_exit(conn, out_time, vehicle_type, price, net_time.total_seconds() / 60)
+        if price and self._charges_in_transaction():
+            if post(conn, user_id, -price, PARKING, ticket_id, out_time) is None:
+                logger.warning(f"User {user_id} of ticket {ticket_id} has no balance, exit not charged")
+        return slot, price, in_time_text, user_id
+
+    def _charges_in_transaction(self):
+        return self.users is None or self.users.storage is self.storage
+
+    def _charge_user_store(self, user_id, price, ticket_id, out_time):
+        # Balances live in another store, so the charge can't share the ticket's transaction.
         try:
-            get_query = f"SELECT amount FROM parking_prices WHERE vehicle_type = ?"
-            self.cursor_parking_prices.execute(get_query, (type_of_vehicle,))
-            result = self.cursor_parking_prices.fetchone()[0]
-            net_time_seconds = net_time.total_seconds()
-            price = result * net_time_seconds / 3600  # Assuming price is per hour
-            logger.info(f"Calculated price {price} for vehicle type {type_of_vehicle} and net time {net_time}")
-            return price
+            with self.users.storage.transaction() as conn:
+                balance = post(conn, user_id, -price, PARKING, ticket_id, out_time)
         except sqlite3.Error as e:
-            logger.error(f"Error calculating price: {e}")
-            return 0.0
+            logger.error(f"Error charging user {user_id} for ticket {ticket_id}: {e}")
+            return
+        if balance is None:
+            logger.warning(f"User {user_id} of ticket {ticket_id} has no balance, exit not charged")
 
+    @timed("ParkingGateSystem.add_out_time")
     def add_out_time(self, ticket_id):
         """
         Adds the out time for a parking ticket and calculates the price.
 
+        Closing the ticket, freeing its slot, storing the price, adding it to
+        the daily rollups and debiting the user's prepaid balance happen in one
+        transaction. The UPDATE returns the ticket's details so no separate
+        SELECT is needed. Balances may go negative, since a vehicle is never
+        held at the exit; ParkingLot's entry policy turns such users away.
+
         Args:
             ticket_id (int): The ID of the parking ticket.
 
         Returns:
-            float: The calculated price for parking.
+            float: The calculated price for parking, 0.0 if the ticket is unknown or already closed.
         """
         try:
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            update_query = "UPDATE parking_tickets SET out_time = ? WHERE ticket_id = ? AND out_time IS NULL;"
-            self.cursor.execute(update_query, (current_time, ticket_id))
-            self.conn.commit()
-
-            self.cursor.execute("SELECT in_time, slot, vehicle_type FROM parking_tickets WHERE ticket_id = ?;", (ticket_id,))
-            result = self.cursor.fetchone()
-            in_time = datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S')
-            out_time = datetime.strptime(current_time, '%Y-%m-%d %H:%M:%S')
-
-            self.slots_manager.release_slot(result[1])
-
-            net_time = out_time - in_time
-            price = self.get_price(net_time, result[2])
+            result = self.run_write(lambda conn: self._close_ticket(conn, ticket_id, current_time))
+            if result is None:
+                logger.warning(f"Ticket {ticket_id} doesn't exist or is already closed")
+                return 0.0
+            slot, price, in_time, user_id = result
+            self.slots_manager.mark_free(slot)
+            if price and not self._charges_in_transaction():
+                self._charge_user_store(user_id, price, ticket_id, current_time)
+            if self.users is not None:
+                self.users.invalidate(user_id)
+            if self.forecaster is not None:
+                self.forecaster.observe_exit(in_time, current_time, self._size_class(slot))
+            if self.journal is not None:
+                self.journal.append(EXIT, ticket_id=ticket_id, slot=slot, out_time=current_time)
+                self.journal.append(SLOT_RELEASED, slot=slot)
+                self.journal.append(PRICE, ticket_id=ticket_id, price=price)
             logger.info(f"Added out time for ticket {ticket_id}. Calculated price is {price}")
             return price
         except sqlite3.Error as e:
@@ -113,36 +257,145 @@ class ParkingGateSystem:
             logger.error(f"Error retrieving available slots: {e}")
             return []
 
-    def create_new_ticket(self, user_id, vehicle_type):
+    def count_free_slots(self):
+        """
+        Returns the number of free slots from the live occupancy counts.
+
+        Returns:
+            int: The number of free slots.
+        """
+        return self.slots_manager.occupancy.free_count()
+
+    def _size_class(self, slot_number):
+        return self.slots_manager.slot_groups.get(slot_number, (DEFAULT_SIZE_CLASS,))[0]
+
+    def _claim_slot(self, conn, user_id, vehicle_type, slot_number, in_time, reservation_id=None):
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE parking_slots
+            SET status="occupied"
+            WHERE slot_number=? AND status="free"
+        ''', (slot_number,))
+        if cursor.rowcount == 0:
+            return None
+        insert_query = "INSERT INTO parking_tickets (user_id, in_time, out_time, vehicle_type, slot) VALUES (?, ?, NULL, ?, ?);"
+        cursor.execute(insert_query, (user_id, in_time, vehicle_type, slot_number))
+        if reservation_id is not None:
+            self.reservations.mark_used(conn, reservation_id, cursor.lastrowid)
+        return cursor.lastrowid
+
+    @timed("ParkingGateSystem.claim_slot_and_issue_ticket")
+    def claim_slot_and_issue_ticket(self, user_id, vehicle_type, slot_number, reservation_id=None):
+        """
+        Claims a slot and inserts its ticket in one transaction.
+
+        The transaction takes the write lock up front, so two gates can never
+        both see the slot as free. Either both rows are written or neither is.
+
+        Args:
+            user_id (int): The ID of the user.
+            vehicle_type (str): The type of vehicle.
+            slot_number (int): The slot to claim.
+            reservation_id (int): The reservation the slot was claimed for, marked used
+                in the same transaction. None for a walk-in.
+
+        Returns:
+            int: The ID of the new ticket, or None if the slot was already taken.
+
+        Raises:
+            sqlite3.OperationalError: If the write lock could not be acquired.
+        """
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ticket_id = self.run_write(
+            lambda conn: self._claim_slot(conn, user_id, vehicle_type, slot_number, current_time, reservation_id))
+        if ticket_id is not None and reservation_id is not None:
+            self.reservations.used(reservation_id, ticket_id)
+        if ticket_id is not None and self.forecaster is not None:
+            self.forecaster.observe_entry(current_time, self._size_class(slot_number))
+        if ticket_id is not None and self.journal is not None:
+            self.journal.append(SLOT_BOOKED, slot=slot_number)
+            self.journal.append(ENTRY, ticket_id=ticket_id, user_id=user_id, slot=slot_number,
+                                vehicle_type=vehicle_type, in_time=current_time)
+        return ticket_id
+
+    def _enter_reserved(self, user_id, vehicle_type, reservation):
+        # Returns the ticket for the reserved bay, or None if the bay can't be had and the user parks as a walk-in.
+        if not self.slots_manager.take_slot(reservation.slot):
+            logger.warning(f"Reserved slot {reservation.slot} of reservation {reservation.reservation_id} is not free")
+            return None
+        try:
+            ticket_id = self.claim_slot_and_issue_ticket(user_id, vehicle_type, reservation.slot, reservation.reservation_id)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Claiming reserved slot {reservation.slot} failed: {e}")
+            self.slots_manager.mark_free(reservation.slot)
+            return None
+        if ticket_id is not None:
+            logger.info(f"Created new ticket {ticket_id} for user {user_id} in reserved slot {reservation.slot}")
+        return ticket_id
+
+    @timed("ParkingGateSystem.create_new_ticket")
+    def create_new_ticket(self, user_id, vehicle_type, level=None, zone=None):
         """
         Creates a new parking ticket for a user.
 
+        A user arriving for a reservation gets the reserved bay. Anyone else
+        gets the nearest free slot of their size class, or of a larger class
+        allowed by the fallback policy, skipping bays held for upcoming
+        reservations. If another gate claims the chosen slot first, the
+        allocator is refreshed and the next free slot is tried, up to
+        max_claim_retries times. If the allocator has no free slot it is
+        refreshed once too, so slots freed by other gate processes are seen.
+
         Args:
             user_id (int): The ID of the user.
             vehicle_type (str): The type of vehicle.
+            level (int): Only park on this level. None for any level.
+            zone (str): Only park in this zone. None for any zone.
 
         Returns:
-            int: The ID of the newly created parking ticket.
+            int: The ID of the newly created parking ticket, or the string
+                "No empty slots available" if no slot is free or none could be
+                claimed within max_claim_retries attempts. None on a database error.
         """
         try:
-            free_slots = self.slots_manager.return_all_available_slots()
-            if free_slots:
-                user_id = int(user_id)
-                free_slot = int(free_slots[0][0])
-                current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                insert_query = "INSERT INTO parking_tickets (user_id, in_time, out_time, vehicle_type, slot) VALUES (?, ?, NULL, ?, ?);"
-                self.cursor.execute(insert_query, (user_id, current_time, vehicle_type, free_slot))
-                self.conn.commit()
-
-                self.cursor.execute("SELECT last_insert_rowid();")
-                new_ticket_id = self.cursor.fetchone()[0]
-
-                self.slots_manager.book_slot(free_slot)
+            user_id = int(user_id)
+            now = datetime.now()
+            reservation = self.reservations.active_for(user_id, now)
+            if reservation is not None:
+                new_ticket_id = self._enter_reserved(user_id, vehicle_type, reservation)
+                if new_ticket_id is not None:
+                    return new_ticket_id
+            held = lambda slot_number: self.reservations.is_held(slot_number, user_id, now)
+            reloaded = False
+            for attempt in range(self.max_claim_retries):
+                free_slot = self.slots_manager.take_free_slot(vehicle_type, level, zone, skip=held)
+                if free_slot is None and not reloaded:
+                    # Another gate process may have freed slots this allocator hasn't seen.
+                    self.slots_manager.load_free_slots()
+                    reloaded = True
+                    free_slot = self.slots_manager.take_free_slot(vehicle_type, level, zone, skip=held)
+                if free_slot is None:
+                    logger.warning("No empty slots available")
+                    return "No empty slots available"
+                try:
+                    new_ticket_id = self.claim_slot_and_issue_ticket(user_id, vehicle_type, free_slot)
+                except sqlite3.OperationalError as e:
+                    logger.warning(f"Attempt {attempt + 1} to claim slot {free_slot} failed: {e}")
+                    RETRIES.inc(operation="create_new_ticket", reason="locked")
+                    self.slots_manager.mark_free(free_slot)
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+                    continue
+                if new_ticket_id is None:
+                    logger.warning(f"Slot {free_slot} was taken by another gate, refreshing free slots")
+                    RETRIES.inc(operation="create_new_ticket", reason="slot_taken")
+                    self.slots_manager.load_free_slots()
+                    self.slots_manager.mark_occupied(free_slot)
+                    reloaded = True
+                    continue
                 logger.info(f"Created new ticket {new_ticket_id} for user {user_id} with vehicle type {vehicle_type} and slot {free_slot}")
                 return new_ticket_id
-            else:
-                logger.warning("No empty slots available")
-                return "No empty slots available"
+            logger.error(f"Could not claim a slot for user {user_id} after {self.max_claim_retries} attempts")
+            return "No empty slots available"
         except sqlite3.Error as e:
             logger.error(f"Error creating new ticket: {e}")
             return None
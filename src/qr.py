@@ -0,0 +1,263 @@
+import io
+import os
+import hashlib
+import logging
+import functools
+import threading
+from concurrent.futures import Future
+from src.config import get_config
+from src.metrics import REGISTRY
+logger = logging.getLogger(__name__)
+
+# Rendering settings. They are part of the cache key, so changing them
+# produces new files instead of reusing old renders.
+QR_VERSION = 1
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+
+
+def _make_qr(payload):
+    # qrcode pulls in PIL, so it is imported when the first code is rendered.
+    import qrcode
+    qr = qrcode.QRCode(
+        version=QR_VERSION,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=QR_BOX_SIZE,
+        border=QR_BORDER,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return qr
+
+
+def render_qr_png(payload):
+    """
+    Renders a QR code as PNG bytes.
+
+    Args:
+        payload (str): The data encoded in the QR code.
+
+    Returns:
+        bytes: The PNG image.
+    """
+    img = _make_qr(payload).make_image(fill='black', back_color='white')
+    buffer = io.BytesIO()
+    img.save(buffer)
+    return buffer.getvalue()
+
+
+def render_qr_svg(payload):
+    """
+    Renders a QR code as SVG bytes. This needs no imaging library.
+
+    Args:
+        payload (str): The data encoded in the QR code.
+
+    Returns:
+        bytes: The SVG document.
+    """
+    import qrcode.image.svg
+    img = _make_qr(payload).make_image(image_factory=qrcode.image.svg.SvgPathImage)
+    return img.to_string()
+
+
+@functools.lru_cache(maxsize=4096)
+def render_qr(payload, image_format="png"):
+    """
+    Renders a QR code on demand, reusing earlier renders of the same payload.
+
+    Args:
+        payload (str): The data encoded in the QR code.
+        image_format (str): "png" or "svg".
+
+    Returns:
+        bytes: The rendered image.
+
+    Raises:
+        ValueError: If the format isn't supported.
+    """
+    if image_format == "png":
+        return render_qr_png(payload)
+    if image_format == "svg":
+        return render_qr_svg(payload)
+    raise ValueError(f"Unsupported QR code format {image_format}")
+
+
+def _render_cache_lookups():
+    info = render_qr.cache_info()
+    return {("hit",): info.hits, ("miss",): info.misses}
+
+
+REGISTRY.gauge("parking_qr_render_cache_lookups", "Lookups in the in-memory QR render cache by result.",
+               ("result",), function=_render_cache_lookups)
+
+
+def render_qr_file(payload, path):
+    """
+    Writes a QR code PNG to path unless the file is already there.
+
+    The file is written under a temporary name and renamed into place, so
+    readers never see a half-written image.
+
+    Args:
+        payload (str): The data encoded in the QR code.
+        path (str): Where to write the image.
+
+    Returns:
+        str: The path of the image.
+    """
+    if os.path.exists(path):
+        return path
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(render_qr_png(payload))
+    os.replace(temp_path, path)
+    return path
+
+
+def render_qr_files(items):
+    """
+    Writes several QR code PNGs, skipping those already on disk.
+
+    Args:
+        items (list): (payload, path) pairs.
+
+    Returns:
+        list: The paths of the images.
+    """
+    return [render_qr_file(payload, path) for payload, path in items]
+
+
+class QRCodeRenderer:
+    """
+    Renders QR code files in a process pool, away from the code that needs them.
+
+    File names are derived from a hash of the payload and the render settings,
+    so the path is known before rendering starts and a payload that has been
+    rendered before is never rendered again.
+
+    Attributes:
+        output_dir (str): Directory the PNG files are written to.
+        workers (int): Size of the process pool. None uses one process per CPU.
+    """
+    def __init__(self, output_dir=None, workers=None):
+        """
+        Initializes the QRCodeRenderer class. The process pool starts on first use.
+
+        Args:
+            output_dir (str): Directory the PNG files are written to. Defaults to the configured QR codes directory.
+            workers (int): Size of the process pool. None uses one process per CPU.
+        """
+        self.output_dir = output_dir or get_config().qr_codes_dir
+        self.workers = workers
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _start_executor(self):
+        # Importing the process pool machinery is slow, so it waits for the first render.
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def path_for(self, payload):
+        """
+        Returns the file a payload's QR code is written to.
+
+        Args:
+            payload (str): The data encoded in the QR code.
+
+        Returns:
+            str: The content-addressed path of the PNG file.
+        """
+        key = f"{payload}|{QR_VERSION}|L|{QR_BOX_SIZE}|{QR_BORDER}"
+        digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return os.path.join(self.output_dir, f"qr_{digest}.png")
+
+    def submit(self, payload):
+        """
+        Queues a QR code to be rendered to its file.
+
+        Args:
+            payload (str): The data encoded in the QR code.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the file path once it exists.
+        """
+        path = self.path_for(payload)
+        with self._lock:
+            pending = self._pending.get(path)
+            if pending is not None:
+                return pending
+            if os.path.exists(path):
+                done = Future()
+                done.set_result(path)
+                return done
+            if self._executor is None:
+                os.makedirs(self.output_dir, exist_ok=True)
+                self._executor = self._start_executor()
+            future = self._executor.submit(render_qr_file, payload, path)
+            self._pending[path] = future
+        future.add_done_callback(lambda f: self._finished(path, f))
+        return future
+
+    def submit_many(self, payloads, chunk_size=256):
+        """
+        Queues many QR codes, sending them to the pool in chunks.
+
+        One task per chunk keeps the cost of handing work to the processes
+        low when thousands of users are added at once.
+
+        Args:
+            payloads (list): The data encoded in each QR code.
+            chunk_size (int): Number of QR codes rendered per task.
+
+        Returns:
+            list: One concurrent.futures.Future per chunk, each resolving to its paths.
+        """
+        futures = []
+        with self._lock:
+            items = []
+            for payload in payloads:
+                path = self.path_for(payload)
+                if path not in self._pending and not os.path.exists(path):
+                    items.append((payload, path))
+            if not items:
+                return futures
+            if self._executor is None:
+                os.makedirs(self.output_dir, exist_ok=True)
+                self._executor = self._start_executor()
+            for i in range(0, len(items), chunk_size):
+                chunk = items[i:i + chunk_size]
+                future = self._executor.submit(render_qr_files, chunk)
+                paths = [path for _, path in chunk]
+                for path in paths:
+                    self._pending[path] = future
+                futures.append((future, paths))
+        for future, paths in futures:
+            future.add_done_callback(lambda f, paths=paths: self._finished_many(paths, f))
+        return [future for future, _ in futures]
+
+    def _finished_many(self, paths, future):
+        with self._lock:
+            for path in paths:
+                self._pending.pop(path, None)
+        if future.exception() is not None:
+            logger.error(f"Error rendering {len(paths)} QR codes: {future.exception()}")
+
+    def _finished(self, path, future):
+        with self._lock:
+            self._pending.pop(path, None)
+        if future.exception() is not None:
+            logger.error(f"Error rendering QR code {path}: {future.exception()}")
+
+    def close(self, wait=True):
+        """
+        Stops the process pool.
+
+        Args:
+            wait (bool): Whether to finish the queued renders first.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
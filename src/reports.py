@@ -0,0 +1,348 @@
+import os
+import math
+import sqlite3
+import hashlib
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+from src.storage import get_storage
+from src.config import get_config
+from src.tariff import get_tariff_cache, MINUTES_PER_DAY
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_HOUR = 3600
+# Dwell time histogram bin edges in minutes.
+DEFAULT_DWELL_BINS = (0, 15, 30, 60, 120, 240, 480, 1440, math.inf)
+# Marks a cache_dir left at its default, since None turns the cache off.
+_CONFIGURED = object()
+
+
+def _epoch(value):
+    # Timestamps are stored as naive local time strings. Like NumPy's
+    # datetime64 parsing, this treats them as UTC so both sides agree.
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    return int((value - datetime(1970, 1, 1)).total_seconds())
+
+
+class TicketColumns:
+    """
+    One chunk of parking_tickets held as column arrays.
+
+    Attributes:
+        ticket_id (numpy.ndarray): int64 ticket IDs.
+        in_time (numpy.ndarray): int64 entry times in seconds since the epoch.
+        out_time (numpy.ndarray): int64 exit times in seconds since the epoch, -1 while parked.
+        vehicle (numpy.ndarray): int16 codes into vehicle_types.
+        vehicle_types (list): Vehicle type names, indexed by the codes in vehicle.
+        price (numpy.ndarray): float64 price stored at exit, NaN where none was stored.
+    """
+    def __init__(self, ticket_id, in_time, out_time, vehicle, vehicle_types, price):
+        self.ticket_id = ticket_id
+        self.in_time = in_time
+        self.out_time = out_time
+        self.vehicle = vehicle
+        self.vehicle_types = vehicle_types
+        self.price = price
+
+    def __len__(self):
+        return len(self.ticket_id)
+
+    def select(self, mask):
+        return TicketColumns(self.ticket_id[mask], self.in_time[mask], self.out_time[mask],
+                             self.vehicle[mask], self.vehicle_types, self.price[mask])
+
+    def save(self, path):
+        temp_path = f"{path}.tmp.npz"
+        np.savez(temp_path, ticket_id=self.ticket_id, in_time=self.in_time, out_time=self.out_time,
+                 vehicle=self.vehicle, vehicle_types=np.array(self.vehicle_types, dtype=str), price=self.price)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            price = data["price"] if "price" in data.files else np.full(len(data["ticket_id"]), np.nan)
+            return cls(data["ticket_id"], data["in_time"], data["out_time"], data["vehicle"],
+                       data["vehicle_types"].tolist(), price)
+
+
+class Reports:
+    """
+    Revenue and occupancy reports computed over parking_tickets with NumPy.
+
+    Tickets are read in fixed ranges of ticket_id, chunk_size at a time, and
+    turned into column arrays, with NumPy parsing the timestamps. Every
+    report is accumulated chunk by chunk with vectorized operations, so
+    memory stays bounded however many tickets there are.
+
+    A range whose tickets have all left, and which has newer tickets after
+    it, can no longer change. Such ranges are cached on disk as .npz files,
+    so later reports load them without touching SQLite.
+
+    Revenue uses the price stored on each ticket at exit. Tickets closed
+    before prices were stored are priced with the current tariffs.
+
+    Attributes:
+        storage (Storage): The storage holding the tickets.
+        chunk_size (int): Number of ticket IDs per chunk.
+        cache_dir (str): Directory for cached chunks, or None to disable the cache.
+    """
+    def __init__(self, storage=None, chunk_size=250000, cache_dir=_CONFIGURED):
+        """
+        Initializes the Reports class.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+            chunk_size (int): Number of ticket IDs per chunk.
+            cache_dir (str): Directory for cached chunks, or None to disable the cache.
+                Defaults to the configured report cache directory.
+        """
+        if cache_dir is _CONFIGURED:
+            cache_dir = get_config().report_cache_dir
+        self.storage = storage or get_storage()
+        self.chunk_size = chunk_size
+        self.cache_dir = None
+        if cache_dir is not None:
+            store_key = hashlib.sha1(os.path.abspath(self.storage.db_path).encode()).hexdigest()[:12]
+            self.cache_dir = os.path.join(cache_dir, store_key)
+        self.tariffs = get_tariff_cache(self.storage)
+
+    def _read_chunk(self, conn, first_id, last_id):
+        rows = conn.execute(
+            "SELECT ticket_id, in_time, out_time, vehicle_type, price FROM parking_tickets WHERE ticket_id BETWEEN ? AND ? ORDER BY ticket_id;",
+            (first_id, last_id)).fetchall()
+        if not rows:
+            empty = np.array([], dtype=np.int64)
+            return TicketColumns(empty, empty, empty, np.array([], dtype=np.int16), [], np.array([]))
+        ticket_id, in_time, out_time, vehicle_type, price = zip(*rows)
+        codes = {}
+        vehicle = np.fromiter((codes.setdefault(v or "Unknown", len(codes)) for v in vehicle_type), np.int16, len(rows))
+        return TicketColumns(np.array(ticket_id, dtype=np.int64), self._seconds(in_time), self._seconds(out_time),
+                             vehicle, list(codes), np.array(price, dtype=float))
+
+    @staticmethod
+    def _seconds(timestamps):
+        # NumPy parses the stored timestamp strings; missing ones become NaT and then -1.
+        seconds = np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+        seconds[seconds == np.iinfo(np.int64).min] = -1
+        return seconds
+
+    def iter_chunks(self, start=None, end=None):
+        """
+        Yields the tickets as column chunks.
+
+        Args:
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+
+        Yields:
+            TicketColumns: One chunk, possibly empty after filtering.
+        """
+        start, end = _epoch(start), _epoch(end)
+        try:
+            with self.storage.connection() as conn:
+                max_id = conn.execute("SELECT MAX(ticket_id) FROM parking_tickets;").fetchone()[0] or 0
+        except sqlite3.Error as e:
+            logger.error(f"Error reading tickets for a report: {e}")
+            return
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        for first_id in range(1, max_id + 1, self.chunk_size):
+            last_id = first_id + self.chunk_size - 1
+            chunk = self._chunk(first_id, last_id, max_id)
+            if chunk is None:
+                continue
+            if start is not None or end is not None:
+                mask = np.ones(len(chunk), dtype=bool)
+                if start is not None:
+                    mask &= chunk.in_time >= start
+                if end is not None:
+                    mask &= chunk.in_time < end
+                chunk = chunk.select(mask)
+            yield chunk
+
+    def _chunk(self, first_id, last_id, max_id):
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, f"tickets_{first_id}_{last_id}.npz")
+            if os.path.exists(path):
+                return TicketColumns.load(path)
+        try:
+            with self.storage.connection() as conn:
+                chunk = self._read_chunk(conn, first_id, last_id)
+        except sqlite3.Error as e:
+            logger.error(f"Error reading tickets {first_id} to {last_id}: {e}")
+            return None
+        if path is not None and last_id < max_id and len(chunk) and not (chunk.out_time < 0).any():
+            chunk.save(path)
+            logger.info(f"Cached tickets {first_id} to {last_id}")
+        return chunk
+
+    def _time_range(self, start, end):
+        if start is None or end is None:
+            with self.storage.connection() as conn:
+                first, last = conn.execute(
+                    "SELECT MIN(in_time), MAX(COALESCE(out_time, in_time)) FROM parking_tickets;").fetchone()
+            start = start if start is not None else first
+            end = end if end is not None else last
+        if start is None or end is None:
+            return None, None
+        start = _epoch(start) // SECONDS_PER_HOUR * SECONDS_PER_HOUR
+        end = -(-(_epoch(end) + 1) // SECONDS_PER_HOUR) * SECONDS_PER_HOUR
+        return start, end
+
+    def hourly_occupancy(self, start=None, end=None):
+        """
+        Returns the average number of parked vehicles in every hour of a period.
+
+        Each ticket contributes the seconds it overlaps each hour, so a car
+        parked 10:30 to 12:15 counts 0.5 in hour 10, 1 in hour 11 and 0.25
+        in hour 12. Vehicles still parked count until now.
+
+        Args:
+            start (datetime or str): Start of the period. Defaults to the first entry.
+            end (datetime or str): End of the period. Defaults to the last entry or exit.
+
+        Returns:
+            tuple: (hours, occupancy) arrays. hours holds datetime64 hour starts and
+                occupancy the average number of vehicles present in each hour.
+        """
+        start, end = self._time_range(start, end)
+        if start is None:
+            return np.array([], dtype='datetime64[h]'), np.array([])
+        buckets = (end - start) // SECONDS_PER_HOUR
+        seconds = np.zeros(buckets + 1)
+        full = np.zeros(buckets + 1)
+        now = _epoch(datetime.now())
+        for chunk in self.iter_chunks(end=datetime(1970, 1, 1) + timedelta(seconds=end)):
+            a = np.maximum(chunk.in_time, start)
+            b = np.minimum(np.where(chunk.out_time < 0, now, chunk.out_time), end)
+            keep = (b > a) & (chunk.in_time >= 0)
+            a, b = a[keep] - start, b[keep] - start
+            first, last = a // SECONDS_PER_HOUR, b // SECONDS_PER_HOUR
+            same = first == last
+            seconds += np.bincount(first[same], b[same] - a[same], buckets + 1)
+            a, b, first, last = a[~same], b[~same], first[~same], last[~same]
+            seconds += np.bincount(first, (first + 1) * SECONDS_PER_HOUR - a, buckets + 1)
+            seconds += np.bincount(last, b - last * SECONDS_PER_HOUR, buckets + 1)
+            # Hours strictly between the first and last are covered in full.
+            full += np.bincount(first + 1, minlength=buckets + 1)
+            full -= np.bincount(last, minlength=buckets + 1)
+        seconds += np.cumsum(full) * SECONDS_PER_HOUR
+        hours = np.datetime64(start, 's').astype('datetime64[h]') + np.arange(buckets)
+        return hours, seconds[:buckets] / SECONDS_PER_HOUR
+
+    def dwell_histogram(self, bins=DEFAULT_DWELL_BINS, start=None, end=None):
+        """
+        Counts finished stays by length, per vehicle type.
+
+        Args:
+            bins (sequence): Bin edges in minutes. The last edge may be math.inf.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+
+        Returns:
+            dict: Maps each vehicle type to an array with one count per bin.
+        """
+        edges = np.asarray(bins, dtype=float) * 60
+        counts = {}
+        for chunk in self.iter_chunks(start, end):
+            closed = chunk.out_time >= 0
+            dwell = (chunk.out_time - chunk.in_time)[closed]
+            vehicle = chunk.vehicle[closed]
+            for code, vehicle_type in enumerate(chunk.vehicle_types):
+                histogram, _ = np.histogram(dwell[vehicle == code], edges)
+                counts[vehicle_type] = counts.get(vehicle_type, 0) + histogram
+        return counts
+
+    def revenue_by_vehicle_type(self, start=None, end=None):
+        """
+        Totals the charges of finished stays per vehicle type.
+
+        Args:
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+
+        Returns:
+            dict: Maps each vehicle type to its revenue. Types without a tariff earn 0.0.
+        """
+        revenue = {}
+        for chunk in self.iter_chunks(start, end):
+            closed = chunk.out_time >= 0
+            for code, vehicle_type in enumerate(chunk.vehicle_types):
+                mask = closed & (chunk.vehicle == code)
+                if not mask.any():
+                    continue
+                prices = chunk.price[mask]
+                missing = np.isnan(prices)
+                if missing.any():
+                    prices[missing] = self._prices(vehicle_type, chunk.in_time[mask][missing], chunk.out_time[mask][missing])
+                revenue[vehicle_type] = revenue.get(vehicle_type, 0.0) + float(prices.sum())
+        return revenue
+
+    def _prices(self, vehicle_type, in_time, out_time):
+        schedule = self.tariffs.get_schedule(vehicle_type)
+        if schedule is None:
+            return np.zeros(len(in_time))
+        minutes = (out_time - in_time) / 60
+        if schedule.has_bands:
+            # Time-of-day bands need the entry time of each stay, so they are priced one by one.
+            epoch = datetime(1970, 1, 1)
+            return np.array([schedule.price(timedelta(seconds=int(b - a)), epoch + timedelta(seconds=int(a)))
+                             for a, b in zip(in_time, out_time)])
+        billable = minutes
+        if schedule.rounding_minutes:
+            billable = np.ceil(minutes / schedule.rounding_minutes) * schedule.rounding_minutes
+        billable = np.where(minutes <= schedule.grace_minutes, 0.0, billable)
+        if schedule.daily_max is None:
+            return schedule.rate * billable / 60
+        full_days, tail = np.divmod(billable, MINUTES_PER_DAY)
+        day_cost = min(schedule.rate * MINUTES_PER_DAY / 60, schedule.daily_max)
+        return full_days * day_cost + np.minimum(schedule.rate * tail / 60, schedule.daily_max)
+
+    def peak_hour_heatmap(self, start=None, end=None):
+        """
+        Counts entries by day of week and hour of day.
+
+        Args:
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+
+        Returns:
+            numpy.ndarray: A 7 x 24 array of entry counts, Monday first.
+        """
+        heatmap = np.zeros(7 * 24, dtype=np.int64)
+        for chunk in self.iter_chunks(start, end):
+            in_time = chunk.in_time[chunk.in_time >= 0]
+            hours = in_time // SECONDS_PER_HOUR
+            # The epoch was a Thursday, day 3 of a Monday-first week.
+            weekday = (hours // 24 + 3) % 7
+            heatmap += np.bincount(weekday * 24 + hours % 24, minlength=7 * 24)
+        return heatmap.reshape(7, 24)
+
+    def to_dataframe(self, start=None, end=None):
+        """
+        Returns the tickets as a pandas DataFrame. Needs pandas installed.
+
+        Args:
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+
+        Returns:
+            pandas.DataFrame: One row per ticket, with vehicle_type as a categorical column.
+        """
+        import pandas as pd
+        frames = []
+        for chunk in self.iter_chunks(start, end):
+            out_time = pd.to_datetime(np.where(chunk.out_time < 0, np.iinfo(np.int64).min, chunk.out_time * 10**9))
+            frames.append(pd.DataFrame({
+                "ticket_id": chunk.ticket_id,
+                "in_time": pd.to_datetime(chunk.in_time, unit='s'),
+                "out_time": out_time,
+                "vehicle_type": pd.Categorical.from_codes(chunk.vehicle, chunk.vehicle_types),
+            }))
+        if not frames:
+            return pd.DataFrame(columns=["ticket_id", "in_time", "out_time", "vehicle_type"])
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,442 @@
+import time
+import heapq
+import bisect
+import sqlite3
+import logging
+import threading
+import weakref
+from datetime import datetime, timedelta
+from src.storage import get_storage
+from src.slots import DEFAULT_SIZE_CLASS, DEFAULT_FALLBACK, size_class_for
+from src.metrics import timed
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Reservations longer than this are refused. It also bounds how far back a
+# window query looks in the start-ordered index.
+MAX_RESERVATION = timedelta(hours=24)
+
+
+def _as_time(value):
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0)
+    return datetime.strptime(value, TIME_FORMAT)
+
+
+class Reservation:
+    """
+    One reserved bay for one time window.
+
+    Attributes:
+        reservation_id (int): The ID of the reservation.
+        user_id (int): The user the bay is held for.
+        slot (int): The reserved slot.
+        start (datetime): Start of the window.
+        end (datetime): End of the window, exclusive.
+        vehicle_type (str): The vehicle the bay was chosen for.
+        status (str): "active", "used" once the user has entered, or "cancelled".
+        ticket_id (int): The ticket issued against the reservation, or None.
+    """
+    __slots__ = ("reservation_id", "user_id", "slot", "start", "end", "vehicle_type", "status", "ticket_id")
+
+    def __init__(self, reservation_id, user_id, slot, start, end, vehicle_type, status="active", ticket_id=None):
+        self.reservation_id = reservation_id
+        self.user_id = user_id
+        self.slot = slot
+        self.start = start
+        self.end = end
+        self.vehicle_type = vehicle_type
+        self.status = status
+        self.ticket_id = ticket_id
+
+
+class Reservations:
+    """
+    Bays reserved for future time windows, indexed for availability queries.
+
+    Every slot has a timeline: its reservations sorted by start, which never
+    overlap, so checking one slot for a window is a bisect. All reservations
+    are also kept in one list sorted by start. No reservation is longer than
+    MAX_RESERVATION, so the reservations overlapping [start, end) all start
+    in [start - MAX_RESERVATION, end), a range found by bisection. Slot
+    numbers are kept sorted per (size class, level, zone) group, and only
+    the reserved ones are skipped while merging them. Asking which slots of
+    a class are free for a window therefore costs O(log n + k) for the k
+    reservations near it, plus the slots returned, instead of a scan of
+    every slot, ticket or reservation.
+
+    The database is the source of truth. reserve() re-checks for conflicts
+    inside its write transaction, and the index reloads when older than
+    ttl seconds, which picks up reservations made by other processes.
+
+    Attributes:
+        storage (Storage): The storage holding reservations and slots.
+        hold (timedelta): How long before a reservation starts its bay stops going to walk-ins.
+        early_arrival (timedelta): How early a user may arrive and still get their reserved bay.
+        ttl (float): Seconds a loaded index stays valid.
+    """
+    def __init__(self, storage=None, hold_minutes=60, early_arrival_minutes=15, ttl=60.0):
+        """
+        Initializes the Reservations class. The index is loaded on first use.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+            hold_minutes (int): Minutes before a reservation starts that its bay is held back from walk-ins.
+            early_arrival_minutes (int): Minutes before its start a reservation can be used at the gate.
+            ttl (float): Seconds a loaded index stays valid.
+        """
+        self.storage = storage or get_storage()
+        self.hold = timedelta(minutes=hold_minutes)
+        self.early_arrival = timedelta(minutes=early_arrival_minutes)
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._reservations = {}
+        self._timelines = {}
+        self._by_start = []
+        self._slot_groups = {}
+        self._group_slots = {}
+
+    def refresh(self):
+        """
+        Reloads the slots and every reservation that hasn't ended or been cancelled.
+        """
+        now = datetime.now().strftime(TIME_FORMAT)
+        try:
+            with self.storage.connection() as conn:
+                slot_rows = conn.execute("SELECT slot_number, size_class, level, zone FROM parking_slots;").fetchall()
+                rows = conn.execute('''
+                    SELECT reservation_id, user_id, slot, start_time, end_time, vehicle_type, status, ticket_id
+                    FROM reservations WHERE end_time > ? AND status != 'cancelled';
+                ''', (now,)).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error loading reservations: {e}")
+            return
+        with self._lock:
+            self._slot_groups = {slot_number: (size_class or DEFAULT_SIZE_CLASS, level or 0, zone)
+                                 for slot_number, size_class, level, zone in slot_rows}
+            self._group_slots = {}
+            for slot_number, group in self._slot_groups.items():
+                self._group_slots.setdefault(group, []).append(slot_number)
+            for slots in self._group_slots.values():
+                slots.sort()
+            self._reservations = {}
+            self._timelines = {}
+            self._by_start = []
+            for reservation_id, user_id, slot, start, end, vehicle_type, status, ticket_id in rows:
+                self._add(Reservation(reservation_id, user_id, slot, _as_time(start), _as_time(end),
+                                      vehicle_type, status, ticket_id))
+            self._loaded_at = time.monotonic()
+        logger.info(f"Loaded {len(rows)} reservations")
+
+    def invalidate(self):
+        """
+        Marks the index as stale so the next read reloads it, e.g. after slots are added.
+        """
+        self._loaded_at = None
+
+    def _ensure_fresh(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.ttl:
+            self.refresh()
+
+    def _add(self, reservation):
+        # Must be called with self._lock held.
+        self._reservations[reservation.reservation_id] = reservation
+        bisect.insort(self._timelines.setdefault(reservation.slot, []),
+                      (reservation.start, reservation.end, reservation.reservation_id))
+        bisect.insort(self._by_start, (reservation.start, reservation.end, reservation.slot, reservation.reservation_id))
+
+    def _remove(self, reservation):
+        # Must be called with self._lock held.
+        self._reservations.pop(reservation.reservation_id, None)
+        timeline = self._timelines.get(reservation.slot, [])
+        entry = (reservation.start, reservation.end, reservation.reservation_id)
+        i = bisect.bisect_left(timeline, entry)
+        if i < len(timeline) and timeline[i] == entry:
+            del timeline[i]
+        entry = (reservation.start, reservation.end, reservation.slot, reservation.reservation_id)
+        i = bisect.bisect_left(self._by_start, entry)
+        if i < len(self._by_start) and self._by_start[i] == entry:
+            del self._by_start[i]
+
+    def _overlapping(self, start, end):
+        # Must be called with self._lock held. Yields (slot, reservation_id) overlapping [start, end).
+        lo = bisect.bisect_left(self._by_start, (start - MAX_RESERVATION,))
+        hi = bisect.bisect_left(self._by_start, (end,))
+        for i in range(lo, hi):
+            _, reserved_end, slot, reservation_id = self._by_start[i]
+            if reserved_end > start:
+                yield slot, reservation_id
+
+    def _unused_conflict(self, slot, start, end, ignore_user=None):
+        # Must be called with self._lock held. Returns an unused reservation on slot overlapping [start, end), or None.
+        timeline = self._timelines.get(slot)
+        if not timeline:
+            return None
+        i = bisect.bisect_left(timeline, (end,))
+        # A slot's reservations never overlap, so walking back from end stops at the first one ending by start.
+        while i > 0:
+            _, reserved_end, reservation_id = timeline[i - 1]
+            if reserved_end <= start:
+                return None
+            reservation = self._reservations[reservation_id]
+            if reservation.status == "active" and (ignore_user is None or reservation.user_id != ignore_user):
+                return reservation
+            i -= 1
+        return None
+
+    def _candidate_classes(self, vehicle_type, fallback):
+        if vehicle_type is None:
+            return (None,)
+        size_class = size_class_for(vehicle_type)
+        if not fallback:
+            return (size_class,)
+        return (size_class,) + tuple(DEFAULT_FALLBACK.get(size_class, ()))
+
+    def free_slots(self, start, end, vehicle_type=None, level=None, zone=None, fallback=True):
+        """
+        Returns the slots with no reservation overlapping [start, end).
+
+        Slots of the vehicle's own size class come first, then those of the
+        larger classes the fallback allows, each in slot number order.
+
+        Args:
+            start (datetime or str): Start of the window, 'YYYY-MM-DD HH:MM:SS'.
+            end (datetime or str): End of the window, exclusive.
+            vehicle_type (str): Only slots this vehicle fits. None for any slot.
+            level (int): Only slots on this level. None for any level.
+            zone (str): Only slots in this zone. None for any zone.
+            fallback (bool): Whether to include larger classes.
+
+        Returns:
+            list: Slot numbers.
+        """
+        start, end = _as_time(start), _as_time(end)
+        self._ensure_fresh()
+        with self._lock:
+            busy = {slot for slot, _ in self._overlapping(start, end)}
+            free = []
+            for size_class in self._candidate_classes(vehicle_type, fallback):
+                groups = [slots for group, slots in self._group_slots.items()
+                          if (size_class is None or group[0] == size_class)
+                          and (level is None or group[1] == level)
+                          and (zone is None or group[2] == zone)]
+                free.extend(slot for slot in heapq.merge(*groups) if slot not in busy)
+            return free
+
+    @timed("Reservations.reserve")
+    def reserve(self, user_id, vehicle_type, start, end, level=None, zone=None, slot=None):
+        """
+        Reserves a bay for a user and a time window.
+
+        The nearest bay free for the whole window is chosen, unless a slot is
+        asked for. The choice is re-checked against the database inside the
+        write transaction, so two processes can't reserve the same bay for
+        overlapping windows.
+
+        Args:
+            user_id (int): The ID of the user.
+            vehicle_type (str): The type of vehicle.
+            start (datetime or str): Start of the window, 'YYYY-MM-DD HH:MM:SS'.
+            end (datetime or str): End of the window, exclusive.
+            level (int): Only reserve on this level. None for any level.
+            zone (str): Only reserve in this zone. None for any zone.
+            slot (int): Reserve this slot. None to pick one.
+
+        Returns:
+            Reservation: The new reservation, or None if no bay is free for the window.
+
+        Raises:
+            ValueError: If the window is empty, in the past or longer than MAX_RESERVATION,
+                or the slot doesn't exist.
+        """
+        start, end = _as_time(start), _as_time(end)
+        if end <= start:
+            raise ValueError("A reservation must end after it starts")
+        if end - start > MAX_RESERVATION:
+            raise ValueError(f"A reservation can't be longer than {MAX_RESERVATION}")
+        if end <= datetime.now():
+            raise ValueError("A reservation can't end in the past")
+        user_id = int(user_id)
+        if slot is None:
+            candidates = self.free_slots(start, end, vehicle_type, level, zone)
+        else:
+            candidates = [int(slot)]
+            self._ensure_fresh()
+            if candidates[0] not in self._slot_groups:
+                raise ValueError(f"Slot {slot} doesn't exist")
+        window = (start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT))
+        try:
+            for candidate in candidates:
+                with self.storage.transaction() as conn:
+                    conflict = conn.execute('''
+                        SELECT 1 FROM reservations
+                        WHERE slot = ? AND status != 'cancelled' AND start_time < ? AND end_time > ? LIMIT 1;
+                    ''', (candidate, window[1], window[0])).fetchone()
+                    if conflict is not None:
+                        continue
+                    reservation_id = conn.execute(
+                        "INSERT INTO reservations (user_id, slot, start_time, end_time, vehicle_type) VALUES (?, ?, ?, ?, ?) RETURNING reservation_id;",
+                        (user_id, candidate, window[0], window[1], vehicle_type)).fetchone()[0]
+                reservation = Reservation(reservation_id, user_id, candidate, start, end, vehicle_type)
+                with self._lock:
+                    self._add(reservation)
+                logger.info(f"Reserved slot {candidate} for user {user_id} from {window[0]} to {window[1]}")
+                return reservation
+        except sqlite3.Error as e:
+            logger.error(f"Error reserving a slot: {e}")
+            return None
+        # Every candidate was taken by another process, so the index is behind.
+        self.invalidate()
+        logger.warning(f"No slot free for user {user_id} from {window[0]} to {window[1]}")
+        return None
+
+    def cancel(self, reservation_id):
+        """
+        Cancels a reservation that hasn't been used.
+
+        Args:
+            reservation_id (int): The ID of the reservation.
+
+        Returns:
+            bool: True if the reservation was cancelled.
+        """
+        reservation_id = int(reservation_id)
+        try:
+            with self.storage.transaction() as conn:
+                cancelled = conn.execute(
+                    "UPDATE reservations SET status = 'cancelled' WHERE reservation_id = ? AND status = 'active';",
+                    (reservation_id,)).rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error cancelling reservation {reservation_id}: {e}")
+            return False
+        with self._lock:
+            reservation = self._reservations.get(reservation_id)
+            if cancelled and reservation is not None:
+                self._remove(reservation)
+        return bool(cancelled)
+
+    def get(self, reservation_id):
+        """
+        Returns a reservation from the index.
+
+        Args:
+            reservation_id (int): The ID of the reservation.
+
+        Returns:
+            Reservation: The reservation, or None if it is unknown, cancelled or over.
+        """
+        self._ensure_fresh()
+        return self._reservations.get(int(reservation_id))
+
+    def user_reservations(self, user_id):
+        """
+        Returns a user's reservations that haven't ended, soonest first.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            list: Reservation objects.
+        """
+        user_id = int(user_id)
+        self._ensure_fresh()
+        with self._lock:
+            return sorted((r for r in self._reservations.values() if r.user_id == user_id), key=lambda r: r.start)
+
+    def active_for(self, user_id, at=None):
+        """
+        Returns the reservation a user arriving now can use.
+
+        Args:
+            user_id (int): The ID of the user.
+            at (datetime): Arrival time. Defaults to now.
+
+        Returns:
+            Reservation: An unused reservation whose window, opened early_arrival early,
+                covers the arrival, or None.
+        """
+        at = at or datetime.now()
+        user_id = int(user_id)
+        self._ensure_fresh()
+        with self._lock:
+            for slot, reservation_id in self._overlapping(at, at + self.early_arrival):
+                reservation = self._reservations[reservation_id]
+                if reservation.user_id == user_id and reservation.status == "active":
+                    return reservation
+        return None
+
+    def is_held(self, slot, user_id=None, at=None):
+        """
+        Tells whether a bay should stay empty for a reservation.
+
+        A bay is held while an unused reservation on it is running or starts
+        within the hold time, unless the reservation belongs to user_id. The
+        index isn't reloaded here, so the allocator can call it under its lock.
+
+        Args:
+            slot (int): The slot number.
+            user_id (int): The arriving user, whose own reservations don't hold bays against them.
+            at (datetime): Arrival time. Defaults to now.
+
+        Returns:
+            bool: True if the bay should not go to this user.
+        """
+        at = at or datetime.now()
+        with self._lock:
+            return self._unused_conflict(slot, at, at + self.hold, user_id) is not None
+
+    def mark_used(self, conn, reservation_id, ticket_id):
+        """
+        Records that a reservation's user has entered.
+
+        Call it in the transaction that issues the ticket.
+
+        Args:
+            conn (sqlite3.Connection): A connection inside an open write transaction.
+            reservation_id (int): The ID of the reservation.
+            ticket_id (int): The ID of the new ticket.
+        """
+        conn.execute("UPDATE reservations SET status = 'used', ticket_id = ? WHERE reservation_id = ?;",
+                     (ticket_id, reservation_id))
+
+    def used(self, reservation_id, ticket_id):
+        """
+        Updates the index once the transaction from mark_used has committed.
+
+        Args:
+            reservation_id (int): The ID of the reservation.
+            ticket_id (int): The ID of the new ticket.
+        """
+        with self._lock:
+            reservation = self._reservations.get(reservation_id)
+            if reservation is not None:
+                reservation.status = "used"
+                reservation.ticket_id = ticket_id
+
+
+_shared_reservations = weakref.WeakKeyDictionary()
+_shared_lock = threading.Lock()
+
+
+def get_reservations(storage=None):
+    """
+    Returns the reservation index shared by everything using the same storage.
+
+    Sharing it means a reservation made through the admin or the gate server
+    is honoured by the gates in the same process straight away.
+
+    Args:
+        storage (Storage): The storage the reservations live in. Defaults to the shared store.
+
+    Returns:
+        Reservations: The shared index.
+    """
+    storage = storage or get_storage()
+    with _shared_lock:
+        reservations = _shared_reservations.get(storage)
+        if reservations is None:
+            reservations = Reservations(storage)
+            _shared_reservations[storage] = reservations
+        return reservations
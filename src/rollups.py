@@ -0,0 +1,180 @@
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from src.storage import get_storage
+from src.config import setup_logging
+from src.tariff import get_tariff_cache
+logger = logging.getLogger(__name__)
+
+ROLLUP_UPSERT = '''
+    INSERT INTO ticket_rollups (day, hour, vehicle_type, tickets, revenue, minutes) VALUES (?, ?, ?, 1, ?, ?)
+    ON CONFLICT (day, hour, vehicle_type) DO UPDATE SET
+        tickets = tickets + 1, revenue = revenue + excluded.revenue, minutes = minutes + excluded.minutes;
+'''
+
+
+def record_exit(conn, out_time, vehicle_type, price, minutes):
+    """
+    Adds a closed ticket to the rollups of the hour it left in.
+
+    Call it in the transaction that closes the ticket, so the rollups never
+    disagree with the tickets table.
+
+    Args:
+        conn (sqlite3.Connection): A connection inside an open write transaction.
+        out_time (str): Exit time, 'YYYY-MM-DD HH:MM:SS'.
+        vehicle_type (str): The type of vehicle.
+        price (float): The price charged.
+        minutes (float): Length of the stay in minutes.
+    """
+    conn.execute(ROLLUP_UPSERT, (out_time[:10], int(out_time[11:13]), vehicle_type, price, minutes))
+
+
+def _as_day(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+class Rollups:
+    """
+    Ticket counts, revenue and parked minutes per exit day, hour and vehicle type.
+
+    The gates update the ticket_rollups table as tickets close, so dashboard
+    queries read one row per hour and vehicle type instead of scanning
+    parking_tickets. backfill() rebuilds the rollups from existing history.
+
+    Attributes:
+        storage (Storage): The storage holding the tickets and rollups.
+    """
+    def __init__(self, storage=None):
+        """
+        Initializes the Rollups class.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+        """
+        self.storage = storage or get_storage()
+
+    def daily(self, start_day, end_day, vehicle_type=None):
+        """
+        Returns tickets, revenue and parked minutes per day and vehicle type.
+
+        Args:
+            start_day (datetime or str): First day, 'YYYY-MM-DD'.
+            end_day (datetime or str): Last day, inclusive.
+            vehicle_type (str): Only this vehicle type. None for all.
+
+        Returns:
+            list: (day, vehicle_type, tickets, revenue, minutes) tuples ordered by day.
+        """
+        query = '''
+            SELECT day, vehicle_type, SUM(tickets), SUM(revenue), SUM(minutes) FROM ticket_rollups
+            WHERE day BETWEEN ? AND ? AND (? IS NULL OR vehicle_type = ?)
+            GROUP BY day, vehicle_type ORDER BY day, vehicle_type;
+        '''
+        try:
+            with self.storage.connection() as conn:
+                return conn.execute(query, (_as_day(start_day), _as_day(end_day), vehicle_type, vehicle_type)).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading daily rollups: {e}")
+            return []
+
+    def hourly(self, day, vehicle_type=None):
+        """
+        Returns tickets, revenue and parked minutes per hour of one day.
+
+        Args:
+            day (datetime or str): The day, 'YYYY-MM-DD'.
+            vehicle_type (str): Only this vehicle type. None for all.
+
+        Returns:
+            list: (hour, vehicle_type, tickets, revenue, minutes) tuples ordered by hour.
+        """
+        query = '''
+            SELECT hour, vehicle_type, tickets, revenue, minutes FROM ticket_rollups
+            WHERE day = ? AND (? IS NULL OR vehicle_type = ?) ORDER BY hour, vehicle_type;
+        '''
+        try:
+            with self.storage.connection() as conn:
+                return conn.execute(query, (_as_day(day), vehicle_type, vehicle_type)).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading hourly rollups: {e}")
+            return []
+
+    def revenue_by_vehicle_type(self, day):
+        """
+        Returns one day's revenue per vehicle type, e.g. yesterday's for finance.
+
+        Args:
+            day (datetime or str): The day, 'YYYY-MM-DD'.
+
+        Returns:
+            dict: Maps each vehicle type to its revenue.
+        """
+        return {vehicle_type: revenue for _, vehicle_type, _, revenue, _ in self.daily(day, day)}
+
+    def backfill(self, batch_size=50000):
+        """
+        Prices closed tickets that have no stored price, then rebuilds the rollups.
+
+        Tickets are priced with the current tariffs in batches, each in its own
+        transaction. The rollups are then rebuilt from the tickets table in one
+        transaction, so running the backfill again is harmless.
+
+        Args:
+            batch_size (int): Number of tickets priced per transaction.
+
+        Returns:
+            int: The number of tickets that were priced.
+        """
+        tariffs = get_tariff_cache(self.storage)
+        priced = 0
+        last_id = 0
+        select_query = '''
+            SELECT ticket_id, in_time, out_time, vehicle_type FROM parking_tickets
+            WHERE ticket_id > ? AND out_time IS NOT NULL AND price IS NULL ORDER BY ticket_id LIMIT ?;
+        '''
+        try:
+            while True:
+                with self.storage.connection() as conn:
+                    rows = conn.execute(select_query, (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                updates = []
+                for ticket_id, in_time, out_time, vehicle_type in rows:
+                    in_time = datetime.strptime(in_time, '%Y-%m-%d %H:%M:%S')
+                    out_time = datetime.strptime(out_time, '%Y-%m-%d %H:%M:%S')
+                    schedule = tariffs.get_schedule(vehicle_type)
+                    price = schedule.price(out_time - in_time, in_time) if schedule is not None else 0.0
+                    updates.append((price, ticket_id))
+                with self.storage.transaction() as conn:
+                    conn.executemany("UPDATE parking_tickets SET price = ? WHERE ticket_id = ? AND price IS NULL;", updates)
+                priced += len(updates)
+                last_id = rows[-1][0]
+                logger.info(f"Priced {priced} tickets")
+            with self.storage.transaction() as conn:
+                conn.execute("DELETE FROM ticket_rollups;")
+                conn.execute('''
+                    INSERT INTO ticket_rollups (day, hour, vehicle_type, tickets, revenue, minutes)
+                    SELECT date(out_time), CAST(strftime('%H', out_time) AS INTEGER), vehicle_type,
+                           COUNT(*), SUM(price), SUM((strftime('%s', out_time) - strftime('%s', in_time)) / 60.0)
+                    FROM parking_tickets WHERE out_time IS NOT NULL
+                    GROUP BY 1, 2, 3;
+                ''')
+            logger.info("Rebuilt ticket rollups")
+        except sqlite3.Error as e:
+            logger.error(f"Error backfilling rollups: {e}")
+        return priced
+
+
+if __name__ == '__main__':
+    # Prices old tickets and rebuilds the rollups of a store.
+    import sys
+    setup_logging()
+    db_path = sys.argv[1] if len(sys.argv) > 1 else None
+    storage = get_storage(db_path)
+    priced = Rollups(storage).backfill()
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    print(f"Priced {priced} tickets. Revenue on {yesterday}: {Rollups(storage).revenue_by_vehicle_type(yesterday)}")
+    storage.close()
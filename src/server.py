@@ -0,0 +1,268 @@
+import json
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from src.parking import ParkingLot
+from src.storage import get_storage
+from src.config import setup_logging
+logger = logging.getLogger(__name__)
+
+# Operations that change the database go through the single writer task.
+WRITE_OPS = ("enter", "exit", "top_up", "reserve", "cancel_reservation")
+# Operations that only read are served concurrently.
+READ_OPS = ("balance", "availability", "occupancy", "free_between")
+
+
+class GateServer:
+    """
+    An asyncio server that lets many entry/exit kiosks share one ParkingLot.
+
+    Kiosks connect over TCP and send one JSON request per line, for example
+    {"op": "enter", "user_id": 1001, "vehicle_type": "Car"}. Each request gets
+    one JSON line back: {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+
+    Writes are queued to a single writer task. Each time the writer wakes it
+    drains everything queued, up to batch_size, and runs that batch in one
+    trip to its worker thread. When the lot's gate system uses group commit,
+    the batch runs on parallel threads instead so its writes share one
+    transaction. Reads run on a separate thread pool, so balance and
+    availability checks never wait behind gate writes.
+
+    Bays are reserved with {"op": "reserve", "user_id": ..., "vehicle_type": ...,
+    "start": "2024-05-01 09:00:00", "end": "2024-05-01 12:00:00"}, and
+    {"op": "free_between", ...} lists the slots free for a window.
+
+    Signage boards can send {"op": "watch"} instead of polling. The
+    connection then also receives {"event": "occupancy", ...} lines whenever
+    the lot's occupancy changes. Bursts of changes are coalesced into one
+    line carrying the latest counts.
+
+    Attributes:
+        lot (ParkingLot): The lot the requests are applied to.
+        host (str): Interface to listen on.
+        port (int): Port to listen on. 0 picks a free port, stored here once started.
+        batch_size (int): Maximum number of writes run per writer batch.
+    """
+    def __init__(self, lot=None, host="127.0.0.1", port=8765, batch_size=64, read_workers=4):
+        """
+        Initializes the GateServer class.
+
+        Args:
+            lot (ParkingLot): The lot to serve. Defaults to a lot on the shared store.
+            host (str): Interface to listen on.
+            port (int): Port to listen on, 0 for any free port.
+            batch_size (int): Maximum number of writes run per writer batch.
+            read_workers (int): Number of threads serving reads.
+        """
+        self.lot = lot or ParkingLot()
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gate-writer")
+        self._read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="gate-reader")
+        self._group_executor = None
+        if self.lot.gate_system.committer is not None:
+            self._group_executor = ThreadPoolExecutor(max_workers=batch_size, thread_name_prefix="gate-group")
+        self._queue = None
+        self._writer_task = None
+        self._server = None
+
+    async def start(self):
+        """
+        Starts the writer task and begins accepting kiosk connections.
+        """
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer())
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Gate server listening on {self.host}:{self.port}")
+
+    async def serve_forever(self):
+        """
+        Starts the server and serves until cancelled.
+        """
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """
+        Stops accepting connections, then stops the writer and worker threads.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        if self._group_executor is not None:
+            self._group_executor.shutdown(wait=True)
+        logger.info("Gate server stopped")
+
+    async def dispatch(self, request):
+        """
+        Handles one request.
+
+        Args:
+            request (dict): The decoded request, with an "op" key.
+
+        Returns:
+            dict: The response.
+        """
+        op = request.get("op")
+        loop = asyncio.get_running_loop()
+        if op in WRITE_OPS:
+            future = loop.create_future()
+            await self._queue.put((op, request, future))
+            return await future
+        if op in READ_OPS:
+            return await loop.run_in_executor(self._read_executor, self._run, op, request)
+        return {"ok": False, "error": f"Unknown op {op!r}"}
+
+    async def _handle_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        watcher = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {"ok": False, "error": "Malformed request"}
+                else:
+                    if not isinstance(request, dict):
+                        response = {"ok": False, "error": "Request must be a JSON object"}
+                    elif request.get("op") == "watch":
+                        if watcher is None:
+                            watcher = asyncio.create_task(self._watch_occupancy(writer))
+                        response = {"ok": True, "result": self._occupancy_counts()}
+                    else:
+                        response = await self.dispatch(request)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError as e:
+            logger.warning(f"Connection from {peer} dropped: {e}")
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            writer.close()
+
+    async def _watch_occupancy(self, writer):
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        unsubscribe = self.lot.occupancy.subscribe(lambda *_: loop.call_soon_threadsafe(changed.set))
+        try:
+            while True:
+                await changed.wait()
+                changed.clear()
+                event = dict(self._occupancy_counts(), event="occupancy")
+                writer.write(json.dumps(event).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            unsubscribe()
+
+    def _occupancy_counts(self):
+        snapshot = self.lot.occupancy_snapshot()
+        return {"free": snapshot["free"], "occupied": snapshot["occupied"], "version": snapshot["version"]}
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if self._group_executor is not None:
+                responses = await asyncio.gather(*[
+                    loop.run_in_executor(self._group_executor, self._run, op, request) for op, request, _ in batch])
+            else:
+                responses = await loop.run_in_executor(self._write_executor, self._run_batch, batch)
+            for (_, _, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+    def _run_batch(self, batch):
+        return [self._run(op, request) for op, request, _ in batch]
+
+    def _run(self, op, request):
+        try:
+            if op == "enter":
+                ticket_id = self.lot.park_vehicle(request["user_id"], request["vehicle_type"],
+                                                 request.get("level"), request.get("zone"))
+                if not isinstance(ticket_id, int):
+                    return {"ok": False, "error": ticket_id or "Could not issue a ticket"}
+                return {"ok": True, "result": ticket_id}
+            if op == "exit":
+                return {"ok": True, "result": self.lot.leave_parking(request["ticket_id"])}
+            if op == "top_up":
+                return {"ok": True, "result": self.lot.add_user_balance(request["user_id"], request["amount"])}
+            if op == "reserve":
+                reservation = self.lot.reserve(request["user_id"], request["vehicle_type"], request["start"],
+                                               request["end"], request.get("level"), request.get("zone"))
+                if reservation is None:
+                    return {"ok": False, "error": "No slot free for that window"}
+                return {"ok": True, "result": {"reservation_id": reservation.reservation_id, "slot": reservation.slot}}
+            if op == "cancel_reservation":
+                return {"ok": True, "result": self.lot.cancel_reservation(request["reservation_id"])}
+            if op == "balance":
+                return {"ok": True, "result": self.lot.check_user_balance(request["user_id"])}
+            if op == "availability":
+                return {"ok": True, "result": self.lot.count_available_slots()}
+            if op == "occupancy":
+                return {"ok": True, "result": self._occupancy_counts()}
+            if op == "free_between":
+                return {"ok": True, "result": self.lot.free_slots_between(
+                    request["start"], request["end"], request.get("vehicle_type"), request.get("level"), request.get("zone"))}
+        except (KeyError, TypeError, ValueError) as e:
+            return {"ok": False, "error": f"Bad {op} request: {e}"}
+        except Exception as e:
+            logger.error(f"Error handling {op}: {e}")
+            return {"ok": False, "error": "Internal error"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve entry, exit, balance and availability requests for all gates of a lot.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--group-commit-ms", type=float, default=None,
+                        help="Share one transaction between gate writes arriving within this many milliseconds.")
+    parser.add_argument("--journal", default=None, help="Append gate events to this journal file.")
+    parser.add_argument("--min-balance", type=float, default=None,
+                        help="Turn away users whose prepaid balance is below this at entry.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics, including per-statement latencies, on this local port.")
+    args = parser.parse_args()
+    log_listener = setup_logging()
+    metrics_server = None
+    if args.metrics_port is not None:
+        get_storage(profile_queries=True)
+        from src.metrics import MetricsServer
+        metrics_server = MetricsServer(port=args.metrics_port)
+    window = args.group_commit_ms / 1000 if args.group_commit_ms is not None else None
+    server = GateServer(ParkingLot(group_commit_window=window, journal_path=args.journal, min_balance=args.min_balance), host=args.host, port=args.port, batch_size=args.batch_size)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.lot.gate_system.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if log_listener is not None:
+            log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import os
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.storage import get_storage
+from src.config import get_config
+from src.history import TicketHistory
+from src.rollups import Rollups
+from src.parking import ParkingLot
+from src.user import UserRepository
+logger = logging.getLogger(__name__)
+
+
+def lot_db_path(lot_id, directory=None):
+    """
+    Returns the path of a site's store.
+
+    Args:
+        lot_id: The ID of the site.
+        directory (str): Directory holding the per-site stores. Defaults to the configured lots directory.
+
+    Returns:
+        str: The path of the database file.
+    """
+    return os.path.join(directory or get_config().lots_dir, f"lot_{lot_id}.db")
+
+
+class LotRouter:
+    """
+    Fronts many sites, each with its own store, and routes every operation to its site.
+
+    Slots, tickets and prices live in one database file per site, so each
+    site has its own write lock and its own pooled connections, and adding
+    a site doesn't slow down the others. Users and balances stay in the
+    shared store, so a user can top up once and park at any site. Ticket
+    IDs are only unique within a site, so tickets are referred to by
+    (lot_id, ticket_id).
+
+    Queries that span sites run on a thread pool, one task per site, and
+    their results are merged.
+
+    Attributes:
+        users (UserRepository): Balances shared by all sites.
+        directory (str): Directory holding the per-site stores.
+        lots (dict): Maps each lot_id, as a string, to its ParkingLot.
+    """
+    def __init__(self, lot_ids=None, user_storage=None, directory=None, workers=8, **lot_options):
+        """
+        Initializes the LotRouter class.
+
+        Args:
+            lot_ids (iterable): The sites to open. None opens every site with a store in directory.
+            user_storage (Storage): The store holding users and balances. Defaults to the shared store.
+            directory (str): Directory holding the per-site stores. Defaults to the configured lots directory.
+            workers (int): Number of threads used for queries spanning sites.
+            **lot_options: Passed to every ParkingLot, e.g. group_commit_window.
+        """
+        self.users = UserRepository(user_storage or get_storage())
+        self.directory = directory or get_config().lots_dir
+        self.lots = {}
+        self._lot_options = lot_options
+        self._adding = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lot-fan-out")
+        if lot_ids is None:
+            lot_ids = self._discover()
+        for lot_id in lot_ids:
+            self.add_lot(lot_id)
+
+    def _discover(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[len("lot_"):-len(".db")] for name in os.listdir(self.directory)
+                      if name.startswith("lot_") and name.endswith(".db"))
+
+    def add_lot(self, lot_id, storage=None):
+        """
+        Opens a site, creating its store if needed.
+
+        The new site is published only once it is ready. Operations on the
+        other sites never wait for it.
+
+        Args:
+            lot_id: The ID of the site.
+            storage (Storage): The site's store. Defaults to lot_db_path(lot_id).
+
+        Returns:
+            ParkingLot: The site's lot.
+        """
+        lot_id = str(lot_id)
+        with self._adding:
+            lot = self.lots.get(lot_id)
+            if lot is not None:
+                return lot
+            if storage is None:
+                os.makedirs(self.directory, exist_ok=True)
+                storage = get_storage(lot_db_path(lot_id, self.directory), legacy_databases=())
+            lot = ParkingLot(storage, users=self.users, **self._lot_options)
+            # Readers use self.lots without the lock, so it is replaced rather than changed.
+            self.lots = {**self.lots, lot_id: lot}
+            logger.info(f"Opened lot {lot_id}")
+            return lot
+
+    def lot(self, lot_id):
+        """
+        Returns the ParkingLot of a site.
+
+        Args:
+            lot_id: The ID of the site.
+
+        Returns:
+            ParkingLot: The site's lot.
+
+        Raises:
+            ValueError: If the site isn't open.
+        """
+        lot = self.lots.get(str(lot_id))
+        if lot is None:
+            raise ValueError(f"Unknown lot {lot_id}")
+        return lot
+
+    def park_vehicle(self, lot_id, user_id, vehicle_type, level=None, zone=None):
+        return self.lot(lot_id).park_vehicle(user_id, vehicle_type, level, zone)
+
+    def leave_parking(self, lot_id, ticket_id):
+        return self.lot(lot_id).leave_parking(ticket_id)
+
+    def count_available_slots(self, lot_id):
+        return self.lot(lot_id).count_available_slots()
+
+    def reserve(self, lot_id, user_id, vehicle_type, start, end, level=None, zone=None):
+        return self.lot(lot_id).reserve(user_id, vehicle_type, start, end, level, zone)
+
+    def cancel_reservation(self, lot_id, reservation_id):
+        return self.lot(lot_id).cancel_reservation(reservation_id)
+
+    def add_user_balance(self, user_id, amount):
+        return self.users.add_balance(user_id, amount)
+
+    def check_user_balance(self, user_id):
+        return self.users.get_balance(user_id)
+
+    def fan_out(self, operation):
+        """
+        Runs an operation against every site in parallel.
+
+        A site that fails is logged and left out of the result, so one bad
+        site doesn't stop a report on the others.
+
+        Args:
+            operation (callable): Takes a lot_id and its ParkingLot.
+
+        Returns:
+            dict: Maps each lot_id to what the operation returned.
+        """
+        lots = self.lots
+        futures = {lot_id: self._executor.submit(operation, lot_id, lot) for lot_id, lot in lots.items()}
+        results = {}
+        for lot_id, future in futures.items():
+            try:
+                results[lot_id] = future.result()
+            except Exception as e:
+                logger.error(f"Error querying lot {lot_id}: {e}")
+        return results
+
+    def total_occupancy(self):
+        """
+        Returns the free and occupied counts of every site and of all sites together.
+
+        The counts come from each site's live occupancy, so this needs no
+        database queries and doesn't use the thread pool.
+
+        Returns:
+            tuple: ((free, occupied) for all sites, dict mapping lot_id to (free, occupied)).
+        """
+        per_lot = {lot_id: lot.occupancy.counts() for lot_id, lot in self.lots.items()}
+        return (sum(free for free, _ in per_lot.values()), sum(occupied for _, occupied in per_lot.values())), per_lot
+
+    def user_history(self, user_id, start=None, end=None, vehicle_type=None):
+        """
+        Returns a user's tickets from every site, in entry order.
+
+        Args:
+            user_id (int): The ID of the user.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+            vehicle_type (str): Only tickets for this vehicle type.
+
+        Returns:
+            list: (lot_id, ticket_id, user_id, in_time, out_time, vehicle_type, slot) tuples.
+        """
+        def fetch(lot_id, lot):
+            rows = TicketHistory(lot.storage).stream(user_id, start=start, end=end, vehicle_type=vehicle_type)
+            return [(lot_id,) + tuple(row) for row in rows]
+        per_lot = self.fan_out(fetch)
+        return list(heapq.merge(*per_lot.values(), key=lambda row: (row[3], row[0], row[1])))
+
+    def daily_revenue(self, start_day, end_day):
+        """
+        Returns tickets and revenue per site, day and vehicle type from each site's rollups.
+
+        Args:
+            start_day (datetime or str): First day, 'YYYY-MM-DD'.
+            end_day (datetime or str): Last day, inclusive.
+
+        Returns:
+            list: (lot_id, day, vehicle_type, tickets, revenue, minutes) tuples ordered by day and site.
+        """
+        per_lot = self.fan_out(lambda lot_id, lot: [(lot_id,) + tuple(row) for row in Rollups(lot.storage).daily(start_day, end_day)])
+        return sorted((row for rows in per_lot.values() for row in rows), key=lambda row: (row[1], row[0], row[2]))
+
+    def close(self):
+        """
+        Stops the fan-out threads and every site's group commit thread.
+        """
+        self._executor.shutdown(wait=True)
+        for lot in self.lots.values():
+            lot.gate_system.close()
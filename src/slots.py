@@ -1,34 +1,270 @@
-from paths import *
 import sqlite3
+import heapq
 import logging
+import threading
+import weakref
 from datetime import datetime
-# Configure the logger
-logging.basicConfig(level=logging.INFO, filename='logs\\slots.log', filemode='a', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from src.storage import get_storage
+from src.occupancy import Occupancy
+from src.metrics import timed
 logger = logging.getLogger(__name__)
-import sqlite3
+
+# Slot size classes, smallest first.
+SIZE_CLASSES = ("motorcycle", "car", "van", "truck")
+# Bays without a class are treated as the largest, so every vehicle fits them.
+DEFAULT_SIZE_CLASS = "truck"
+# The size class each vehicle type needs. Unknown types are treated as cars.
+VEHICLE_SIZE_CLASSES = {"motorcycle": "motorcycle", "bike": "motorcycle", "car": "car", "van": "van", "truck": "truck"}
+# Classes tried, in order, when a vehicle's own class is full.
+DEFAULT_FALLBACK = {size_class: SIZE_CLASSES[i + 1:] for i, size_class in enumerate(SIZE_CLASSES)}
+
+
+def size_class_for(vehicle_type):
+    """
+    Returns the slot size class a vehicle type needs.
+
+    Args:
+        vehicle_type (str): The type of vehicle, e.g. "Van".
+
+    Returns:
+        str: The size class.
+    """
+    return VEHICLE_SIZE_CLASSES.get(str(vehicle_type).lower(), "car")
+
+
+_occupancies = weakref.WeakKeyDictionary()
+_occupancy_lock = threading.Lock()
+
+
+def get_occupancy(storage):
+    """
+    Returns the occupancy counts shared by everything using the same storage.
+
+    Every Slots on a storage updates the same counts, so an Admin sees the
+    changes made by the gates in the same process straight away.
+
+    Args:
+        storage (Storage): The storage the slots live in.
+
+    Returns:
+        Occupancy: The shared counts.
+    """
+    with _occupancy_lock:
+        occupancy = _occupancies.get(storage)
+        if occupancy is None:
+            occupancy = Occupancy()
+            _occupancies[storage] = occupancy
+        return occupancy
+
 
 class Slots:
     """
     A class to manage parking slots.
 
+    Free slots are indexed by (size_class, level, zone). Each group has its
+    own min-heap of slot numbers, and lower slot numbers are taken as nearer
+    the entrance. Finding the nearest free slot of a class on a level peeks
+    at the top of each matching group's heap, which is O(log n) in the
+    number of slots.
+
     Attributes:
-        conn (sqlite3.Connection): Connection to the database.
-        cursor (sqlite3.Cursor): Cursor for executing SQL queries.
+        storage (Storage): The shared storage the slots table lives in.
+        fallback (dict): Maps a size class to the larger classes a vehicle may use
+            when its own class is full. An empty dict disables fallback.
+        slot_groups (dict): Maps each slot number to its (size_class, level, zone).
+        free_heaps (dict): Maps each group to a min-heap of slot numbers that may be free.
+        free_set (set): Slot numbers that are currently free. Heap entries not in this set are stale.
+        occupancy (Occupancy): Live free/occupied counts and change notifications, shared by
+            every Slots on the same storage.
     """
-    def __init__(self, db_name=parking_slots_path):
+    def __init__(self, storage=None, fallback=None):
         """
         Initializes the Slots class.
 
         Args:
-            db_name (str): The name of the SQLite database file.
+            storage (Storage): The storage to use. Defaults to the shared store.
+            fallback (dict): Size class fallback policy. Defaults to DEFAULT_FALLBACK.
         """
+        self._lock = threading.Lock()
+        self.fallback = DEFAULT_FALLBACK if fallback is None else fallback
+        self.slot_groups = {}
+        self.free_heaps = {}
+        self.free_set = set()
         try:
-            self.conn = sqlite3.connect(db_name)
-            self.cursor = self.conn.cursor()
-            logger.info(f"Connected to the database {db_name}")
+            self.storage = storage or get_storage()
+            self.occupancy = get_occupancy(self.storage)
+            logger.info("Slots manager using the shared storage")
+            self.load_free_slots()
         except sqlite3.Error as e:
             logger.error(f"Error connecting to database: {e}")
 
+    @timed("Slots.load_free_slots")
+    def load_free_slots(self):
+        """
+        Warms the in-memory free slot index and occupancy counts from the database.
+        """
+        try:
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT slot_number, status, size_class, level, zone FROM parking_slots')
+                rows = cursor.fetchall()
+            slot_groups = {}
+            free_heaps = {}
+            free_set = set()
+            for slot_number, status, size_class, level, zone in rows:
+                slot_number = int(slot_number)
+                group = (size_class or DEFAULT_SIZE_CLASS, level or 0, zone)
+                slot_groups[slot_number] = group
+                free_heaps.setdefault(group, [])
+                if status == "free":
+                    free_set.add(slot_number)
+                    free_heaps[group].append(slot_number)
+            for heap in free_heaps.values():
+                heapq.heapify(heap)
+            self.occupancy.load(
+                (slot_number, slot_number not in free_set, {"size_class": group[0], "level": group[1], "zone": group[2]})
+                for slot_number, group in slot_groups.items())
+            with self._lock:
+                self.slot_groups = slot_groups
+                self.free_heaps = free_heaps
+                self.free_set = free_set
+            logger.info(f"Loaded {len(free_set)} free slots in {len(free_heaps)} groups into the allocator")
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.error(f"Error loading free slots: {e}")
+
+    def _candidate_classes(self, vehicle_type, fallback):
+        if vehicle_type is None:
+            return (None,)
+        size_class = size_class_for(vehicle_type)
+        if not fallback:
+            return (size_class,)
+        return (size_class,) + tuple(self.fallback.get(size_class, ()))
+
+    def _find(self, vehicle_type, level, zone, fallback):
+        # Must be called with self._lock held. Returns (slot_number, heap) or (None, None).
+        for size_class in self._candidate_classes(vehicle_type, fallback):
+            best, best_heap = None, None
+            for group, heap in self.free_heaps.items():
+                if ((size_class is not None and group[0] != size_class)
+                        or (level is not None and group[1] != level)
+                        or (zone is not None and group[2] != zone)):
+                    continue
+                while heap and heap[0] not in self.free_set:
+                    heapq.heappop(heap)
+                if heap and (best is None or heap[0] < best):
+                    best, best_heap = heap[0], heap
+            if best is not None:
+                return best, best_heap
+        return None, None
+
+    def next_free_slot(self, vehicle_type=None, level=None, zone=None, fallback=True):
+        """
+        Returns the nearest free slot without querying the database.
+
+        Args:
+            vehicle_type (str): Only slots this vehicle fits. None for any slot.
+            level (int): Only slots on this level. None for any level.
+            zone (str): Only slots in this zone. None for any zone.
+            fallback (bool): Whether to use larger classes when the vehicle's own class is full.
+
+        Returns:
+            int: The slot number, or None if no slot is free.
+        """
+        with self._lock:
+            return self._find(vehicle_type, level, zone, fallback)[0]
+
+    @timed("Slots.take_free_slot")
+    def take_free_slot(self, vehicle_type=None, level=None, zone=None, fallback=True, skip=None):
+        """
+        Removes and returns the nearest free slot from the allocator.
+
+        Unlike next_free_slot, two threads calling this never get the same
+        slot. Give the slot back with mark_free if it can't be booked.
+
+        Args:
+            vehicle_type (str): Only slots this vehicle fits. None for any slot.
+            level (int): Only slots on this level. None for any level.
+            zone (str): Only slots in this zone. None for any zone.
+            fallback (bool): Whether to use larger classes when the vehicle's own class is full.
+            skip (callable): Called with a slot number; slots it returns True for stay free
+                but aren't taken, e.g. bays held for a reservation.
+
+        Returns:
+            int: The slot number, or None if no slot is free.
+        """
+        with self._lock:
+            set_aside = []
+            while True:
+                slot_number, heap = self._find(vehicle_type, level, zone, fallback)
+                if slot_number is None or skip is None or not skip(slot_number):
+                    break
+                # Lift skipped slots off their heaps so _find moves past them.
+                set_aside.append((heapq.heappop(heap), heap))
+            for skipped, skipped_heap in set_aside:
+                heapq.heappush(skipped_heap, skipped)
+            if slot_number is None:
+                return None
+            heapq.heappop(heap)
+            self.free_set.discard(slot_number)
+        self.occupancy.set_occupied(slot_number, True)
+        return slot_number
+
+    def take_slot(self, slot_number):
+        """
+        Removes a given slot from the allocator if it is free.
+
+        Args:
+            slot_number (int): The slot to take, e.g. a reserved bay.
+
+        Returns:
+            bool: True if the slot was free and is now taken. Give it back with mark_free
+                if it can't be booked.
+        """
+        slot_number = int(slot_number)
+        with self._lock:
+            if slot_number not in self.free_set:
+                return False
+            # The heap entry goes stale and is dropped by _find.
+            self.free_set.discard(slot_number)
+        self.occupancy.set_occupied(slot_number, True)
+        return True
+
+    def free_slot_count(self):
+        """
+        Returns the number of free slots without querying the database.
+
+        Returns:
+            int: The number of free slots.
+        """
+        return len(self.free_set)
+
+    def mark_occupied(self, slot_number):
+        """
+        Removes a slot from the in-memory allocator.
+
+        Args:
+            slot_number (int): The number of the slot that is now occupied.
+        """
+        slot_number = int(slot_number)
+        with self._lock:
+            self.free_set.discard(slot_number)
+        self.occupancy.set_occupied(slot_number, True)
+
+    def mark_free(self, slot_number):
+        """
+        Adds a slot back to the in-memory allocator.
+
+        Args:
+            slot_number (int): The number of the slot that is now free.
+        """
+        slot_number = int(slot_number)
+        with self._lock:
+            if slot_number not in self.free_set:
+                self.free_set.add(slot_number)
+                group = self.slot_groups.setdefault(slot_number, (DEFAULT_SIZE_CLASS, 0, None))
+                heapq.heappush(self.free_heaps.setdefault(group, []), slot_number)
+        self.occupancy.set_occupied(slot_number, False)
+
     def return_all_available_slots(self):
         """
         Retrieves all available parking slots.
@@ -37,14 +273,17 @@ class Slots:
             list: A list of available slot numbers.
         """
         try:
-            self.cursor.execute('SELECT slot_number FROM parking_slots WHERE status="free"')
-            slots = self.cursor.fetchall()
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT slot_number FROM parking_slots WHERE status="free"')
+                slots = cursor.fetchall()
             logger.info("Retrieved available slots")
             return slots
         except sqlite3.Error as e:
             logger.error(f"Error retrieving available slots: {e}")
             return []
 
+    @timed("Slots.book_slot")
     def book_slot(self, slot_number):
         """
         Books a parking slot.
@@ -56,19 +295,24 @@ class Slots:
             ValueError: If the slot is already occupied or doesn't exist.
         """
         try:
-            self.cursor.execute('''
-                UPDATE parking_slots 
-                SET status="occupied" 
-                WHERE slot_number=? AND status="free"
-            ''', (slot_number,))
-            if self.cursor.rowcount == 0:
-                raise ValueError("Slot is already occupied or doesn't exist.")
-            else:
-                self.conn.commit()
-                logger.info(f"Slot {slot_number} booked successfully.")
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE parking_slots
+                    SET status="occupied"
+                    WHERE slot_number=? AND status="free"
+                ''', (slot_number,))
+                if cursor.rowcount == 0:
+                    self.mark_occupied(slot_number)
+                    raise ValueError("Slot is already occupied or doesn't exist.")
+                else:
+                    conn.commit()
+                    self.mark_occupied(slot_number)
+                    logger.info(f"Slot {slot_number} booked successfully.")
         except sqlite3.Error as e:
             logger.error(f"Error booking slot: {e}")
 
+    @timed("Slots.release_slot")
     def release_slot(self, slot_number):
         """
         Releases a parking slot.
@@ -80,16 +324,19 @@ class Slots:
             ValueError: If the slot is already free or doesn't exist.
         """
         try:
-            self.cursor.execute('''
-                UPDATE parking_slots 
-                SET status="free" 
-                WHERE slot_number=? AND status="occupied"
-            ''', (slot_number,))
-            if self.cursor.rowcount == 0:
-                raise ValueError("Slot is already free or doesn't exist.")
-            else:
-                self.conn.commit()
-                logger.info(f"Slot {slot_number} released successfully.")
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE parking_slots
+                    SET status="free"
+                    WHERE slot_number=? AND status="occupied"
+                ''', (slot_number,))
+                if cursor.rowcount == 0:
+                    raise ValueError("Slot is already free or doesn't exist.")
+                else:
+                    conn.commit()
+                    self.mark_free(slot_number)
+                    logger.info(f"Slot {slot_number} released successfully.")
         except sqlite3.Error as e:
             logger.error(f"Error releasing slot: {e}")
 
@@ -101,8 +348,10 @@ class Slots:
             list: A list of occupied slot numbers.
         """
         try:
-            self.cursor.execute('SELECT slot_number FROM parking_slots WHERE status="occupied"')
-            slots = self.cursor.fetchall()
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT slot_number FROM parking_slots WHERE status="occupied"')
+                slots = cursor.fetchall()
             logger.info("Retrieved occupied slots")
             return slots
         except sqlite3.Error as e:
@@ -111,10 +360,7 @@ class Slots:
 
     def close_connection(self):
         """
-        Closes the database connection.
+        Kept for compatibility. Connections belong to the shared storage pool,
+        which is closed with Storage.close().
         """
-        try:
-            self.conn.close()
-            logger.info("Database connection closed")
-        except sqlite3.Error as e:
-            logger.error(f"Error closing database connection: {e}")
+        logger.info("Slots manager released")
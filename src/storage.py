@@ -0,0 +1,436 @@
+import os
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from src.config import get_config
+from src.metrics import ProfiledConnection, record_lock_wait
+logger = logging.getLogger(__name__)
+
+# Pragmas applied to every pooled connection. WAL lets readers run alongside
+# the gate writers. The synchronous level is set per pool.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-16000;",
+    "PRAGMA mmap_size=134217728;",
+)
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS parking_slots (
+        slot_number INT PRIMARY KEY,
+        status VARCHAR(10) CHECK (status IN ('free', 'occupied'))
+    );''',
+    '''CREATE TABLE IF NOT EXISTS parking_tickets (
+        ticket_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        in_time DATETIME,
+        out_time DATETIME,
+        vehicle_type TEXT,
+        slot INTEGER
+    );''',
+    '''CREATE TABLE IF NOT EXISTS parking_prices (
+        vehicle_type STRING PRIMARY KEY,
+        amount INTEGER
+    );''',
+    '''CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        amount INTEGER
+    );''',
+    '''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        name TEXT,
+        email_id TEXT,
+        phone_number TEXT,
+        qr_code_path TEXT
+    );''',
+)
+
+# Schema changes applied in order on top of SCHEMA. Each entry is the
+# user_version it brings the store to and the statements that get it there.
+MIGRATIONS = (
+    (2, (
+        "ALTER TABLE parking_prices ADD COLUMN grace_minutes INTEGER DEFAULT 0;",
+        "ALTER TABLE parking_prices ADD COLUMN rounding_minutes INTEGER DEFAULT 0;",
+        "ALTER TABLE parking_prices ADD COLUMN daily_max REAL;",
+        '''CREATE TABLE IF NOT EXISTS tariff_bands (
+            vehicle_type TEXT,
+            start_minute INTEGER,
+            end_minute INTEGER,
+            amount REAL,
+            is_flat INTEGER DEFAULT 0
+        );''',
+    )),
+    (3, (
+        "CREATE INDEX IF NOT EXISTS idx_parking_tickets_user_in_time ON parking_tickets (user_id, in_time);",
+        "CREATE INDEX IF NOT EXISTS idx_parking_tickets_open ON parking_tickets (slot) WHERE out_time IS NULL;",
+        "CREATE INDEX IF NOT EXISTS idx_parking_slots_status ON parking_slots (status);",
+    )),
+    (4, (
+        '''CREATE TABLE IF NOT EXISTS id_sequences (
+            name TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL
+        );''',
+        '''INSERT OR IGNORE INTO id_sequences (name, next_value)
+            SELECT 'user_id', COALESCE(MAX(user_id), 0) + 1
+            FROM (SELECT user_id FROM user_data UNION ALL SELECT user_id FROM users);''',
+    )),
+    (5, (
+        "ALTER TABLE parking_slots ADD COLUMN size_class TEXT DEFAULT 'truck';",
+        "ALTER TABLE parking_slots ADD COLUMN level INTEGER DEFAULT 0;",
+        "ALTER TABLE parking_slots ADD COLUMN zone TEXT;",
+    )),
+    (6, (
+        "ALTER TABLE parking_tickets ADD COLUMN price REAL;",
+        '''CREATE TABLE IF NOT EXISTS ticket_rollups (
+            day TEXT,
+            hour INTEGER,
+            vehicle_type TEXT,
+            tickets INTEGER,
+            revenue REAL,
+            minutes REAL,
+            PRIMARY KEY (day, hour, vehicle_type)
+        ) WITHOUT ROWID;''',
+    )),
+    (7, (
+        '''CREATE TABLE IF NOT EXISTS reservations (
+            reservation_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            slot INTEGER,
+            start_time TEXT,
+            end_time TEXT,
+            vehicle_type TEXT,
+            status TEXT DEFAULT 'active' CHECK (status IN ('active', 'used', 'cancelled')),
+            ticket_id INTEGER
+        );''',
+        "CREATE INDEX IF NOT EXISTS idx_reservations_slot_start ON reservations (slot, start_time);",
+        "CREATE INDEX IF NOT EXISTS idx_reservations_end ON reservations (end_time);",
+    )),
+    (8, (
+        '''CREATE TABLE IF NOT EXISTS balance_ledger (
+            entry_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('opening', 'top_up', 'parking', 'adjustment')),
+            ticket_id INTEGER,
+            created_at TEXT
+        );''',
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, amount);",
+        # Existing balances become opening entries, so the ledger starts out matching them.
+        '''INSERT INTO balance_ledger (user_id, amount, kind, created_at)
+            SELECT user_id, amount, 'opening', datetime('now', 'localtime') FROM user_data WHERE amount != 0;''',
+    )),
+)
+
+class ConnectionPool:
+    """
+    A thread-safe pool of SQLite connections to a single database file.
+
+    Attributes:
+        db_path (str): Path of the database file.
+        pool_size (int): Maximum number of open connections.
+        timeout (float): Seconds to wait for a free connection or a database lock.
+        synchronous (str): SQLite synchronous level, NORMAL or FULL.
+        profile_queries (bool): Whether connections record the latency of every statement.
+    """
+    def __init__(self, db_path, pool_size=8, timeout=5.0, synchronous="NORMAL", profile_queries=False):
+        """
+        Initializes the ConnectionPool class. Connections are opened lazily.
+
+        Args:
+            db_path (str): Path of the database file.
+            pool_size (int): Maximum number of open connections.
+            timeout (float): Seconds to wait for a free connection or a database lock.
+            synchronous (str): SQLite synchronous level, NORMAL or FULL.
+            profile_queries (bool): Whether connections record the latency of every statement.
+        """
+        if synchronous not in ("NORMAL", "FULL"):
+            raise ValueError(f"Unsupported synchronous level {synchronous}")
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.profile_queries = profile_queries
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Opens a new connection with the store pragmas applied.
+
+        Returns:
+            sqlite3.Connection: The new connection.
+        """
+        factory = ProfiledConnection if self.profile_queries else sqlite3.Connection
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False, factory=factory)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.execute(f"PRAGMA synchronous={self.synchronous};")
+        logger.info(f"Opened pooled connection to {self.db_path}")
+        return conn
+
+    def acquire(self):
+        """
+        Takes a connection from the pool, opening one if the pool is not full.
+
+        Returns:
+            sqlite3.Connection: A connection owned by the caller until released.
+
+        Raises:
+            sqlite3.OperationalError: If no connection became free within the timeout.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.pool_size:
+                self._opened += 1
+                try:
+                    return self._connect()
+                except sqlite3.Error:
+                    self._opened -= 1
+                    raise
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+            record_lock_wait("pool", time.perf_counter() - start)
+            return conn
+        except queue.Empty:
+            record_lock_wait("pool", time.perf_counter() - start)
+            raise sqlite3.OperationalError("Timed out waiting for a pooled connection")
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool, rolling back any unfinished transaction.
+
+        Args:
+            conn (sqlite3.Connection): The connection to return.
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that lends out a pooled connection.
+
+        Yields:
+            sqlite3.Connection: The borrowed connection.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        """
+        Closes every idle connection in the pool.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+        logger.info(f"Closed pooled connections to {self.db_path}")
+
+
+class Storage:
+    """
+    The shared storage layer: one WAL-mode database behind a connection pool.
+
+    Nothing is opened when a Storage is created. The schema is created or
+    migrated when the first connection is borrowed, so building the objects
+    of a gate or CLI costs nothing until they touch the database.
+
+    Attributes:
+        db_path (str): Path of the unified database file.
+        pool (ConnectionPool): The pool all connections are borrowed from.
+    """
+    def __init__(self, db_path=None, pool_size=None, timeout=None, legacy_databases=None, synchronous=None,
+                 profile_queries=False):
+        """
+        Initializes the Storage class. Settings left as None come from get_config().
+
+        Args:
+            db_path (str): Path of the unified database file.
+            pool_size (int): Maximum number of pooled connections.
+            timeout (float): Seconds to wait for a free connection or a database lock.
+            legacy_databases (tuple): (path, table) pairs imported when the store is first created.
+            synchronous (str): NORMAL syncs only on WAL checkpoints and may lose the last
+                commits on power loss. FULL syncs every commit.
+            profile_queries (bool): Record the latency of every statement in the
+                parking_query_seconds metric. Costs about a microsecond per statement.
+        """
+        config = get_config()
+        self.db_path = db_path or config.db_path
+        self.pool = ConnectionPool(self.db_path, pool_size or config.pool_size, timeout or config.timeout,
+                                   synchronous or config.synchronous, profile_queries)
+        self._legacy_databases = config.legacy_databases if legacy_databases is None else legacy_databases
+        self._ready = False
+        self._initializing = False
+        self._schema_lock = threading.RLock()
+
+    def connection(self):
+        """
+        Borrows a connection from the pool, creating the schema on first use.
+
+        Returns:
+            contextmanager: Yields a sqlite3.Connection.
+        """
+        if not self._ready:
+            self._ensure_schema()
+        return self.pool.connection()
+
+    def _ensure_schema(self):
+        # The lock is reentrant so initialize_schema can borrow connections itself.
+        with self._schema_lock:
+            if self._ready or self._initializing:
+                return
+            self._initializing = True
+            try:
+                self.initialize_schema(self._legacy_databases)
+                self._ready = True
+            finally:
+                self._initializing = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs a block inside a BEGIN IMMEDIATE transaction on a pooled connection.
+
+        The write lock is taken up front, so the block never fails half way
+        with a lock upgrade error. The transaction commits when the block exits
+        and rolls back if it raises.
+
+        Yields:
+            sqlite3.Connection: The connection the transaction runs on.
+        """
+        with self.connection() as conn:
+            start = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+            finally:
+                record_lock_wait("write", time.perf_counter() - start)
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def initialize_schema(self, legacy_databases=()):
+        """
+        Creates the tables and, for a new store, imports the legacy databases.
+
+        Args:
+            legacy_databases (tuple): (path, table) pairs to import.
+        """
+        with self.transaction() as conn:
+            version = conn.execute("PRAGMA user_version;").fetchone()[0]
+            for statement in SCHEMA:
+                conn.execute(statement)
+        if version == 0:
+            with self.connection() as conn:
+                for path, table in legacy_databases:
+                    self.import_legacy_table(conn, path, table)
+                conn.execute("PRAGMA user_version = 1;")
+        self.apply_migrations()
+        logger.info(f"Storage ready at {self.db_path}")
+
+    def apply_migrations(self):
+        """
+        Brings the store up to the latest schema version.
+
+        Each migration runs in its own write transaction and re-checks the
+        version first, so several processes starting together apply it once.
+        """
+        for target, statements in MIGRATIONS:
+            with self.transaction() as conn:
+                version = conn.execute("PRAGMA user_version;").fetchone()[0]
+                if version >= target:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {target};")
+                logger.info(f"Migrated {self.db_path} to schema version {target}")
+
+    def import_legacy_table(self, conn, path, table):
+        """
+        Copies one table from a legacy database file into the unified store.
+
+        Rows that already exist in the store are left alone, so importing the
+        same file twice is harmless.
+
+        Args:
+            conn (sqlite3.Connection): Connection to the unified store, outside any transaction.
+            path (str): Path of the legacy database file.
+            table (str): Name of the table to copy.
+        """
+        if not os.path.exists(path):
+            return
+        conn.execute("ATTACH DATABASE ? AS legacy;", (path,))
+        try:
+            columns = [row[1] for row in conn.execute(f"PRAGMA legacy.table_info({table});")]
+            if columns:
+                column_list = ", ".join(columns)
+                conn.execute(f"INSERT OR IGNORE INTO main.{table} ({column_list}) SELECT {column_list} FROM legacy.{table};")
+                conn.commit()
+                logger.info(f"Imported table {table} from {path}")
+        finally:
+            conn.execute("DETACH DATABASE legacy;")
+
+    def close(self):
+        """
+        Closes all pooled connections.
+        """
+        self.pool.close_all()
+
+
+_shared_storages = {}
+_shared_lock = threading.Lock()
+
+
+def get_storage(db_path=None, legacy_databases=None, profile_queries=False):
+    """
+    Returns the process-wide Storage for a database file, creating it on first use.
+
+    Args:
+        db_path (str): Path of the unified database file. Defaults to the configured store.
+        legacy_databases (tuple): Legacy files imported if the store is created. Ignored
+            when the storage already exists.
+        profile_queries (bool): Whether the storage records statement latencies. Ignored
+            when the storage already exists.
+
+    Returns:
+        Storage: The shared storage instance.
+    """
+    db_path = db_path or get_config().db_path
+    with _shared_lock:
+        storage = _shared_storages.get(db_path)
+        if storage is None:
+            storage = Storage(db_path, legacy_databases=legacy_databases, profile_queries=profile_queries)
+            _shared_storages[db_path] = storage
+        return storage
+
+
+if __name__ == '__main__':
+    # Creates the unified store, or brings an existing one up to the latest
+    # schema. A new store imports the legacy per-table database files.
+    import sys
+    from src.config import setup_logging
+    setup_logging()
+    db_path = sys.argv[1] if len(sys.argv) > 1 else None
+    storage = Storage(db_path)
+    with storage.connection() as conn:
+        version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    storage.close()
+    print(f"{storage.db_path} is at schema version {version}")
@@ -0,0 +1,280 @@
+import math
+import time
+import bisect
+import sqlite3
+import logging
+import threading
+import weakref
+from src.storage import get_storage
+from src.metrics import CACHE_REQUESTS
+logger = logging.getLogger(__name__)
+
+
+MINUTES_PER_DAY = 1440
+
+
+class TariffSchedule:
+    """
+    A vehicle type's tariff compiled into a lookup structure.
+
+    The day is split into segments at every band boundary. Hourly segments
+    carry a prefix sum of their cost from midnight, so the cost of any
+    interval is a difference of two lookups. Flat bands are charged once per
+    occurrence the stay overlaps, which is counted arithmetically. Whole
+    24-hour windows all cost the same, so a multi-day stay is priced in
+    O(number of bands) however long it is.
+
+    Attributes:
+        vehicle_type (str): The type of vehicle.
+        rate (float): Base hourly rate, used outside any band.
+        grace_minutes (float): Stays up to this long are free.
+        rounding_minutes (float): Billable time is rounded up to a multiple of this. 0 bills exact time.
+        daily_max (float): Cap on the charge for each 24 hours from entry, or None.
+    """
+    def __init__(self, vehicle_type, rate, grace_minutes=0, rounding_minutes=0, daily_max=None, bands=()):
+        """
+        Initializes the TariffSchedule class.
+
+        Args:
+            vehicle_type (str): The type of vehicle.
+            rate (float): Base hourly rate.
+            grace_minutes (float): Stays up to this long are free.
+            rounding_minutes (float): Rounding unit for billable time, 0 for none.
+            daily_max (float): Cap per 24 hours from entry, or None.
+            bands (iterable): (start_minute, end_minute, amount, is_flat) tuples in minutes
+                from midnight. A band with end before start runs overnight. Hourly
+                bands replace the base rate, flat bands charge amount once per
+                occurrence. Bands should not overlap; if they do, the later one wins.
+        """
+        self.vehicle_type = vehicle_type
+        self.rate = rate or 0
+        self.grace_minutes = grace_minutes or 0
+        self.rounding_minutes = rounding_minutes or 0
+        self.daily_max = daily_max
+        self.flat_bands = []
+        hourly_bands = []
+        for start, end, amount, is_flat in bands:
+            length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+            pieces = [(start, start + length)] if start + length <= MINUTES_PER_DAY else \
+                [(start, MINUTES_PER_DAY), (0, start + length - MINUTES_PER_DAY)]
+            if is_flat:
+                self.flat_bands.append((start, length, amount))
+            for piece_start, piece_end in pieces:
+                hourly_bands.append((piece_start, piece_end, 0 if is_flat else amount))
+        self.has_bands = bool(hourly_bands)
+        self._compile(hourly_bands)
+
+    def _compile(self, hourly_bands):
+        breakpoints = sorted({0, MINUTES_PER_DAY} | {b for band in hourly_bands for b in band[:2]})
+        self.starts = breakpoints[:-1]
+        self.rates = []
+        self.cumulative = []
+        total = 0.0
+        for start, end in zip(breakpoints, breakpoints[1:]):
+            middle = (start + end) / 2
+            rate = self.rate
+            for band_start, band_end, band_rate in hourly_bands:
+                if band_start <= middle < band_end:
+                    rate = band_rate
+            self.rates.append(rate)
+            self.cumulative.append(total)
+            total += rate * (end - start) / 60
+        self.day_cost = total
+
+    def _hourly_until(self, t):
+        day, minute = divmod(t, MINUTES_PER_DAY)
+        i = bisect.bisect_right(self.starts, minute) - 1
+        return day * self.day_cost + self.cumulative[i] + self.rates[i] * (minute - self.starts[i]) / 60
+
+    def _flat_charges(self, a, b, first):
+        total = 0.0
+        for start, length, amount in self.flat_bands:
+            k_max = math.ceil((b - start) / MINUTES_PER_DAY) - 1
+            k_min = math.floor((a - start - length) / MINUTES_PER_DAY) + 1
+            count = max(0, k_max - k_min + 1)
+            if not first and 0 < (a - start) % MINUTES_PER_DAY < length:
+                # Already charged in the previous window.
+                count -= 1
+            total += count * amount
+        return total
+
+    def _window_cost(self, a, b, first):
+        cost = self._hourly_until(b) - self._hourly_until(a) + self._flat_charges(a, b, first)
+        if self.daily_max is not None:
+            cost = min(cost, self.daily_max)
+        return cost
+
+    def billable_minutes(self, minutes):
+        """
+        Applies the grace period and rounding to a stay length.
+
+        Args:
+            minutes (float): Length of the stay in minutes.
+
+        Returns:
+            float: Minutes to bill, 0 if the stay is within the grace period.
+        """
+        if minutes <= self.grace_minutes:
+            return 0.0
+        if self.rounding_minutes:
+            return math.ceil(minutes / self.rounding_minutes) * self.rounding_minutes
+        return minutes
+
+    def price(self, net_time, in_time=None):
+        """
+        Prices a stay.
+
+        Args:
+            net_time (datetime.timedelta): The duration of parking.
+            in_time (datetime.datetime): Entry time. Only its time of day is used, and
+                only when the schedule has bands.
+
+        Returns:
+            float: The price of the stay.
+        """
+        minutes = self.billable_minutes(net_time.total_seconds() / 60)
+        if not minutes:
+            return 0.0
+        if not self.has_bands and self.daily_max is None:
+            return self.rate * minutes / 60
+        start = 0.0
+        if in_time is not None:
+            start = in_time.hour * 60 + in_time.minute + in_time.second / 60
+        end = start + minutes
+        full_days = int(minutes // MINUTES_PER_DAY)
+        if full_days == 0:
+            return self._window_cost(start, end, True)
+        total = self._window_cost(start, start + MINUTES_PER_DAY, True)
+        if full_days > 1:
+            total += (full_days - 1) * self._window_cost(start + MINUTES_PER_DAY, start + 2 * MINUTES_PER_DAY, False)
+        tail_start = start + full_days * MINUTES_PER_DAY
+        if end > tail_start:
+            total += self._window_cost(tail_start, end, False)
+        return total
+
+
+class TariffCache:
+    """
+    An in-process copy of the parking_prices table keyed by vehicle type.
+
+    Rates change rarely, so exit pricing reads them from memory. The table is
+    reloaded when the cache is invalidated (Admin.update_prices does this) or
+    when the copy is older than ttl seconds, which picks up changes made by
+    other processes.
+
+    Attributes:
+        storage (Storage): The shared storage holding the prices table.
+        ttl (float): Seconds a loaded copy stays valid.
+    """
+    def __init__(self, storage=None, ttl=60.0):
+        """
+        Initializes the TariffCache class. The table is loaded on first use.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+            ttl (float): Seconds a loaded copy stays valid.
+        """
+        self.storage = storage or get_storage()
+        self.ttl = ttl
+        self._rates = {}
+        self._schedules = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Reloads every tariff from the database and compiles its schedule.
+        """
+        with self._lock:
+            try:
+                with self.storage.connection() as conn:
+                    rows = conn.execute("SELECT vehicle_type, amount, grace_minutes, rounding_minutes, daily_max FROM parking_prices;").fetchall()
+                    band_rows = conn.execute("SELECT vehicle_type, start_minute, end_minute, amount, is_flat FROM tariff_bands;").fetchall()
+                bands = {}
+                for vehicle_type, *band in band_rows:
+                    bands.setdefault(vehicle_type, []).append(band)
+                self._schedules = {
+                    vehicle_type: TariffSchedule(vehicle_type, amount, grace, rounding, daily_max, bands.get(vehicle_type, ()))
+                    for vehicle_type, amount, grace, rounding, daily_max in rows
+                }
+                self._rates = {vehicle_type: amount for vehicle_type, amount, *_ in rows}
+                self._loaded_at = time.monotonic()
+                logger.info(f"Loaded {len(self._rates)} tariffs")
+            except sqlite3.Error as e:
+                logger.error(f"Error loading tariffs: {e}")
+
+    def invalidate(self):
+        """
+        Marks the cached rates as stale so the next read reloads them.
+        """
+        self._loaded_at = None
+
+    def _ensure_fresh(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.ttl:
+            CACHE_REQUESTS.inc(cache="tariffs", result="miss")
+            self.refresh()
+        else:
+            CACHE_REQUESTS.inc(cache="tariffs", result="hit")
+
+    def get_rate(self, vehicle_type):
+        """
+        Returns the hourly rate for a vehicle type.
+
+        Args:
+            vehicle_type (str): The type of vehicle.
+
+        Returns:
+            float: The hourly rate, or None if the vehicle type has no tariff.
+        """
+        self._ensure_fresh()
+        return self._rates.get(vehicle_type)
+
+    def get_schedule(self, vehicle_type):
+        """
+        Returns the compiled tariff schedule for a vehicle type.
+
+        Args:
+            vehicle_type (str): The type of vehicle.
+
+        Returns:
+            TariffSchedule: The schedule, or None if the vehicle type has no tariff.
+        """
+        self._ensure_fresh()
+        return self._schedules.get(vehicle_type)
+
+    def get_rates(self):
+        """
+        Returns every rate.
+
+        Returns:
+            dict: Hourly rates keyed by vehicle type.
+        """
+        self._ensure_fresh()
+        return dict(self._rates)
+
+
+_tariff_caches = weakref.WeakKeyDictionary()
+_tariff_lock = threading.Lock()
+
+
+def get_tariff_cache(storage=None):
+    """
+    Returns the tariff cache shared by everything using the same storage.
+
+    Sharing the cache means an Admin price change is seen by the gates in
+    the same process straight away.
+
+    Args:
+        storage (Storage): The storage the prices live in. Defaults to the shared store.
+
+    Returns:
+        TariffCache: The shared cache.
+    """
+    storage = storage or get_storage()
+    with _tariff_lock:
+        cache = _tariff_caches.get(storage)
+        if cache is None:
+            cache = TariffCache(storage)
+            _tariff_caches[storage] = cache
+        return cache
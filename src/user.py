@@ -1,8 +1,12 @@
-from paths import * 
 import sqlite3
+import time
+import threading
+from collections import OrderedDict
+from src.storage import get_storage
+from src.history import TicketHistory
+from src.ledger import post, post_many, TOP_UP
+from src.metrics import timed, CACHE_REQUESTS
 import logging
-# Configure the logger
-logging.basicConfig(level=logging.INFO, filename='logs\\user.log', filemode='a', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class User:
@@ -11,40 +15,24 @@ class User:
 
     Attributes:
         user_id (int): The ID of the user.
-        users_db (sqlite3.Connection): Connection to the users database.
-        cursor_users (sqlite3.Cursor): Cursor for executing SQL queries on the users database.
-        parking_tickets_db (sqlite3.Connection): Connection to the parking tickets database.
-        cursor_parking_ticket (sqlite3.Cursor): Cursor for executing SQL queries on the parking tickets database.
+        storage (Storage): The shared storage holding balances and tickets.
     """
-    def __init__(self, user_id, users_db_name=users_db_path, parking_tickets=parking_tickets_path):
+    def __init__(self, user_id, storage=None):
         """
         Initializes the User class.
 
         Args:
             user_id (int): The ID of the user.
-            users_db_name (str): The name of the users database file.
+            storage (Storage): The storage to use. Defaults to the shared store.
         """
         try:
             self.user_id = user_id
-            self.users_db = sqlite3.connect(users_db_name)
-            self.cursor_users = self.users_db.cursor()
-            self.parking_tickets_db = sqlite3.connect(parking_tickets)
-            self.cursor_parking_ticket = self.parking_tickets_db.cursor()
-            logger.info(f"User {user_id} connected to databases")
+            self.storage = storage or get_storage()
+            logger.info(f"User {user_id} using the shared storage")
         except sqlite3.Error as e:
             logger.error(f"Error connecting to database: {e}")
 
-    def __del__(self):
-        """
-        Closes all database connections when the object is deleted.
-        """
-        try:
-            self.users_db.close()
-            self.parking_tickets_db.close()
-            logger.info("User databases closed")
-        except sqlite3.Error as e:
-            logger.error(f"Error closing database connection: {e}")
-
+    @timed("User.get_balance")
     def get_balance(self):
         """
         Retrieves the balance of the user.
@@ -53,9 +41,11 @@ class User:
             float: The balance of the user.
         """
         try:
-            get_query = f"SELECT amount FROM user_data WHERE user_id = {self.user_id};"
-            self.cursor_users.execute(get_query)
-            balance = self.cursor_users.fetchone()[0]
+            get_query = "SELECT amount FROM user_data WHERE user_id = ?;"
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(get_query, (self.user_id,))
+                balance = cursor.fetchone()[0]
             logger.info(f"Retrieved balance for user {self.user_id}")
             return balance
         except sqlite3.Error as e:
@@ -70,30 +60,223 @@ class User:
             list: A list of tuples containing parking ticket information for the user.
         """
         try:
-            get_query = f"SELECT * FROM parking_tickets WHERE user_id = {self.user_id}"
-            self.cursor_parking_ticket.execute(get_query)
-            history = self.cursor_parking_ticket.fetchall()
+            get_query = "SELECT * FROM parking_tickets WHERE user_id = ? ORDER BY in_time;"
+            with self.storage.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(get_query, (self.user_id,))
+                history = cursor.fetchall()
             logger.info(f"Retrieved parking history for user {self.user_id}")
             return history
         except sqlite3.Error as e:
             logger.error(f"Error retrieving parking history: {e}")
             return []
 
+    def get_history_page(self, after=None, limit=100, start=None, end=None, vehicle_type=None):
+        """
+        Retrieves one page of the user's parking history.
+
+        Args:
+            after (tuple): Cursor returned with the previous page, or None for the first page.
+            limit (int): Maximum number of tickets in the page.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+            vehicle_type (str): Only tickets for this vehicle type.
+
+        Returns:
+            tuple: (rows, cursor). cursor is None when there are no more pages.
+        """
+        return TicketHistory(self.storage).page(self.user_id, after, limit, start, end, vehicle_type)
+
+    def iter_history(self, chunk_size=500, start=None, end=None, vehicle_type=None):
+        """
+        Streams the user's parking history in constant memory.
+
+        Args:
+            chunk_size (int): Number of rows fetched per query.
+            start (datetime or str): Only tickets that entered at or after this time.
+            end (datetime or str): Only tickets that entered before this time.
+            vehicle_type (str): Only tickets for this vehicle type.
+
+        Returns:
+            generator: Yields parking ticket rows in entry order.
+        """
+        return TicketHistory(self.storage).stream(self.user_id, chunk_size, start, end, vehicle_type)
+
+    @timed("User.add_balance")
     def add_balance(self, amount):
         """
         Adds balance to the user's account.
 
+        The increment happens inside a single UPDATE, so concurrent top-ups
+        can't overwrite each other, and is recorded in the balance ledger in
+        the same transaction.
+
         Args:
             amount (float): The amount to be added to the user's balance.
+
+        Returns:
+            float: The new balance, or None if the user doesn't exist.
         """
         try:
-            self.cursor_users.execute(f"SELECT amount FROM user_data WHERE user_id = {self.user_id};")
-            current_amount = self.cursor_users.fetchone()[0]
-            final_balance = current_amount + amount
-            update_query = f"UPDATE user_data SET amount = {final_balance} WHERE user_id = {self.user_id};"
-            self.cursor_users.execute(update_query)
-            self.users_db.commit()
+            with self.storage.transaction() as conn:
+                final_balance = post(conn, self.user_id, amount, TOP_UP)
+            if final_balance is None:
+                logger.warning(f"User {self.user_id} not found, balance not added")
+                return None
             logger.info(f"Added balance {amount} to user {self.user_id}. New balance is {final_balance}")
+            return final_balance
         except sqlite3.Error as e:
             logger.error(f"Error adding balance: {e}")
 
+
+class UserRepository:
+    """
+    A long-lived user service that reuses pooled connections and caches balances.
+
+    The cache is a bounded LRU of balances keyed by user id. Writes made
+    through the repository invalidate the entry, so a read after a top-up
+    always goes back to the database. A read that raced with such a write
+    isn't cached, and entries expire after ttl seconds, which picks up
+    writes made by other processes.
+
+    Attributes:
+        storage (Storage): The shared storage holding balances and tickets.
+        cache_size (int): Maximum number of balances kept in memory.
+        ttl (float): Seconds a cached balance stays valid.
+    """
+    def __init__(self, storage=None, cache_size=10000, ttl=5.0):
+        """
+        Initializes the UserRepository class.
+
+        Args:
+            storage (Storage): The storage to use. Defaults to the shared store.
+            cache_size (int): Maximum number of balances kept in memory.
+            ttl (float): Seconds a cached balance stays valid.
+        """
+        self.storage = storage or get_storage()
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._balances = OrderedDict()
+        # Maps a user id to a token for the database read in flight. Invalidating
+        # drops it, so a read that started before a write isn't cached.
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_user(self, user_id):
+        """
+        Returns a User bound to the repository's storage.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            User: The user.
+        """
+        return User(user_id, self.storage)
+
+    @timed("UserRepository.get_balance")
+    def get_balance(self, user_id):
+        """
+        Retrieves the balance of a user, serving hot users from the cache.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            float: The balance of the user, or None if the user doesn't exist.
+        """
+        user_id = int(user_id)
+        with self._lock:
+            cached = self._balances.get(user_id)
+            if cached is not None and time.monotonic() - cached[1] <= self.ttl:
+                self._balances.move_to_end(user_id)
+                CACHE_REQUESTS.inc(cache="balances", result="hit")
+                return cached[0]
+            token = self._pending[user_id] = object()
+        CACHE_REQUESTS.inc(cache="balances", result="miss")
+        try:
+            with self.storage.connection() as conn:
+                row = conn.execute("SELECT amount FROM user_data WHERE user_id = ?;", (user_id,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving balance: {e}")
+            row = None
+        else:
+            if row is None:
+                logger.warning(f"User {user_id} not found")
+        self._remember(user_id, None if row is None else row[0], token)
+        return None if row is None else row[0]
+
+    @timed("UserRepository.add_balance")
+    def add_balance(self, user_id, amount):
+        """
+        Adds balance to a user's account and drops the cached balance.
+
+        Args:
+            user_id (int): The ID of the user.
+            amount (float): The amount to be added to the user's balance.
+
+        Returns:
+            float: The new balance, or None if the user doesn't exist.
+        """
+        balance = self.get_user(user_id).add_balance(amount)
+        self.invalidate(user_id)
+        return balance
+
+    @timed("UserRepository.bulk_add_balance")
+    def bulk_add_balance(self, top_ups):
+        """
+        Applies many top-ups in one transaction, e.g. a payment settlement file.
+
+        Either every top-up is applied or, on a database error, none are.
+
+        Args:
+            top_ups (iterable): (user_id, amount) pairs.
+
+        Returns:
+            int: The number of balances updated. Unknown user ids are skipped.
+        """
+        rows = [(int(user_id), amount) for user_id, amount in top_ups]
+        try:
+            with self.storage.transaction() as conn:
+                updated = post_many(conn, rows, TOP_UP)
+        except sqlite3.Error as e:
+            logger.error(f"Error applying bulk top-ups: {e}")
+            return 0
+        with self._lock:
+            for user_id, _ in rows:
+                self._balances.pop(user_id, None)
+                self._pending.pop(user_id, None)
+        logger.info(f"Applied {updated} of {len(rows)} top-ups")
+        return updated
+
+    def invalidate(self, user_id):
+        """
+        Drops a user's cached balance.
+
+        Args:
+            user_id (int): The ID of the user.
+        """
+        with self._lock:
+            self._balances.pop(int(user_id), None)
+            self._pending.pop(int(user_id), None)
+
+    def clear(self):
+        """
+        Drops every cached balance.
+        """
+        with self._lock:
+            self._balances.clear()
+            self._pending.clear()
+
+    def _remember(self, user_id, balance, token):
+        with self._lock:
+            if self._pending.get(user_id) is not token:
+                # Invalidated, or read again, since this read started.
+                return
+            del self._pending[user_id]
+            if balance is None:
+                return
+            self._balances[user_id] = (balance, time.monotonic())
+            self._balances.move_to_end(user_id)
+            while len(self._balances) > self.cache_size:
+                self._balances.popitem(last=False)
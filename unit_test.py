@@ -1,20 +1,51 @@
 import unittest
-from unittest.mock import MagicMock, patch
+import threading
+from unittest.mock import ANY, MagicMock
 from datetime import datetime, timedelta
 from parking_lot.src.slots import Slots
 from parking_lot.src.admin import Admin 
 from parking_lot.src.parking_gate_system import ParkingGateSystem 
-from parking_lot.src.user import User
+from parking_lot.src.user import User, UserRepository
+from parking_lot.src.storage import Storage
+from parking_lot.src.tariff import TariffSchedule
+from parking_lot.src.history import TicketHistory
+from parking_lot.src.parking import ParkingLot
+from parking_lot.src.server import GateServer
+from parking_lot.src.qr import QRCodeRenderer, render_qr
+from parking_lot.src.sharding import LotRouter
+from parking_lot.src.journal import EventJournal, replay, ticket_events
+from parking_lot.src.reports import Reports
+from parking_lot.src.rollups import Rollups
+from parking_lot.src.reservations import Reservations
+from parking_lot.src.forecast import Forecaster
+from parking_lot.src.ledger import Ledger, record_openings
+from parking_lot.src.benchmark import make_trace, run_benchmark, measure_startup
+from parking_lot.src.config import Config
+from parking_lot.src.metrics import MetricsRegistry, MetricsServer, ProfiledConnection, QUERY_SECONDS
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+import tempfile
+import urllib.request
+
+
+def make_mock_storage():
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value = mock_cursor
+    mock_storage = MagicMock()
+    mock_storage.connection.return_value.__enter__.return_value = mock_conn
+    mock_storage.transaction.return_value.__enter__.return_value = mock_conn
+    return mock_storage, mock_conn, mock_cursor
+
 
 class TestSlots(unittest.TestCase):
 
-    @patch('sqlite3.connect')
-    def setUp(self, mock_connect):
-        self.mock_conn = MagicMock()
-        self.mock_cursor = MagicMock()
-        mock_connect.return_value = self.mock_conn
-        self.mock_conn.cursor.return_value = self.mock_cursor
-        self.slots = Slots()
+    def setUp(self):
+        self.mock_storage, self.mock_conn, self.mock_cursor = make_mock_storage()
+        self.slots = Slots(self.mock_storage)
 
     def test_return_all_available_slots(self):
         self.mock_cursor.fetchall.return_value = [(1,), (2,)]
@@ -26,10 +57,10 @@ class TestSlots(unittest.TestCase):
         self.mock_cursor.rowcount = 1
         self.slots.book_slot(1)
         self.mock_cursor.execute.assert_called_with('''
-            UPDATE parking_slots 
-            SET status="occupied" 
-            WHERE slot_number=? AND status="free"
-        ''', (1,))
+                    UPDATE parking_slots
+                    SET status="occupied"
+                    WHERE slot_number=? AND status="free"
+                ''', (1,))
         self.mock_conn.commit.assert_called_once()
 
     def test_book_slot_error(self):
@@ -41,10 +72,10 @@ class TestSlots(unittest.TestCase):
         self.mock_cursor.rowcount = 1
         self.slots.release_slot(1)
         self.mock_cursor.execute.assert_called_with('''
-            UPDATE parking_slots 
-            SET status="free" 
-            WHERE slot_number=? AND status="occupied"
-        ''', (1,))
+                    UPDATE parking_slots
+                    SET status="free"
+                    WHERE slot_number=? AND status="occupied"
+                ''', (1,))
         self.mock_conn.commit.assert_called_once()
 
     def test_release_slot_error(self):
@@ -58,102 +89,238 @@ class TestSlots(unittest.TestCase):
         self.assertEqual(occupied_slots, [(1,), (2,)])
         self.mock_cursor.execute.assert_called_with('SELECT slot_number FROM parking_slots WHERE status="occupied"')
 
+    def test_next_free_slot(self):
+        self.mock_cursor.fetchall.return_value = [(3, 'free', 'car', 0, None), (1, 'free', 'car', 0, None), (2, 'free', 'car', 0, None), (4, 'occupied', 'car', 0, None)]
+        self.slots.load_free_slots()
+        self.assertEqual(self.slots.next_free_slot(), 1)
+        self.mock_cursor.rowcount = 1
+        self.slots.book_slot(1)
+        self.assertEqual(self.slots.next_free_slot(), 2)
+        self.slots.release_slot(1)
+        self.assertEqual(self.slots.next_free_slot(), 1)
+
+    def test_occupancy_counts(self):
+        self.mock_cursor.fetchall.return_value = [(1, 'free', 'car', 0, None), (2, 'free', 'car', 0, None), (9, 'occupied', 'truck', 1, 'B')]
+        self.slots.load_free_slots()
+        events = []
+        self.slots.occupancy.subscribe(lambda slot, occupied, version: events.append((slot, occupied)))
+        self.assertEqual(self.slots.take_free_slot(), 1)
+        self.assertEqual(self.slots.occupancy.counts(), (1, 2))
+        self.slots.mark_free(9)
+        self.slots.mark_free(9)
+        self.slots.mark_occupied(42)
+        self.assertEqual(events, [(1, True), (9, False)])
+        self.assertEqual(self.slots.occupancy.snapshot()['bitmap'], b'\x02\x00')
+        self.assertEqual(self.slots.occupancy.counts('level', 1), (1, 0))
+
+    def test_best_fit_allocation(self):
+        self.mock_cursor.fetchall.return_value = [
+            (5, 'free', 'truck', 0, None), (7, 'free', 'van', 2, 'A'), (3, 'free', 'van', 1, 'A'),
+            (9, 'free', 'car', 2, 'B'), (8, 'free', 'car', 2, 'A'), (1, 'free', 'motorcycle', 0, None)]
+        self.slots.load_free_slots()
+        self.assertEqual(self.slots.next_free_slot('Van', level=2), 7)
+        self.assertEqual(self.slots.take_free_slot('Car', level=2), 8)
+        self.assertEqual(self.slots.take_free_slot('Car', level=2), 9)
+        self.assertEqual(self.slots.take_free_slot('Car', level=2), 7)
+        self.assertIsNone(self.slots.take_free_slot('Car', level=2))
+        self.assertIsNone(self.slots.take_free_slot('Car', fallback=False))
+        self.assertEqual(self.slots.take_free_slot('Truck'), 5)
+        self.assertEqual(self.slots.take_free_slot(), 1)
+
+    def test_next_free_slot_empty(self):
+        self.mock_cursor.fetchall.return_value = []
+        self.slots.load_free_slots()
+        self.assertIsNone(self.slots.next_free_slot())
+
     def tearDown(self):
         self.slots.close_connection()
 
 
 class TestAdmin(unittest.TestCase):
 
-    @patch('sqlite3.connect')
-    def setUp(self, mock_connect):
-        self.mock_conn = MagicMock()
-        self.mock_cursor = MagicMock()
-        mock_connect.return_value = self.mock_conn
-        self.mock_conn.cursor.return_value = self.mock_cursor
-        self.admin = Admin()
+    def setUp(self):
+        self.mock_storage, self.mock_conn, self.mock_cursor = make_mock_storage()
+        self.admin = Admin(self.mock_storage)
 
     def test_get_prices(self):
-        self.mock_cursor.fetchall.return_value = [('car', 10), ('bike', 5)]
+        self.mock_conn.execute.return_value.fetchall.side_effect = [[('car', 10, 0, 0, None), ('bike', 5, 0, 0, None)], []]
         prices = self.admin.get_prices()
         self.assertEqual(prices, [('car', 10), ('bike', 5)])
-        self.mock_cursor.execute.assert_called_with("SELECT * FROM parking_prices")
+        self.mock_conn.execute.assert_any_call("SELECT vehicle_type, amount, grace_minutes, rounding_minutes, daily_max FROM parking_prices;")
+
+    def test_get_prices_cached(self):
+        self.mock_conn.execute.return_value.fetchall.side_effect = [[('car', 10, 0, 0, None)], []]
+        self.admin.get_prices()
+        self.admin.get_prices()
+        self.assertEqual(self.mock_conn.execute.call_count, 2)
 
     def test_update_prices_new_vehicle(self):
         self.admin.get_prices = MagicMock(return_value=[('car', 10)])
         self.admin.update_prices('bike', 5)
-        self.mock_cursor.execute.assert_called_with('INSERT INTO parking_prices VALUES (?,?);', ('bike', 5))
+        self.mock_cursor.execute.assert_called_with('INSERT INTO parking_prices (vehicle_type, amount) VALUES (?,?);', ('bike', 5))
         self.mock_conn.commit.assert_called_once()
+        self.assertIsNone(self.admin.tariffs._loaded_at)
 
     def test_get_users_info(self):
         self.mock_cursor.fetchall.return_value = [(1, '2022-01-01', None, 'car', 1)]
         user_info = self.admin.get_users_info(1)
         self.assertEqual(user_info, [(1, '2022-01-01', None, 'car', 1)])
-        self.mock_cursor.execute.assert_called_with("SELECT * FROM parking_tickets WHERE user_id = 1")
+        self.mock_cursor.execute.assert_called_with("SELECT * FROM parking_tickets WHERE user_id = ? ORDER BY in_time;", (1,))
 
     def test_add_new_user(self):
-        self.mock_cursor.fetchone.return_value = [1]
-        new_user_id = self.admin.add_new_user(50.0)
-        self.assertEqual(new_user_id, 2)
-        self.mock_cursor.execute.assert_called_with("INSERT INTO user_data (user_id, amount) VALUES (?, ?);", (2, 50.0))
-        self.mock_conn.commit.assert_called_once()
+        self.admin.qr_renderer = MagicMock()
+        self.admin.qr_renderer.path_for.return_value = 'qr.png'
+        self.mock_conn.execute.return_value.fetchone.return_value = [2]
+        new_user_id, qr_path = self.admin.add_new_user('Ann', 'ann@example.com', '555', 50.0)
+        self.assertEqual((new_user_id, qr_path), (2, 'qr.png'))
+        self.mock_conn.executemany.assert_any_call("INSERT INTO user_data (user_id, amount) VALUES (?, ?);", [(2, 50.0)])
+        self.mock_conn.executemany.assert_called_with(
+            "INSERT INTO balance_ledger (user_id, amount, kind, ticket_id, created_at) VALUES (?, ?, ?, ?, ?);", [(2, 50.0, 'opening', None, ANY)])
+        self.admin.qr_renderer.submit_many.assert_called_once_with(['2'])
+
+
+class TestAdminOccupancy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_slots (slot_number, status) VALUES (?, 'free')", [(slot,) for slot in range(1, 6)])
+
+    def test_sees_gate_changes(self):
+        admin = Admin(self.storage)
+        self.assertEqual(admin.get_occupancy(), (5, 0))
+        lot = ParkingLot(self.storage)
+        lot.park_vehicle(1, 'Car')
+        ticket_id = lot.park_vehicle(2, 'Car')
+        self.assertEqual(admin.get_occupancy(), (3, 2))
+        lot.leave_parking(ticket_id)
+        self.assertEqual(admin.get_occupancy(), (4, 1))
+        lot.gate_system.close()
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmp_dir.cleanup()
 
 
 class TestUser(unittest.TestCase):
 
-    @patch('sqlite3.connect')
-    def setUp(self, mock_connect):
-        self.mock_conn = MagicMock()
-        self.mock_cursor = MagicMock()
-        mock_connect.return_value = self.mock_conn
-        self.mock_conn.cursor.return_value = self.mock_cursor
-        self.user = User(1)
+    def setUp(self):
+        self.mock_storage, self.mock_conn, self.mock_cursor = make_mock_storage()
+        self.user = User(1, self.mock_storage)
 
     def test_get_balance(self):
         self.mock_cursor.fetchone.return_value = [100.0]
         balance = self.user.get_balance()
         self.assertEqual(balance, 100.0)
-        self.mock_cursor.execute.assert_called_with("SELECT amount FROM user_data WHERE user_id = 1;")
+        self.mock_cursor.execute.assert_called_with("SELECT amount FROM user_data WHERE user_id = ?;", (1,))
 
     def test_get_all_history(self):
         self.mock_cursor.fetchall.return_value = [(1, '2022-01-01', None, 'car', 1)]
         history = self.user.get_all_history()
         self.assertEqual(history, [(1, '2022-01-01', None, 'car', 1)])
-        self.mock_cursor.execute.assert_called_with("SELECT * FROM parking_tickets WHERE user_id = 1")
+        self.mock_cursor.execute.assert_called_with("SELECT * FROM parking_tickets WHERE user_id = ? ORDER BY in_time;", (1,))
 
     def test_add_balance(self):
+        self.mock_conn.execute.return_value.fetchone.return_value = (150.0,)
+        balance = self.user.add_balance(50.0)
+        self.assertEqual(balance, 150.0)
+        self.mock_conn.execute.assert_any_call("UPDATE user_data SET amount = amount + ? WHERE user_id = ? RETURNING amount;", (50.0, 1))
+        self.mock_conn.execute.assert_called_with(
+            "INSERT INTO balance_ledger (user_id, amount, kind, ticket_id, created_at) VALUES (?, ?, ?, ?, ?);", (1, 50.0, 'top_up', None, ANY))
+        self.mock_storage.transaction.assert_called_once()
+
+
+class TestUserRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_storage, self.mock_conn, self.mock_cursor = make_mock_storage()
+        self.repository = UserRepository(self.mock_storage, cache_size=2)
+
+    def test_get_balance_cached(self):
+        self.mock_conn.execute.return_value.fetchone.return_value = (100.0,)
+        self.assertEqual(self.repository.get_balance(1), 100.0)
+        self.assertEqual(self.repository.get_balance(1), 100.0)
+        self.mock_conn.execute.assert_called_once_with("SELECT amount FROM user_data WHERE user_id = ?;", (1,))
+
+    def test_add_balance_invalidates(self):
+        self.mock_conn.execute.return_value.fetchone.return_value = (100.0,)
+        self.repository.get_balance(1)
         self.mock_cursor.fetchone.return_value = [100.0]
-        self.user.add_balance(50.0)
-        self.mock_cursor.execute.assert_called_with("UPDATE user_data SET amount = 150.0 WHERE user_id = 1;")
-        self.mock_conn.commit.assert_called_once()
+        self.repository.add_balance(1, 50.0)
+        self.mock_conn.execute.return_value.fetchone.return_value = (150.0,)
+        self.assertEqual(self.repository.get_balance(1), 150.0)
+
+    def test_read_racing_a_write_is_not_cached(self):
+        def read_then_write(*args):
+            self.repository.invalidate(1)
+            return MagicMock(fetchone=MagicMock(return_value=(100.0,)))
+        self.mock_conn.execute.side_effect = read_then_write
+        self.assertEqual(self.repository.get_balance(1), 100.0)
+        self.assertEqual(self.repository._balances, {})
+        self.assertEqual(self.repository._pending, {})
+
+    def test_cache_expires(self):
+        self.repository.ttl = 0
+        self.mock_conn.execute.return_value.fetchone.return_value = (100.0,)
+        self.repository.get_balance(1)
+        self.repository.get_balance(1)
+        self.assertEqual(self.mock_conn.execute.call_count, 2)
+
+    def test_cache_is_bounded(self):
+        self.mock_conn.execute.return_value.fetchone.return_value = (10.0,)
+        for user_id in (1, 2, 3):
+            self.repository.get_balance(user_id)
+        self.assertEqual(list(self.repository._balances), [2, 3])
+
+    def test_bulk_add_balance(self):
+        self.mock_conn.executemany.return_value.rowcount = 2
+        updated = self.repository.bulk_add_balance([(1, 10.0), (2, 20.0)])
+        self.assertEqual(updated, 2)
+        self.mock_conn.executemany.assert_any_call("UPDATE user_data SET amount = amount + ? WHERE user_id = ?;", [(10.0, 1), (20.0, 2)])
+        self.assertEqual(self.mock_conn.executemany.call_count, 2)
+
+    def test_unknown_user(self):
+        self.mock_conn.execute.return_value.fetchone.return_value = None
+        self.assertIsNone(self.repository.get_balance(99))
 
 
 class TestParkingGateSystem(unittest.TestCase):
 
-    @patch('sqlite3.connect')
-    def setUp(self, mock_connect):
-        self.mock_conn = MagicMock()
-        self.mock_cursor = MagicMock()
-        mock_connect.return_value = self.mock_conn
-        self.mock_conn.cursor.return_value = self.mock_cursor
-        self.gate_system = ParkingGateSystem()
+    def setUp(self):
+        self.mock_storage, self.mock_conn, self.mock_cursor = make_mock_storage()
+        self.gate_system = ParkingGateSystem(self.mock_storage)
 
     def test_get_price(self):
-        self.mock_cursor.fetchone.return_value = [60]
+        self.mock_conn.execute.return_value.fetchall.side_effect = [[('car', 60, 0, 0, None)], []]
         net_time = timedelta(minutes=10)
         price = self.gate_system.get_price(net_time, 'car')
-        self.assertEqual(price, 60.0)
-        self.mock_cursor.execute.assert_called_with("SELECT amount FROM parking_prices WHERE vehicle_type = ?", ('car',))
+        self.assertEqual(price, 10.0)
+
+    def test_get_price_unknown_vehicle(self):
+        self.mock_conn.execute.return_value.fetchall.side_effect = [[('car', 60, 0, 0, None)], []]
+        self.assertEqual(self.gate_system.get_price(timedelta(hours=1), 'boat'), 0.0)
+
+    def test_price_many(self):
+        self.mock_conn.execute.return_value.fetchall.side_effect = [[('car', 60, 0, 0, None), ('van', 120, 0, 0, None)], []]
+        prices = self.gate_system.price_many([timedelta(minutes=30), timedelta(hours=2), timedelta(hours=1)], ['car', 'van', 'boat'])
+        self.assertEqual(prices, [30.0, 240.0, 0.0])
 
     def test_add_out_time(self):
-        self.mock_cursor.fetchone.side_effect = [
-            ('2022-01-01 12:00:00', 1, 'car'),
-            [60]
-        ]
+        in_time = (datetime.now() - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+        self.mock_cursor.fetchone.return_value = (in_time, 1, 'car', 5)
+        self.mock_conn.execute.return_value.fetchone.return_value = (40.0,)
+        self.gate_system.get_price = MagicMock(return_value=60.0)
         price = self.gate_system.add_out_time(1)
         self.assertEqual(price, 60.0)
-        self.mock_cursor.execute.assert_called_with("UPDATE parking_tickets SET out_time = ? WHERE ticket_id = ? AND out_time IS NULL;", (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 1))
-        self.mock_conn.commit.assert_called_once()
-        self.mock_cursor.execute.assert_called_with("SELECT in_time, slot, vehicle_type FROM parking_tickets WHERE ticket_id = ?;", (1,))
+        self.mock_cursor.execute.assert_any_call("UPDATE parking_tickets SET out_time = ? WHERE ticket_id = ? AND out_time IS NULL RETURNING in_time, slot, vehicle_type, user_id;", (ANY, 1))
+        self.mock_conn.execute.assert_any_call("UPDATE user_data SET amount = amount + ? WHERE user_id = ? RETURNING amount;", (-60.0, 5))
+        self.assertEqual(self.gate_system.slots_manager.next_free_slot(), 1)
+
+    def test_add_out_time_closed_ticket(self):
+        self.mock_cursor.fetchone.return_value = None
+        self.assertEqual(self.gate_system.add_out_time(1), 0.0)
+        self.assertIsNone(self.gate_system.slots_manager.next_free_slot())
 
     def test_show_free_slots(self):
         self.gate_system.slots_manager.return_all_available_slots = MagicMock(return_value=[(1,), (2,)])
@@ -161,12 +328,724 @@ class TestParkingGateSystem(unittest.TestCase):
         self.assertEqual(free_slots, [(1,), (2,)])
 
     def test_create_new_ticket(self):
-        self.gate_system.slots_manager.return_all_available_slots = MagicMock(return_value=[(1,)])
+        self.gate_system.slots_manager.take_free_slot = MagicMock(return_value=1)
+        self.mock_cursor.lastrowid = 7
         ticket_id = self.gate_system.create_new_ticket(1, 'car')
-        self.assertIsNotNone(ticket_id)
-        self.mock_cursor.execute.assert_called_with("INSERT INTO parking_tickets (user_id, in_time, out_time, vehicle_type, slot) VALUES (?, ?, NULL, ?, ?);", (1, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'car', 1))
-        self.mock_conn.commit.assert_called_once()
-        self.gate_system.slots_manager.book_slot.assert_called_once_with(1)
+        self.assertEqual(ticket_id, 7)
+        self.mock_cursor.execute.assert_called_with("INSERT INTO parking_tickets (user_id, in_time, out_time, vehicle_type, slot) VALUES (?, ?, NULL, ?, ?);", (1, ANY, 'car', 1))
+        self.mock_storage.transaction.assert_called_once()
+
+    def test_create_new_ticket_slot_taken(self):
+        self.gate_system.slots_manager.take_free_slot = MagicMock(side_effect=[1, None])
+        self.gate_system.slots_manager.load_free_slots = MagicMock()
+        self.mock_cursor.rowcount = 0
+        result = self.gate_system.create_new_ticket(1, 'car')
+        self.assertEqual(result, "No empty slots available")
+        self.gate_system.slots_manager.load_free_slots.assert_called_once()
+
+    def test_create_new_ticket_retries_exhausted(self):
+        self.gate_system.slots_manager.take_free_slot = MagicMock(return_value=1)
+        self.gate_system.slots_manager.load_free_slots = MagicMock()
+        self.mock_cursor.rowcount = 0
+        self.assertEqual(self.gate_system.create_new_ticket(1, 'car'), "No empty slots available")
+        self.assertEqual(self.gate_system.slots_manager.take_free_slot.call_count, self.gate_system.max_claim_retries)
+
+
+class TestGateProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp_dir.name, 'parking.db')
+        self.storages = [Storage(db_path, legacy_databases=()), Storage(db_path, legacy_databases=())]
+        with self.storages[0].transaction() as conn:
+            conn.execute("INSERT INTO parking_slots (slot_number, status) VALUES (1, 'free')")
+        self.gates = [ParkingGateSystem(storage) for storage in self.storages]
+
+    def test_sees_slots_freed_by_another_gate(self):
+        first, second = self.gates
+        ticket_id = first.create_new_ticket(1, 'Car')
+        self.assertIsInstance(ticket_id, int)
+        second.add_out_time(ticket_id)
+        self.assertIsInstance(first.create_new_ticket(2, 'Car'), int)
+
+    def tearDown(self):
+        for gate, storage in zip(self.gates, self.storages):
+            gate.close()
+            storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_slots (slot_number, status) VALUES (?, 'free')", [(slot,) for slot in range(1, 21)])
+        self.gate_system = ParkingGateSystem(self.storage, group_commit_window=0.005)
+
+    def test_concurrent_tickets(self):
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            tickets = list(executor.map(lambda user_id: self.gate_system.create_new_ticket(user_id, 'Car'), range(25)))
+        issued = [ticket for ticket in tickets if isinstance(ticket, int)]
+        self.assertEqual(len(issued), 20)
+        self.assertEqual(len(set(issued)), 20)
+        with self.storage.connection() as conn:
+            occupied = conn.execute("SELECT COUNT(*) FROM parking_slots WHERE status = 'occupied'").fetchone()[0]
+            slots = conn.execute("SELECT COUNT(DISTINCT slot) FROM parking_tickets").fetchone()[0]
+        self.assertEqual((occupied, slots), (20, 20))
+
+    def test_failed_operation_is_isolated(self):
+        def failing(conn):
+            conn.execute("UPDATE parking_slots SET status = 'occupied' WHERE slot_number = 2")
+            raise ValueError("boom")
+        with self.assertRaises(ValueError):
+            self.gate_system.run_write(failing)
+        self.assertIsNotNone(self.gate_system.claim_slot_and_issue_ticket(1, 'Car', 2))
+
+    def test_submit_after_close(self):
+        committer = self.gate_system.committer
+        self.gate_system.close()
+        with self.assertRaises(RuntimeError):
+            committer.submit(lambda conn: None)
+
+    def tearDown(self):
+        self.gate_system.close()
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestEventJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.tmp_dir.name, 'gate.journal')
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_slots (slot_number, status) VALUES (?, 'free')", [(1,), (2,), (3,)])
+            conn.execute("INSERT INTO parking_prices (vehicle_type, amount) VALUES ('Car', 60)")
+        self.gate_system = ParkingGateSystem(self.storage, journal_path=self.journal_path)
+
+    def test_replay_rebuilds_state(self):
+        first = self.gate_system.create_new_ticket(1, 'Car')
+        self.gate_system.create_new_ticket(2, 'Car')
+        self.gate_system.add_out_time(first)
+        self.assertTrue(self.gate_system.journal.flush(timeout=5))
+        state = replay(self.journal_path)
+        self.assertEqual(state.slots, {1: False, 2: True})
+        self.assertEqual(state.tickets[first]['price'], 0.0)
+        self.assertEqual([record['type'] for record in ticket_events(self.journal_path, first)], ['entry', 'exit', 'price'])
+
+    def test_apply_keeps_prices(self):
+        first = self.gate_system.create_new_ticket(1, 'Car')
+        second = self.gate_system.create_new_ticket(2, 'Car')
+        with self.storage.transaction() as conn:
+            conn.execute("UPDATE parking_tickets SET in_time = ? WHERE ticket_id = ?",
+                         ((datetime.now() - timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S'), first))
+        price = self.gate_system.add_out_time(first)
+        self.assertTrue(self.gate_system.journal.flush(timeout=5))
+        replay(self.journal_path).apply_to(self.storage)
+        with self.storage.connection() as conn:
+            self.assertEqual(conn.execute("SELECT ticket_id, price FROM parking_tickets ORDER BY ticket_id").fetchall(),
+                             [(first, price), (second, None)])
+        self.assertAlmostEqual(price, 120.0, delta=1)
+
+    def test_snapshot_and_tail(self):
+        self.gate_system.create_new_ticket(1, 'Car')
+        self.gate_system.journal.flush()
+        snapshot_path = os.path.join(self.tmp_dir.name, 'gate.snapshot')
+        replay(self.journal_path).save(snapshot_path)
+        self.gate_system.create_new_ticket(2, 'Car')
+        self.gate_system.close()
+        with open(self.journal_path, 'ab') as f:
+            f.write(b'\x10\x00\x00\x00torn')
+        state = replay(self.journal_path, snapshot_path)
+        self.assertEqual((state.seq, state.slots), (4, {1: True, 2: True}))
+        journal = EventJournal(self.journal_path)
+        journal.append('slot_released', slot=2)
+        journal.close()
+        self.assertEqual(replay(self.journal_path, snapshot_path).slots, {1: True, 2: False})
+
+    def test_two_writers(self):
+        self.gate_system.close()
+        first, second = EventJournal(self.journal_path), EventJournal(self.journal_path)
+        first.append('slot_booked', slot=1)
+        second.append('slot_booked', slot=2)
+        first.close()
+        second.close()
+        self.assertEqual(replay(self.journal_path).slots, {1: True, 2: True})
+
+    def tearDown(self):
+        self.gate_system.close()
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.execute("INSERT INTO parking_slots (slot_number, status) VALUES (1, 'free')")
+            conn.executemany("INSERT INTO parking_prices (vehicle_type, amount) VALUES (?, ?)", [('Car', 60), ('Van', 120)])
+        self.rollups = Rollups(self.storage)
+
+    def test_exit_stores_price_and_rollup(self):
+        gate_system = ParkingGateSystem(self.storage)
+        ticket_id = gate_system.create_new_ticket(1, 'Car')
+        in_time = (datetime.now() - timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S')
+        with self.storage.transaction() as conn:
+            conn.execute("UPDATE parking_tickets SET in_time = ? WHERE ticket_id = ?", (in_time, ticket_id))
+        price = gate_system.add_out_time(ticket_id)
+        self.assertAlmostEqual(price, 120.0, delta=1)
+        with self.storage.connection() as conn:
+            self.assertEqual(conn.execute("SELECT price FROM parking_tickets").fetchone()[0], price)
+        today = datetime.now().strftime('%Y-%m-%d')
+        self.assertEqual(self.rollups.revenue_by_vehicle_type(today), {'Car': price})
+
+    def test_backfill(self):
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_tickets (user_id, in_time, out_time, vehicle_type, slot) VALUES (1, ?, ?, ?, 1)", [
+                ('2024-01-01 10:00:00', '2024-01-01 11:30:00', 'Car'),
+                ('2024-01-01 22:00:00', '2024-01-02 00:30:00', 'Van'),
+                ('2024-01-02 09:00:00', None, 'Car')])
+        self.assertEqual(self.rollups.backfill(), 2)
+        self.assertEqual(self.rollups.daily('2024-01-01', '2024-01-02'),
+                         [('2024-01-01', 'Car', 1, 90.0, 90.0), ('2024-01-02', 'Van', 1, 300.0, 150.0)])
+        self.assertEqual(self.rollups.backfill(), 0)
+        self.assertEqual(self.rollups.hourly('2024-01-02'), [(0, 'Van', 1, 300.0, 150.0)])
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestReports(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_prices (vehicle_type, amount) VALUES (?, ?)", [('Car', 60), ('Van', 120)])
+            conn.executemany("INSERT INTO parking_tickets (user_id, in_time, out_time, vehicle_type, slot) VALUES (1, ?, ?, ?, 1)", [
+                ('2024-01-01 10:30:00', '2024-01-01 12:15:00', 'Car'),
+                ('2024-01-01 11:00:00', '2024-01-01 11:30:00', 'Van'),
+                ('2024-01-02 09:00:00', None, 'Car')])
+        self.reports = Reports(self.storage, chunk_size=2, cache_dir=os.path.join(self.tmp_dir.name, 'cache'))
+
+    def test_hourly_occupancy(self):
+        hours, occupancy = self.reports.hourly_occupancy('2024-01-01 10:00:00', '2024-01-01 12:59:59')
+        self.assertEqual(str(hours[0]), '2024-01-01T10')
+        self.assertEqual(occupancy.tolist(), [0.5, 1.5, 0.25])
+
+    def test_dwell_revenue_and_heatmap(self):
+        histogram = self.reports.dwell_histogram()
+        self.assertEqual((histogram['Car'][3], histogram['Van'][2]), (1, 1))
+        self.assertEqual(self.reports.revenue_by_vehicle_type(), {'Car': 105.0, 'Van': 60.0})
+        heatmap = self.reports.peak_hour_heatmap()
+        self.assertEqual((heatmap[0, 10], heatmap[0, 11], heatmap[1, 9], heatmap.sum()), (1, 1, 1, 3))
+
+    def test_sealed_chunks_are_cached(self):
+        self.reports.revenue_by_vehicle_type()
+        self.assertEqual(len(os.listdir(self.reports.cache_dir)), 1)
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM parking_tickets WHERE ticket_id = 1")
+        self.assertEqual(self.reports.revenue_by_vehicle_type(), {'Car': 105.0, 'Van': 60.0})
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestTariffSchedule(unittest.TestCase):
+
+    def test_flat_rate(self):
+        schedule = TariffSchedule('car', 60)
+        self.assertEqual(schedule.price(timedelta(minutes=90)), 90.0)
+
+    def test_grace_and_rounding(self):
+        schedule = TariffSchedule('car', 60, grace_minutes=10, rounding_minutes=60)
+        self.assertEqual(schedule.price(timedelta(minutes=5)), 0.0)
+        self.assertEqual(schedule.price(timedelta(minutes=61)), 120.0)
+
+    def test_peak_band(self):
+        schedule = TariffSchedule('car', 60, bands=[(8 * 60, 10 * 60, 120, False)])
+        price = schedule.price(timedelta(hours=3), datetime(2024, 1, 1, 7, 0))
+        self.assertEqual(price, 60 + 240)
+
+    def test_overnight_flat_rate(self):
+        schedule = TariffSchedule('car', 60, bands=[(22 * 60, 6 * 60, 100, True)])
+        price = schedule.price(timedelta(hours=10), datetime(2024, 1, 1, 21, 0))
+        self.assertEqual(price, 60 + 100 + 60)
+
+    def test_daily_max_multi_day(self):
+        schedule = TariffSchedule('car', 60, daily_max=500, bands=[(8 * 60, 10 * 60, 120, False)])
+        price = schedule.price(timedelta(days=30, hours=1), datetime(2024, 1, 1, 12, 0))
+        self.assertEqual(price, 30 * 500 + 60)
+
+
+class TestQRCodeRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.renderer = QRCodeRenderer(self.tmp_dir.name, workers=1)
+
+    def test_submit_renders_once(self):
+        path = self.renderer.submit('1001').result(timeout=30)
+        self.assertEqual(path, self.renderer.path_for('1001'))
+        self.assertTrue(os.path.exists(path))
+        mtime = os.path.getmtime(path)
+        self.assertEqual(self.renderer.submit('1001').result(timeout=30), path)
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+    def test_on_demand_formats(self):
+        self.assertTrue(render_qr('1001', 'png').startswith(b'\x89PNG'))
+        self.assertIn(b'<svg', render_qr('1001', 'svg'))
+        with self.assertRaises(ValueError):
+            render_qr('1001', 'gif')
+
+    def tearDown(self):
+        self.renderer.close()
+        self.tmp_dir.cleanup()
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        legacy_slots = os.path.join(self.tmp_dir.name, 'parking_slots.db')
+        conn = sqlite3.connect(legacy_slots)
+        conn.execute("CREATE TABLE parking_slots (slot_number INT PRIMARY KEY, status VARCHAR(10))")
+        conn.executemany("INSERT INTO parking_slots VALUES (?, 'free')", [(1,), (2,)])
+        conn.commit()
+        conn.close()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), pool_size=2,
+                               legacy_databases=((legacy_slots, 'parking_slots'),))
+
+    def test_wal_mode(self):
+        with self.storage.connection() as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode;").fetchone()[0], 'wal')
+
+    def test_legacy_import(self):
+        with self.storage.connection() as conn:
+            slots = conn.execute("SELECT slot_number FROM parking_slots ORDER BY slot_number").fetchall()
+        self.assertEqual(slots, [(1,), (2,)])
+
+    def test_pool_reuses_connections(self):
+        with self.storage.connection() as first:
+            pass
+        with self.storage.connection() as second:
+            self.assertIs(first, second)
+
+    def test_migrations_create_indexes(self):
+        with self.storage.connection() as conn:
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM parking_tickets WHERE user_id = ? ORDER BY in_time", (1,)).fetchall()
+        self.assertIn('idx_parking_tickets_user_in_time', indexes)
+        self.assertIn('idx_parking_tickets_open', indexes)
+        self.assertIn('idx_parking_tickets_user_in_time', plan[0][3])
+
+    def test_add_users_bulk(self):
+        admin = Admin(self.storage, qr_renderer=MagicMock(path_for=lambda payload: f'qr_{payload}.png'))
+        with self.storage.transaction() as conn:
+            conn.execute("INSERT INTO users (user_id, name) VALUES (3, 'Existing')")
+        records = [('Ann', 'a@example.com', '1', 10), ('', None, None, 0), {'name': 'Bob', 'initial_balance': 5},
+                   ('Cy', None, None, 'lots'), ('Di', None, None, 1)]
+        created, failed = admin.add_users_bulk(records)
+        self.assertEqual([(index, user_id) for index, user_id, _ in created], [(0, 1), (2, 2)])
+        self.assertEqual([index for index, _ in failed], [1, 3, 4])
+        created, failed = admin.add_users_bulk([('Ed', None, None, 7)])
+        self.assertEqual((created[0][1], failed), (4, []))
+        with self.storage.connection() as conn:
+            balances = conn.execute("SELECT user_id, amount FROM user_data ORDER BY user_id").fetchall()
+        self.assertEqual(balances, [(1, 10.0), (2, 5.0), (4, 7.0)])
+
+    def test_add_users_bulk_rolled_back(self):
+        admin = Admin(self.storage, qr_renderer=MagicMock(path_for=lambda payload: f'qr_{payload}.png'))
+        with self.storage.transaction() as conn:
+            conn.execute("INSERT INTO users (user_id, name) VALUES (2, 'Existing')")
+        insert_users = admin._insert_users
+
+        def fail_last_chunk(conn, rows, created, failed):
+            if rows[0][0] == 3:
+                raise sqlite3.OperationalError("disk I/O error")
+            insert_users(conn, rows, created, failed)
+        admin._insert_users = fail_last_chunk
+        records = [('Ann', None, None, 1), ('Bob', None, None, 1), ('', None, None, 0), ('Cy', None, None, 1)]
+        created, failed = admin.add_users_bulk(records, chunk_size=1)
+        self.assertEqual(created, [])
+        self.assertEqual([index for index, _ in failed], [0, 1, 2, 3])
+        self.assertTrue(failed[1][1].startswith("Database error"))
+        self.assertTrue(failed[2][1].startswith("Invalid record"))
+
+    def test_history_pagination(self):
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_tickets (user_id, in_time, vehicle_type, slot) VALUES (?, ?, ?, 1)",
+                             [(7, f'2024-01-{day:02d} 10:00:00', 'Car' if day % 2 else 'Van') for day in range(1, 11)])
+        history = TicketHistory(self.storage)
+        rows, cursor = history.page(7, limit=4)
+        self.assertEqual([row[2][:10] for row in rows], ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04'])
+        rows, cursor = history.page(7, after=cursor, limit=4)
+        self.assertEqual(rows[0][2][:10], '2024-01-05')
+        self.assertEqual(len(list(history.stream(7, chunk_size=3))), 10)
+        self.assertEqual(len(list(history.stream(7, chunk_size=3, vehicle_type='Van', start='2024-01-05'))), 3)
+
+    def test_transaction_rolls_back(self):
+        with self.assertRaises(ValueError):
+            with self.storage.transaction() as conn:
+                conn.execute("UPDATE parking_slots SET status='occupied'")
+                raise ValueError()
+        with self.storage.connection() as conn:
+            occupied = conn.execute("SELECT COUNT(*) FROM parking_slots WHERE status='occupied'").fetchone()[0]
+        self.assertEqual(occupied, 0)
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_trace_is_reproducible(self):
+        trace = make_trace(200, 50, 3, seed=7, rush_factor=2.0)
+        self.assertEqual(trace, make_trace(200, 50, 3, seed=7, rush_factor=2.0))
+        self.assertEqual(sum(len(events) for events in trace), 200)
+        for gate, events in enumerate(trace):
+            self.assertEqual([event[0] for event in events], sorted(event[0] for event in events))
+            self.assertTrue(all(event[2] % 3 == gate for event in events))
+
+    def test_run_benchmark(self):
+        report = run_benchmark(slots=40, users=20, operations=100, gates=2)
+        self.assertEqual(report["errors"], 0)
+        entries = report["operations"]["entry"]
+        self.assertEqual(entries["count"], sum(event[1] == "entry" for events in make_trace(100, 20, 2) for event in events))
+        self.assertLessEqual(entries["p50_ms"], entries["p95_ms"])
+        self.assertLessEqual(entries["p95_ms"], entries["p99_ms"])
+        self.assertEqual(report["operations"]["all"]["count"], entries["count"] + report["operations"]["exit"]["count"])
+        json.dumps(report)
+
+    def test_imports_are_light(self):
+        report = measure_startup({"src.admin": 10000, "src.server": 10000}, repeats=1)
+        for module in ("src.admin", "src.server"):
+            self.assertEqual(report["modules"][module]["heavy_modules"], [])
+            self.assertEqual(report["modules"][module]["created_files"], [])
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_paths_follow_data_dir(self):
+        config = Config(data_dir='data', journal_path='events.journal')
+        self.assertEqual(config.db_path, os.path.join('data', 'parking.db'))
+        self.assertEqual(config.lots_dir, os.path.join('data', 'lots'))
+        self.assertEqual(config.journal_path, 'events.journal')
+        self.assertIn((os.path.join('data', 'users_data.db'), 'user_data'), config.legacy_databases)
+
+    def test_from_env(self):
+        config = Config.from_env({'PARKING_DATA_DIR': 'site', 'PARKING_POOL_SIZE': '2'}, log_level='DEBUG')
+        self.assertEqual((config.db_path, config.pool_size, config.log_level), (os.path.join('site', 'parking.db'), 2, 'DEBUG'))
+
+    def test_storage_opens_lazily(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'lazy.db')
+            storage = Storage(db_path, legacy_databases=())
+            self.assertFalse(os.path.exists(db_path))
+            with storage.connection() as conn:
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM parking_slots").fetchone()[0], 0)
+            storage.close()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_histogram_and_render(self):
+        latency = self.registry.histogram("op_seconds", "Latency.", ("operation",), buckets=(0.001, 0.01, 0.1))
+        for value in (0.0005, 0.0005, 0.005, 0.05):
+            latency.observe(value, operation="entry")
+        self.assertEqual(latency.percentile(50, operation="entry"), 0.001)
+        self.assertEqual(latency.percentile(99, operation="entry"), 0.1)
+        self.assertIs(self.registry.histogram("op_seconds", "Latency.", ("operation",)), latency)
+        retries = self.registry.counter("retries_total", "Retries.", ("reason",))
+        retries.inc(reason="locked")
+        text = self.registry.render()
+        self.assertIn('op_seconds_bucket{operation="entry",le="0.01"} 3', text)
+        self.assertIn('op_seconds_count{operation="entry"} 4', text)
+        self.assertIn('retries_total{reason="locked"} 1', text)
+        with self.assertRaises(ValueError):
+            self.registry.counter("op_seconds", "Latency.")
+
+    def test_metrics_server(self):
+        self.registry.counter("requests_total", "Requests.").inc(3)
+        server = MetricsServer(self.registry, port=0)
+        try:
+            body = urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics").read().decode()
+        finally:
+            server.close()
+        self.assertIn("requests_total 3", body)
+
+    def test_profiled_connection(self):
+        conn = sqlite3.connect(":memory:", factory=ProfiledConnection)
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.executemany("INSERT INTO t   VALUES (?)", [(1,), (2,)])
+        conn.close()
+        self.assertIsNotNone(QUERY_SECONDS.percentile(50, statement="INSERT INTO t VALUES (?)"))
+
+
+class TestReservations(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_slots (slot_number, status, size_class) VALUES (?, 'free', ?)",
+                             [(1, 'car'), (2, 'car'), (3, 'van')])
+        self.lot = ParkingLot(self.storage)
+        self.now = datetime.now().replace(microsecond=0)
+
+    def test_free_slots_between(self):
+        later = self.now + timedelta(hours=4)
+        first = self.lot.reserve(1, 'Car', later, later + timedelta(hours=2))
+        self.assertEqual(first.slot, 1)
+        self.assertEqual(self.lot.free_slots_between(later + timedelta(hours=1), later + timedelta(hours=3), 'Car'), [2, 3])
+        self.assertEqual(self.lot.free_slots_between(later + timedelta(hours=2), later + timedelta(hours=3), 'Car'), [1, 2, 3])
+        self.assertEqual(self.lot.free_slots_between(later, later + timedelta(hours=1), 'Van'), [3])
+        self.assertEqual(self.lot.reserve(2, 'Car', later, later + timedelta(hours=1)).slot, 2)
+        self.assertEqual(self.lot.reserve(3, 'Car', later, later + timedelta(hours=1)).slot, 3)
+        self.assertIsNone(self.lot.reserve(4, 'Car', later, later + timedelta(hours=1)))
+        self.assertTrue(self.lot.cancel_reservation(first.reservation_id))
+        self.assertEqual(self.lot.reserve(4, 'Car', later, later + timedelta(hours=1)).slot, 1)
+        with self.assertRaises(ValueError):
+            self.lot.reserve(5, 'Car', later, later)
+
+    def test_reserve_rechecks_database(self):
+        other = Reservations(self.storage)
+        later = self.now + timedelta(hours=4)
+        self.lot.free_slots_between(later, later + timedelta(hours=1))
+        other.reserve(1, 'Car', later, later + timedelta(hours=1), slot=1)
+        self.assertIsNone(self.lot.reservations.reserve(2, 'Car', later, later + timedelta(hours=1), slot=1))
+
+    def test_gate_honors_reservation(self):
+        self.lot.reserve(7, 'Car', self.now + timedelta(minutes=10), self.now + timedelta(hours=2))
+        self.lot.park_vehicle(8, 'Car')
+        self.lot.park_vehicle(9, 'Car')
+        self.assertEqual(self.lot.park_vehicle(10, 'Car'), "No empty slots available")
+        ticket_id = self.lot.park_vehicle(7, 'Car')
+        with self.storage.connection() as conn:
+            self.assertEqual(conn.execute("SELECT user_id, slot FROM parking_tickets ORDER BY ticket_id").fetchall(),
+                             [(8, 2), (9, 3), (7, 1)])
+            self.assertEqual(conn.execute("SELECT status, ticket_id FROM reservations").fetchone(), ('used', ticket_id))
+
+    def tearDown(self):
+        self.lot.gate_system.close()
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestForecaster(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        self.now = datetime(2024, 5, 6, 9, 0)
+        tickets = []
+        for day in range(1, 8):
+            for minute in range(0, 60, 10):
+                in_time = self.now - timedelta(days=day) + timedelta(minutes=minute)
+                out_time = in_time + timedelta(hours=1)
+                tickets.append((1, str(in_time), str(out_time), 'Car', 1))
+        tickets.append((2, str(self.now - timedelta(minutes=30)), None, 'Car', 2))
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_slots (slot_number, status, size_class) VALUES (?, 'free', 'car')",
+                             [(slot,) for slot in range(1, 11)])
+            conn.executemany("INSERT INTO parking_tickets (user_id, in_time, out_time, vehicle_type, slot) VALUES (?, ?, ?, ?, ?)", tickets)
+        self.forecaster = Forecaster(self.storage, history_days=7, surge_threshold=0.5)
+        self.assertEqual(self.forecaster.fit(self.now), 43)
+
+    def test_predict(self):
+        times, free = self.forecaster.predict(2, self.now)
+        self.assertEqual(len(times), 9)
+        # Six arrivals in the 9:00 hour staying an hour each, plus the vehicle parked since 8:30.
+        self.assertAlmostEqual(free['car'][0], 9.0)
+        self.assertAlmostEqual(free['car'][2], 6.0)
+        self.assertEqual(free['van'].tolist(), [0.0] * 9)
+
+    def test_price_factor_and_updates(self):
+        self.assertEqual(self.forecaster.price_factor('Car', self.now.replace(hour=3)), 1.0)
+        self.assertGreater(self.forecaster.price_factor('Car', self.now.replace(hour=10)), 1.0)
+        self.assertEqual(self.forecaster.price_factor('Car', self.now.replace(hour=13)), 1.0)
+        for minute in range(12):
+            self.forecaster.observe_entry(self.now.replace(hour=12, minute=minute), 'car')
+        # Observing doesn't rebuild the factors; the next refresh picks the entries up.
+        self.assertEqual(self.forecaster.price_factor('Car', self.now.replace(hour=13)), 1.0)
+        self.forecaster.refresh()
+        self.assertGreater(self.forecaster.price_factor('Car', self.now.replace(hour=13)), 1.0)
+
+    def test_stale_model_refreshes_in_background(self):
+        self.forecaster.refresh_seconds = 0
+        for minute in range(12):
+            self.forecaster.observe_entry(self.now.replace(hour=12, minute=minute), 'car')
+        self.assertEqual(self.forecaster.price_factor('Car', self.now.replace(hour=13)), 1.0)
+        for thread in threading.enumerate():
+            if thread.name == "forecast-refresh":
+                thread.join()
+        self.assertGreater(self.forecaster.price_factor('Car', self.now.replace(hour=13)), 1.0)
+
+    def test_gate_feeds_prices(self):
+        with self.storage.transaction() as conn:
+            conn.execute("INSERT INTO parking_prices (vehicle_type, amount) VALUES ('Car', 60)")
+        gate_system = ParkingGateSystem(self.storage, forecaster=self.forecaster)
+        factor = self.forecaster.price_factor('Car', self.now.replace(hour=10))
+        self.assertAlmostEqual(gate_system.get_price(timedelta(hours=1), 'Car', self.now.replace(hour=10)), 60 * factor)
+        self.assertEqual(gate_system.get_price(timedelta(hours=1), 'Car', self.now.replace(hour=3)), 60.0)
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_slots (slot_number, status) VALUES (?, 'free')", [(1,), (2,)])
+            conn.execute("INSERT INTO parking_prices (vehicle_type, amount) VALUES ('Car', 60)")
+            conn.executemany("INSERT INTO user_data (user_id, amount) VALUES (?, ?)", [(1, 100), (2, 0)])
+            record_openings(conn, [(1, 100), (2, 0)])
+        self.lot = ParkingLot(self.storage, min_balance=1)
+        self.ledger = Ledger(self.storage, chunk_size=1)
+
+    def test_exit_debits_balance(self):
+        ticket_id = self.lot.park_vehicle(1, 'Car')
+        with self.storage.transaction() as conn:
+            conn.execute("UPDATE parking_tickets SET in_time = ? WHERE ticket_id = ?",
+                         ((datetime.now() - timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S'), ticket_id))
+        self.assertEqual(self.lot.check_user_balance(1), 100)
+        price = self.lot.leave_parking(ticket_id)
+        self.assertAlmostEqual(price, 120.0, delta=1)
+        self.assertAlmostEqual(self.lot.check_user_balance(1), 100 - price)
+        self.assertEqual([entry[1:4] for entry in self.ledger.entries(1)], [(-price, 'parking', ticket_id), (100, 'opening', None)])
+        self.assertEqual(self.lot.park_vehicle(1, 'Car'), "Insufficient balance")
+        self.lot.add_user_balance(1, 50)
+        self.assertIsInstance(self.lot.park_vehicle(1, 'Car'), int)
+
+    def test_entry_policy(self):
+        self.assertEqual(self.lot.park_vehicle(2, 'Car'), "Insufficient balance")
+        self.assertEqual(self.lot.park_vehicle(99, 'Car'), "Insufficient balance")
+        self.assertEqual(self.lot.count_available_slots(), 2)
+
+    def test_reconcile(self):
+        self.lot.users.bulk_add_balance([(1, 10), (2, 5), (3, 1)])
+        self.assertEqual(self.ledger.reconcile(), [])
+        with self.storage.transaction() as conn:
+            conn.execute("UPDATE user_data SET amount = 500 WHERE user_id = 2")
+        self.assertEqual(self.ledger.reconcile(repair=True), [(2, 500, 5.0)])
+        self.assertEqual(self.ledger.reconcile(), [])
+        self.lot.users.invalidate(2)
+        self.assertEqual(self.lot.check_user_balance(2), 5)
+
+    def tearDown(self):
+        self.lot.gate_system.close()
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestLotRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.user_storage = Storage(os.path.join(self.tmp_dir.name, 'users.db'), legacy_databases=())
+        self.lots_dir = os.path.join(self.tmp_dir.name, 'lots')
+        self.router = LotRouter(['north', 'south'], self.user_storage, self.lots_dir)
+        for lot_id, slots in (('north', [(1,), (2,)]), ('south', [(1,)])):
+            with self.router.lot(lot_id).storage.transaction() as conn:
+                conn.executemany("INSERT INTO parking_slots (slot_number, status) VALUES (?, 'free')", slots)
+            self.router.lot(lot_id).slot_manager.load_free_slots()
+
+    def test_routes_to_each_lot(self):
+        self.assertEqual(self.router.park_vehicle('north', 7, 'Car'), 1)
+        self.assertEqual(self.router.park_vehicle('south', 7, 'Car'), 1)
+        self.assertEqual(self.router.park_vehicle('south', 8, 'Car'), "No empty slots available")
+        self.assertEqual(self.router.total_occupancy(), ((1, 2), {'north': (1, 1), 'south': (0, 1)}))
+        self.assertEqual([row[:2] for row in self.router.user_history(7)], [('north', 1), ('south', 1)])
+        with self.assertRaises(ValueError):
+            self.router.park_vehicle('east', 7, 'Car')
+
+    def test_discovers_existing_lots(self):
+        router = LotRouter(user_storage=self.user_storage, directory=self.lots_dir)
+        self.assertEqual(sorted(router.lots), ['north', 'south'])
+        router.close()
+
+    def tearDown(self):
+        self.router.close()
+        for lot in self.router.lots.values():
+            lot.storage.close()
+        self.user_storage.close()
+        self.tmp_dir.cleanup()
+
+
+class TestGateServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp_dir.name, 'parking.db'), legacy_databases=())
+        with self.storage.transaction() as conn:
+            conn.executemany("INSERT INTO parking_slots (slot_number, status) VALUES (?, 'free')", [(1,), (2,)])
+            conn.execute("INSERT INTO parking_prices (vehicle_type, amount) VALUES ('Car', 60)")
+            conn.execute("INSERT INTO user_data VALUES (1, 100)")
+        self.server = GateServer(ParkingLot(self.storage), port=0)
+        await self.server.start()
+
+    async def request(self, **request):
+        reader, writer = await asyncio.open_connection(self.server.host, self.server.port)
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        writer.close()
+        await writer.wait_closed()
+        return response
+
+    async def test_concurrent_entries(self):
+        responses = await asyncio.gather(*[self.request(op="enter", user_id=1, vehicle_type="Car") for _ in range(3)])
+        self.assertEqual(sorted(r["ok"] for r in responses), [False, True, True])
+        self.assertEqual(await self.request(op="availability"), {"ok": True, "result": 0})
+
+    async def test_exit_and_balance(self):
+        ticket = await self.request(op="enter", user_id=1, vehicle_type="Car")
+        self.assertTrue((await self.request(op="exit", ticket_id=ticket["result"]))["ok"])
+        self.assertEqual(await self.request(op="balance", user_id=1), {"ok": True, "result": 100})
+
+    async def test_watch_occupancy(self):
+        reader, writer = await asyncio.open_connection(self.server.host, self.server.port)
+        writer.write(json.dumps({"op": "watch"}).encode() + b"\n")
+        await writer.drain()
+        self.assertEqual(json.loads(await reader.readline())["result"]["free"], 2)
+        await self.request(op="enter", user_id=1, vehicle_type="Car")
+        event = json.loads(await asyncio.wait_for(reader.readline(), 5))
+        self.assertEqual((event["event"], event["free"], event["occupied"]), ("occupancy", 1, 1))
+        writer.close()
+        await writer.wait_closed()
+
+    async def test_unknown_op(self):
+        self.assertFalse((await self.request(op="fly"))["ok"])
+
+    async def test_non_object_request(self):
+        reader, writer = await asyncio.open_connection(self.server.host, self.server.port)
+        writer.write(b"[]\n1\n")
+        await writer.drain()
+        self.assertFalse(json.loads(await reader.readline())["ok"])
+        self.assertFalse(json.loads(await reader.readline())["ok"])
+        writer.close()
+        await writer.wait_closed()
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+        self.storage.close()
+        self.tmp_dir.cleanup()
+
 
 if __name__ == '__main__':
     unittest.main(argv=[''], verbosity=2, exit=False)